@@ -25,8 +25,7 @@ class InsulinPump(object):
         bol = np.round(bol / self._params['inc_bolus']
                        ) * self._params['inc_bolus']
         bol = bol / self.U2PMOL     # convert from pmol/min to U/min
-        bol = min(bol, self._params['max_bolus'])
-        bol = max(bol, self._params['min_bolus'])
+        bol = np.clip(bol, self._params['min_bolus'], self._params['max_bolus'])
         return bol
 
     def basal(self, amount):
@@ -34,8 +33,7 @@ class InsulinPump(object):
         bas = np.round(bas / self._params['inc_basal']
                        ) * self._params['inc_basal']
         bas = bas / self.U2PMOL     # convert from pmol/min to U/min
-        bas = min(bas, self._params['max_basal'])
-        bas = max(bas, self._params['min_basal'])
+        bas = np.clip(bas, self._params['min_basal'], self._params['max_basal'])
         return bas
 
     def reset(self):
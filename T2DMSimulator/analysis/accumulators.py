@@ -0,0 +1,240 @@
+import numpy as np
+import copy
+from T2DMSimulator.analysis.risk import risk_array
+from T2DMSimulator.analysis.metrics import TIR_BANDS, HYPO_THRESHOLD, HYPO_MIN_DURATION, _in_band
+
+MINUTES_PER_DAY = 24 * 60
+
+
+class Accumulator(object):
+    '''
+    Statistic of a signal updated one sample at a time in constant memory.
+
+    add takes a sample: a mapping with the simulation minute 'time', its
+    minute past midnight 'time_of_day', the minutes since the previous
+    sample 'sample_time' and the signal values (T2DSimEnv passes BG, CGM,
+    CHO, insulin, LBGI, HBGI and risk). The values may be scalars or
+    equally shaped arrays, e.g. one per patient.
+    value returns the statistic so far, at any time. merge adds the samples
+    of another accumulator of the same kind, e.g. one run in another
+    process, for cohort totals.
+    '''
+    name = None
+
+    def __init__(self, field='BG'):
+        self.field = field
+        self.reset()
+
+    def reset(self):
+        raise NotImplementedError
+
+    def add(self, sample):
+        raise NotImplementedError
+
+    def value(self):
+        raise NotImplementedError
+
+    def merge(self, other):
+        raise NotImplementedError
+
+    def empty(self):
+        '''
+        An accumulator with the settings of this one and no samples
+        '''
+        other = copy.copy(self)
+        other.reset()
+        return other
+
+
+class RunningStats(Accumulator):
+    '''
+    Count, mean, variance (Welford's algorithm), min and max of field
+    '''
+    name = 'stats'
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, sample):
+        x = sample[self.field]
+        self.count += 1
+        delta = x - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (x - self.mean)
+        self.min = np.minimum(self.min, x)
+        self.max = np.maximum(self.max, x)
+
+    def value(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = self.m2 / self.count if self.count else np.nan
+            sd = np.sqrt(var)
+            return {'count': self.count, 'mean': self.mean if self.count else np.nan, 'var': var, 'sd': sd,
+                    'CV': 100 * sd / self.mean if self.count else np.nan, 'min': self.min, 'max': self.max}
+
+    def merge(self, other):
+        # Chan et al. pairwise update
+        count = self.count + other.count
+        if count:
+            delta = other.mean - self.mean
+            self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+            self.mean = self.mean + delta * other.count / count
+        self.count = count
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        return self
+
+
+class TimeInRange(Accumulator):
+    '''
+    Samples of field in each band of bands (TIR_BANDS by default)
+    '''
+    name = 'time_in_range'
+
+    def __init__(self, field='BG', bands=None):
+        self.bands = TIR_BANDS if bands is None else bands
+        Accumulator.__init__(self, field)
+
+    def reset(self):
+        self.count = 0
+        self.counts = {name: 0 for name in self.bands}
+
+    def add(self, sample):
+        x = sample[self.field]
+        self.count += 1
+        for name, band in self.bands.items():
+            self.counts[name] = self.counts[name] + _in_band(x, *band)
+
+    def value(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return {name: np.divide(count, self.count) for name, count in self.counts.items()}
+
+    def merge(self, other):
+        self.count += other.count
+        for name in self.counts:
+            self.counts[name] = self.counts[name] + other.counts[name]
+        return self
+
+
+class RiskIndex(Accumulator):
+    '''
+    LBGI, HBGI and risk index (RI) of field, the means of analysis.risk
+    '''
+    name = 'risk'
+
+    def reset(self):
+        self.count = 0
+        self.sums = (0.0, 0.0, 0.0)
+
+    def add(self, sample):
+        self.count += 1
+        self.sums = tuple(total + r for total, r in zip(self.sums, risk_array(sample[self.field])))
+
+    def value(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return dict(zip(('LBGI', 'HBGI', 'RI'), (np.divide(total, self.count) for total in self.sums)))
+
+    def merge(self, other):
+        self.count += other.count
+        self.sums = tuple(a + b for a, b in zip(self.sums, other.sums))
+        return self
+
+
+class HypoDetector(Accumulator):
+    '''
+    Hypoglycemic events of field: runs of samples below threshold (mg/dL)
+    lasting at least min_duration minutes, counted once the run is long
+    enough, as metrics.hypo_events. Also counts the minutes below threshold.
+    '''
+    name = 'hypo'
+
+    def __init__(self, field='BG', threshold=HYPO_THRESHOLD, min_duration=HYPO_MIN_DURATION):
+        self.threshold = threshold
+        self.min_duration = min_duration
+        Accumulator.__init__(self, field)
+
+    def reset(self):
+        self.events = 0
+        self.minutes_below = 0.0
+        self.run = 0.0  # minutes of the current run below threshold
+
+    def add(self, sample):
+        below = sample[self.field] < self.threshold
+        run = np.where(below, self.run + sample['sample_time'], 0.0)
+        self.events = self.events + ((run >= self.min_duration) & (self.run < self.min_duration))
+        self.minutes_below = self.minutes_below + below * sample['sample_time']
+        self.run = run
+
+    def value(self):
+        return {'events': self.events, 'minutes_below': self.minutes_below, 'in_event': self.run >= self.min_duration}
+
+    def merge(self, other):
+        # the current run of other is a run of another patient or branch and
+        # does not carry over
+        self.events = self.events + other.events
+        self.minutes_below = self.minutes_below + other.minutes_below
+        return self
+
+
+class DailyRollup(Accumulator):
+    '''
+    accumulators per simulated day (day = time // 1440): each day gets
+    empty copies of them. Memory grows by the few numbers of the
+    accumulators a day.
+    '''
+    name = 'daily'
+
+    def __init__(self, accumulators):
+        self.templates = [accumulator.empty() for accumulator in accumulators]
+        Accumulator.__init__(self, None)
+
+    def reset(self):
+        self.days = {}
+
+    def add(self, sample):
+        day = int(sample['time'] // MINUTES_PER_DAY)
+        if day not in self.days:
+            self.days[day] = [template.empty() for template in self.templates]
+        for accumulator in self.days[day]:
+            accumulator.add(sample)
+
+    def value(self):
+        '''
+        {day: {accumulator name: value}}
+        '''
+        return {day: {accumulator.name: accumulator.value() for accumulator in accumulators}
+                for day, accumulators in sorted(self.days.items())}
+
+    def merge(self, other):
+        for day, accumulators in other.days.items():
+            if day not in self.days:
+                self.days[day] = [accumulator.empty() for accumulator in accumulators]
+            for mine, theirs in zip(self.days[day], accumulators):
+                mine.merge(theirs)
+        return self
+
+    def empty(self):
+        return DailyRollup(self.templates)
+
+
+def default_accumulators(field='BG'):
+    '''
+    RunningStats, TimeInRange, RiskIndex, HypoDetector and their DailyRollup
+    of field
+    '''
+    accumulators = [RunningStats(field), TimeInRange(field), RiskIndex(field), HypoDetector(field)]
+    return accumulators + [DailyRollup(accumulators)]
+
+
+def merge_all(accumulators):
+    '''
+    Cohort total of a list of accumulators of the same kind (e.g. gathered
+    from worker processes), the inputs are left unchanged
+    '''
+    total = accumulators[0].empty()
+    for accumulator in accumulators:
+        total.merge(accumulator)
+    return total
@@ -0,0 +1,131 @@
+import numpy as np
+import pandas as pd
+from T2DMSimulator.analysis.accumulators import Accumulator, MINUTES_PER_DAY
+
+PERCENTILES = (5, 25, 50, 75, 95)
+
+
+class AmbulatoryGlucoseProfile(Accumulator):
+    '''
+    Percentile bands of glucose by time of day (an AGP) over any number of
+    patients and days in bounded memory.
+
+    Samples are binned on the fly into bin_minutes slots of the day and,
+    within a slot, into resolution mg/dL levels over [low, high] (values
+    outside count in the end levels, CGM readings are clipped to the sensor
+    range anyway). The counts are a quantile sketch with a fixed error of
+    half a level: the memory (slots x levels) does not grow with the
+    samples, and sketches merge exactly by adding counts, e.g. from worker
+    processes.
+
+    As an Accumulator of T2DSimEnv it takes field from every sample at its
+    'time_of_day'. add_values, add_traces, add_history and add_columns add
+    samples in bulk.
+    '''
+    name = 'agp'
+
+    def __init__(self, field='CGM', bin_minutes=15, low=0, high=600, resolution=1):
+        if MINUTES_PER_DAY % bin_minutes:
+            raise ValueError('bin_minutes must divide a day, got {}'.format(bin_minutes))
+        self.bin_minutes = bin_minutes
+        self.low = low
+        self.resolution = resolution
+        self.n_levels = int(np.ceil((high - low) / resolution)) + 1
+        Accumulator.__init__(self, field)
+
+    def reset(self):
+        self.counts = np.zeros((MINUTES_PER_DAY // self.bin_minutes, self.n_levels), dtype=np.int64)
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    def add(self, sample):
+        self.add_values(sample['time_of_day'], sample[self.field])
+
+    def add_values(self, minute_of_day, values):
+        '''
+        Add values taken at minute_of_day (broadcast against each other,
+        minutes past midnight, counted modulo a day). NaN values are left
+        out.
+        '''
+        minute_of_day, values = np.broadcast_arrays(minute_of_day, np.asarray(values, dtype=float))
+        slot = (minute_of_day.astype(int) % MINUTES_PER_DAY) // self.bin_minutes
+        level = np.clip(np.floor((values - self.low) / self.resolution), 0, self.n_levels - 1)
+        valid = ~np.isnan(level)
+        if slot.ndim == 0:
+            if valid:
+                self.counts[slot, int(level)] += 1
+            return
+        cell = slot[valid] * self.n_levels + level[valid].astype(int)
+        if len(cell) > self.counts.size // 8:
+            self.counts += np.bincount(cell, minlength=self.counts.size).reshape(self.counts.shape)
+        else:
+            np.add.at(self.counts.reshape(-1), cell, 1)
+
+    def add_traces(self, values, sample_time, start_minute=0):
+        '''
+        Add a (patients, time) matrix of samples sample_time minutes apart,
+        the first sample of each patient at start_minute (a scalar or one
+        per patient) past midnight
+        '''
+        values = np.atleast_2d(values)
+        minutes = np.reshape(start_minute, (-1, 1)) + np.arange(values.shape[1]) * sample_time
+        self.add_values(minutes, values)
+
+    def add_history(self, df, field='CGM'):
+        '''
+        Add column field of a T2DSimEnv.show_history DataFrame (indexed by
+        Time, datetimes or minutes)
+        '''
+        index = df.index
+        if isinstance(index, pd.DatetimeIndex):
+            minutes = index.hour * 60 + index.minute + index.second / 60
+        else:
+            minutes = np.asarray(index, dtype=float)
+        self.add_values(np.asarray(minutes), df[field].to_numpy(dtype=float))
+
+    def add_columns(self, columns, start_time=None, field='CGM'):
+        '''
+        Add history columns, e.g. read back from a history sink (NpzSink.read),
+        whose time column counts minutes from start_time
+        '''
+        start = 0 if start_time is None else start_time.hour * 60 + start_time.minute
+        self.add_values(start + np.asarray(columns['time']), columns[field])
+
+    def merge(self, other):
+        if self.counts.shape != other.counts.shape or (self.low, self.resolution) != (other.low, other.resolution):
+            raise ValueError('Only profiles with the same bins and levels merge')
+        self.counts += other.counts
+        return self
+
+    def percentiles(self, q=PERCENTILES):
+        '''
+        (len(q), slots) array of the percentiles q of every time of day slot,
+        the centre of the level holding the sample of that rank, NaN for
+        slots without samples
+        '''
+        cumulative = np.cumsum(self.counts, axis=1)
+        total = cumulative[:, -1]
+        bands = np.full((len(q), len(total)), np.nan)
+        for i, percentile in enumerate(q):
+            rank = np.maximum(np.ceil(percentile / 100 * total), 1)
+            level = (cumulative < rank[:, None]).sum(axis=1)
+            bands[i] = np.where(total > 0, self.low + (level + 0.5) * self.resolution, np.nan)
+        return bands
+
+    def value(self, q=PERCENTILES):
+        '''
+        {'minute': start of every slot, 'p<q>': percentile q of every slot}
+        '''
+        values = {'minute': np.arange(len(self.counts)) * self.bin_minutes}
+        values.update(('p{}'.format(percentile), band) for percentile, band in zip(q, self.percentiles(q)))
+        return values
+
+    def to_dataframe(self, q=PERCENTILES):
+        '''
+        The bands as a DataFrame indexed by the time of day of the slots
+        '''
+        values = self.value(q)
+        index = pd.to_timedelta(values.pop('minute'), unit='min').rename('Time of day')
+        return pd.DataFrame(values, index=index)
@@ -0,0 +1,184 @@
+import copy
+import logging
+import numpy as np
+from collections import namedtuple
+from scipy.optimize import least_squares
+from T2DMSimulator.glucose.GlucoseParameters import GlucoseParameters
+from T2DMSimulator.glucose.compiled import parameter_index, PARAMETER_LAYOUT, N_GLUCOSE_PARAMETERS
+from T2DMSimulator.glucose.glucose_initializer import STEADY_STATE_CACHE, SteadyStateCache
+from T2DMSimulator.patient.t2dpatient import T2DPatient, Action
+from T2DMSimulator.simulation.rollout import rollout
+
+pathos = True
+try:
+    from pathos.multiprocessing import ProcessPool as Pool
+except ImportError:
+    pathos = False
+
+logger = logging.getLogger(__name__)
+
+CalibrationResult = namedtuple("CalibrationResult", ["parameters", "values", "relative_std", "glucose_params",
+                                                     "residual_std", "cost", "n_simulations", "optimizer"])
+
+
+def diary_actions(diary, n_steps):
+    '''
+    Per minute patient Action of (n_steps,) arrays from a meal and
+    medication diary, a list of (minute, field, amount) entries with field a
+    patient Action field, e.g. (420, 'CHO', 45) or (420, 'metformin', 500).
+    Entries in the same minute add up.
+    '''
+    fields = {field: np.zeros(n_steps) for field in Action._fields}
+    for minute, field, amount in diary:
+        if field not in fields:
+            raise ValueError('Unknown diary field {}, expected one of {}'.format(field, Action._fields))
+        fields[field][int(minute)] += amount
+    return Action(**fields)
+
+
+class Calibration(object):
+    '''
+    Fits a subset of GlucoseParameters to a CGM trace by weighted least
+    squares (the maximum likelihood fit under Gaussian sensor noise of
+    standard deviation sigma). The parameters are fitted on a log scale.
+
+    Each evaluation builds a T2DPatient from the candidate parameters, whose
+    initial state comes from GlucoseInitializer and its steady state cache,
+    and simulates the diary with simulation.rollout. The Jacobian is taken
+    by forward differences, its simulations run in a process pool (pathos)
+    when available.
+    '''
+    def __init__(self, times, CGM, actions, parameters, glucose_params=None, lower=None, upper=None, sigma=1.0,
+                 patient_kwargs=None, cache_directory=None, rtol=1e-6, atol=1e-8, step=1e-3):
+        '''
+        Calibration constructor.
+        Inputs:
+            - times: minutes of the CGM readings from the start of the diary,
+              when the patient is assumed to be at its fasting initial state
+            - CGM: the readings (mg/dl)
+            - actions: a patient Action of per minute inputs covering the
+              readings, scalars or arrays (see diary_actions)
+            - parameters: names of the GlucoseParameters entries to fit, as
+              for compiled.parameter_index (e.g. 'pancreasModel.Ks')
+            - glucose_params: starting GlucoseParameters (default values if
+              None), the other entries stay fixed
+            - lower, upper: bounds of the fitted values, a tenth and ten
+              times the starting values by default
+            - sigma: standard deviation of the CGM noise (mg/dl)
+            - patient_kwargs: further T2DPatient arguments, e.g.
+              steady_state=True
+            - cache_directory: directory of an on-disk SteadyStateCache
+              of the simulated patients, shared by the worker processes.
+              Without one the patients use the shared STEADY_STATE_CACHE
+            - rtol, atol: solver tolerances of the simulations
+            - step: forward difference step on the log scale
+        '''
+        self.times = np.asarray(times, dtype=float)
+        self.CGM = np.asarray(CGM, dtype=float)
+        if self.times.shape != self.CGM.shape:
+            raise ValueError('times and CGM must have the same shape')
+        self.n_steps = int(np.ceil(self.times.max()))
+        self.actions = Action(*(value if np.ndim(value) == 0 else np.asarray(value, dtype=float)[:self.n_steps]
+                                for value in actions))
+        self.indices = [parameter_index(name) for name in parameters]
+        if any(i >= N_GLUCOSE_PARAMETERS for i in self.indices):
+            raise ValueError('Only GlucoseParameters entries can be fitted, the basal values follow from them')
+        self.parameters = ['{}.{}'.format(*PARAMETER_LAYOUT[i]) for i in self.indices]
+        self.glucose_params = GlucoseParameters() if glucose_params is None else glucose_params
+        self.start = np.array([getattr(getattr(self.glucose_params, submodel), name)
+                               for submodel, name in (PARAMETER_LAYOUT[i] for i in self.indices)], dtype=float)
+        if np.any(self.start <= 0):
+            raise ValueError('Fitted parameters must be positive, they are fitted on a log scale')
+        self.lower = self.start / 10 if lower is None else np.asarray(lower, dtype=float)
+        self.upper = self.start * 10 if upper is None else np.asarray(upper, dtype=float)
+        self.sigma = sigma
+        self.patient_kwargs = {} if patient_kwargs is None else patient_kwargs
+        self.cache = STEADY_STATE_CACHE if cache_directory is None else SteadyStateCache(directory=cache_directory)
+        self.rtol = rtol
+        self.atol = atol
+        self.step = step
+        self.n_simulations = 0
+        self._last = None
+
+    def glucose_parameters(self, values):
+        '''
+        Copy of the starting GlucoseParameters with the fitted entries set to values
+        '''
+        glucose_params = copy.deepcopy(self.glucose_params)
+        for i, value in zip(self.indices, values):
+            submodel, name = PARAMETER_LAYOUT[i]
+            setattr(getattr(glucose_params, submodel), name, float(value))
+        return glucose_params
+
+    def simulate(self, values):
+        '''
+        BG at every minute of the diary for the fitted entries set to values
+        '''
+        patient = T2DPatient({}, glucose_params=self.glucose_parameters(values), steady_state_cache=self.cache,
+                             **self.patient_kwargs)
+        return rollout(patient, self.actions, self.n_steps, rtol=self.rtol, atol=self.atol).BG[0]
+
+    def residuals(self, z):
+        '''
+        Weighted residuals (simulated - CGM) / sigma at log scale values z
+        '''
+        if self._last is None or not np.array_equal(self._last[0], z):
+            self._last = (np.array(z), self._residuals(self.simulate(np.exp(z))))
+            self.n_simulations += 1
+        return self._last[1]
+
+    def jacobian(self, z, mapper=map):
+        '''
+        Forward difference Jacobian of residuals, the simulations are
+        distributed with mapper (map or a pool's map)
+        '''
+        base = self.residuals(z)
+        points = [np.exp(z + self.step * e) for e in np.eye(len(z))]
+        columns = [(self._residuals(BG) - base) / self.step for BG in mapper(self.simulate, points)]
+        self.n_simulations += len(points)
+        return np.column_stack(columns)
+
+    def fit(self, processes=None, **kwargs):
+        '''
+        Run scipy.optimize.least_squares (trust region reflective within the
+        bounds) from the starting values.
+        Inputs:
+            - processes: worker processes of the Jacobian simulations, all
+              cores by default, 1 to stay in this process
+            - kwargs: further least_squares arguments
+        Returns a CalibrationResult, relative_std is the standard error of
+        the log of each fitted value from the Gauss-Newton approximation of
+        the covariance.
+        '''
+        pool = None
+        if processes != 1 and pathos:
+            pool = Pool(nodes=processes) if processes else Pool()
+        elif processes != 1:
+            logger.info('pathos is not installed, calibrating in a single process')
+        try:
+            jacobian = (lambda z: self.jacobian(z, pool.map)) if pool is not None else self.jacobian
+            bounds = (np.log(self.lower), np.log(self.upper))
+            z0 = np.clip(np.log(self.start), *bounds)
+            result = least_squares(self.residuals, z0, jac=jacobian, bounds=bounds, **kwargs)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+                pool.clear()
+
+        dof = max(len(self.CGM) - len(self.indices), 1)
+        residual_std = np.sqrt(2 * result.cost / dof) * self.sigma
+        try:
+            covariance = np.linalg.inv(result.jac.T @ result.jac) * (2 * result.cost / dof)
+            relative_std = np.sqrt(np.diag(covariance))
+        except np.linalg.LinAlgError:
+            relative_std = np.full(len(self.indices), np.inf)
+        values = np.exp(result.x)
+        logger.info('Calibration finished after {} simulations: {}'.format(self.n_simulations, result.message))
+        return CalibrationResult(parameters=self.parameters, values=values, relative_std=relative_std,
+                                 glucose_params=self.glucose_parameters(values), residual_std=residual_std,
+                                 cost=result.cost, n_simulations=self.n_simulations, optimizer=result)
+
+    def _residuals(self, BG):
+        minutes = np.arange(len(BG))
+        return (np.interp(self.times, minutes, BG) - self.CGM) / self.sigma
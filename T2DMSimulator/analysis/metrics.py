@@ -0,0 +1,150 @@
+import numpy as np
+from T2DMSimulator.analysis.risk import risk_array
+
+# glucose ranges of the time in range metrics, (low, high, closed) in mg/dL
+# with closed the bounds included ('left', 'right' or 'both'): the
+# international consensus bands of CGM reporting, <54, 54-69, 70-180,
+# 181-250 and >250
+TIR_BANDS = {
+    'very_low': (-np.inf, 54, 'left'),
+    'low': (54, 70, 'left'),
+    'in_range': (70, 180, 'both'),
+    'high': (180, 250, 'right'),
+    'very_high': (250, np.inf, 'right'),
+}
+HYPO_THRESHOLD = 70  # mg/dL
+HYPO_MIN_DURATION = 15  # min
+
+
+def risk_indices(BG):
+    '''
+    LBGI, HBGI and risk index (RI) of BG, the means over the last axis of
+    the risk of analysis.risk. BG is one trace or a (patients, time) matrix,
+    NaN samples are left out.
+    '''
+    BG, valid = _traces(BG)
+    return tuple(np.mean(r, axis=-1, where=valid) for r in risk_array(BG))
+
+
+def time_in_ranges(BG, bands=None):
+    '''
+    Fraction of the (non NaN) samples of each trace in each band.
+    Inputs:
+        - bands: {name: (low, high, closed)} mg/dL as TIR_BANDS, the
+          default
+    Returns {name: fraction}, arrays of one value per trace.
+    '''
+    bands = TIR_BANDS if bands is None else bands
+    BG, valid = _traces(BG)
+    count = valid.sum(axis=-1)
+    return {name: _in_band(BG, *band).sum(axis=-1) / count for name, band in bands.items()}
+
+
+def coefficient_of_variation(BG):
+    '''
+    Standard deviation over mean of each trace, in %
+    '''
+    BG, valid = _traces(BG)
+    return 100 * np.std(BG, axis=-1, where=valid) / np.mean(BG, axis=-1, where=valid)
+
+
+def gmi(BG):
+    '''
+    Glucose management indicator (%) of each trace from its mean BG in
+    mg/dL: 3.31 + 0.02392 * mean
+    '''
+    BG, valid = _traces(BG)
+    return 3.31 + 0.02392 * np.mean(BG, axis=-1, where=valid)
+
+
+def mage(BG):
+    '''
+    Mean amplitude of glycemic excursions of each trace: the mean of the
+    rises and falls between consecutive turning points (local peaks and
+    nadirs) that are larger than the standard deviation of the trace, NaN
+    for a trace without one. Flat stretches do not make a turning point.
+    '''
+    BG, valid = _traces(BG)
+    BG = BG.reshape(-1, BG.shape[-1])
+    n, length = BG.shape
+    sd = np.std(BG, axis=-1, where=valid.reshape(BG.shape))
+    direction = np.sign(np.diff(BG, axis=-1))
+    direction[np.isnan(direction)] = 0
+    # carry the last rise or fall over flat stretches
+    last = np.where(direction != 0, np.arange(length - 1), 0)
+    np.maximum.accumulate(last, axis=-1, out=last)
+    direction = np.take_along_axis(direction, last, axis=-1)
+    turning = np.zeros((n, length), dtype=bool)
+    turning[:, 1:-1] = (direction[:, 1:] != direction[:, :-1]) & (direction[:, :-1] != 0)
+    # excursions between consecutive turning points of the same trace
+    rows, columns = np.nonzero(turning)
+    same = rows[1:] == rows[:-1]
+    amplitude = np.abs(BG[rows[1:], columns[1:]] - BG[rows[:-1], columns[:-1]])[same]
+    rows = rows[1:][same]
+    large = amplitude > sd[rows]
+    total = np.bincount(rows[large], weights=amplitude[large], minlength=n)
+    count = np.bincount(rows[large], minlength=n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return _result(total / count, valid)
+
+
+def hypo_events(BG, sample_time, threshold=HYPO_THRESHOLD, min_duration=HYPO_MIN_DURATION):
+    '''
+    Number of hypoglycemic events of each trace: runs of consecutive
+    samples below threshold (mg/dL) lasting at least min_duration minutes.
+    Inputs:
+        - sample_time: minutes between samples
+    '''
+    BG, valid = _traces(BG)
+    BG = BG.reshape(-1, BG.shape[-1])
+    n, length = BG.shape
+    below = np.zeros((n, length + 2), dtype=np.int8)
+    below[:, 1:-1] = BG < threshold
+    # every run starts and ends within its row as the rows are padded
+    change = np.diff(below, axis=-1).ravel()
+    starts = np.flatnonzero(change == 1)
+    ends = np.flatnonzero(change == -1)
+    long_enough = (ends - starts) * sample_time >= min_duration
+    return _result(np.bincount(starts[long_enough] // (length + 1), minlength=n), valid)
+
+
+def glycemic_metrics(BG, sample_time, chunk=1024):
+    '''
+    All the metrics of this module for one trace or a (patients, time)
+    matrix of BG (or CGM) samples, taken chunk traces at a time to bound
+    the memory of the intermediate arrays.
+    Returns {metric: array of one value per trace} with the keys LBGI, HBGI,
+    RI, CV, GMI, MAGE, hypo_events and the TIR_BANDS names.
+    '''
+    BG = np.asarray(BG, dtype=float)
+    if BG.ndim == 1:
+        return {name: value[0] for name, value in glycemic_metrics(BG[None], sample_time, chunk).items()}
+    blocks = []
+    for start in range(0, len(BG), chunk):
+        block = BG[start:start + chunk]
+        metrics = dict(zip(('LBGI', 'HBGI', 'RI'), risk_indices(block)))
+        metrics.update(time_in_ranges(block))
+        metrics['CV'] = coefficient_of_variation(block)
+        metrics['GMI'] = gmi(block)
+        metrics['MAGE'] = mage(block)
+        metrics['hypo_events'] = hypo_events(block, sample_time)
+        blocks.append(metrics)
+    return {name: np.concatenate([metrics[name] for metrics in blocks]) for name in blocks[0]}
+
+
+def _traces(BG):
+    # BG as a float array of one or more traces along the last axis and the
+    # mask of its valid samples
+    BG = np.asarray(BG, dtype=float)
+    return BG, ~np.isnan(BG)
+
+
+def _in_band(BG, low, high, closed='left'):
+    above = BG >= low if closed in ('left', 'both') else BG > low
+    below = BG <= high if closed in ('right', 'both') else BG < high
+    return above & below
+
+
+def _result(values, valid):
+    # one value for a single trace
+    return values[0] if valid.ndim == 1 else values
@@ -4,10 +4,10 @@ def risk_index(BG, horizon):
     # BG is in mg/dL
     # horizon in samples
     BG_to_compute = BG[-horizon:]
-    risks =[risk(r) for r in BG_to_compute]
-    LBGI = np.mean([r[0] for r in risks])
-    HBGI = np.mean([r[1] for r in risks])
-    RI = np.mean([r[2] for r in risks])
+    rl, rh, ri = risk_array(BG_to_compute)
+    LBGI = np.mean(rl)
+    HBGI = np.mean(rh)
+    RI = np.mean(ri)
 
     return (LBGI, HBGI, RI)
 
@@ -28,4 +28,21 @@ def risk(BG):
         rl = ri
     if U >= 0:
         rh = ri
-    return (rl, rh, ri)
\ No newline at end of file
+    return (rl, rh, ri)
+
+def risk_array(BG):
+    '''
+    Vectorized risk: returns the (rl, rh, ri) arrays of an array of BG values
+    '''
+    MIN_BG = 20.0
+    MAX_BG = 600.0
+    BG = np.asarray(BG, dtype=float)
+    U = 1.509 * (np.log(np.clip(BG, MIN_BG, MAX_BG))**1.084 - 5.381)
+    ri = 10 * U**2
+    rl = np.where(U <= 0, ri, 0.0)
+    rh = np.where(U >= 0, ri, 0.0)
+    low, high = BG <= MIN_BG, BG >= MAX_BG
+    rl = np.where(low, 100.0, np.where(high, 0.0, rl))
+    rh = np.where(low, 0.0, np.where(high, 100.0, rh))
+    ri = np.where(low | high, 100.0, ri)
+    return (rl, rh, ri)
@@ -0,0 +1,154 @@
+import numpy as np
+from collections import namedtuple
+from scipy import sparse
+from scipy.integrate import solve_ivp
+from T2DMSimulator.glucose.compiled import compiled_rhs, parameter_index, update_derived, PARAMETER_NAMES, D_MIPGU0, N_GLUCOSE_PARAMETERS
+from T2DMSimulator.glucose.glucose_initializer import initialize_parameter_matrix
+from T2DMSimulator.glucose.jacobian import compiled_jacobian, N_STATES
+from T2DMSimulator.glucose.steady_state import find_steady_state
+from T2DMSimulator.patient.cohort import T2DCohort
+from T2DMSimulator.patient.inputs import apply_doses, MinuteInputs
+from T2DMSimulator.patient.t2dpatient import Action
+from T2DMSimulator.simulation.rollout import minute_schedule, segment_boundaries
+
+SensitivityResult = namedtuple("SensitivityResult", ["time", "BG", "dBG", "S", "parameters", "values"])
+
+# relative step of the central differences in parameter_directions and
+# parameter_jacobian, about the cube root of machine epsilon
+RELATIVE_STEP = 6e-6
+
+
+def parameter_directions(patient, indices):
+    '''
+    Derivatives of the whole compiled parameter vector, (N_PARAMETERS, P),
+    and of the initial state, (57, P), with respect to the compiled
+    parameters p[indices] of patient. A GlucoseParameters entry also moves
+    the basal entries, the derived ones and X0, which GlucoseInitializer
+    computes from it (the fasting fixed point for a steady_state patient).
+    A basal entry only moves the derived ones. Central differences through
+    initialize_parameter_matrix, on 2 P patients at once.
+    '''
+    indices = np.asarray(indices)
+    n = len(indices)
+    p = patient._compiled_params
+    h = RELATIVE_STEP * np.where(p[indices] != 0, np.abs(p[indices]), 1.0)
+    P = np.tile(p, (2 * n, 1))
+    P[np.arange(n), indices] += h
+    P[n + np.arange(n), indices] -= h
+    update_derived(P)
+    X0 = np.tile(np.asarray(patient.X0v, dtype=float), (2 * n, 1))
+    initialized = np.tile(indices < N_GLUCOSE_PARAMETERS, 2)
+    if initialized.any():
+        rows = P[initialized]
+        X0[initialized] = initialize_parameter_matrix(rows, patient.GBPC0, patient.IBPF0, patient.brates)
+        P[initialized] = rows
+        if patient.steady_state:
+            for i in np.flatnonzero(initialized):
+                X0[i] = find_steady_state(X0[i], P[i], HR=patient.resting_heart_rate)
+    return ((P[:n] - P[n:]) / (2 * h)[:, None]).T, ((X0[:n] - X0[n:]) / (2 * h)[:, None]).T
+
+
+def parameter_jacobian(t, x, p, directions, Dg, stress, HR):
+    '''
+    (57, P) derivatives of compiled_rhs of a single patient along the P
+    columns of directions, the (N_PARAMETERS, P) derivatives of p from
+    parameter_directions. Central differences on one batched RHS call of
+    2 P rows, each column scaled so no entry of p moves by more than
+    RELATIVE_STEP relative.
+    '''
+    n = directions.shape[1]
+    relative = np.abs(directions) / np.where(p != 0, np.abs(p), 1.0)[:, None]
+    h = RELATIVE_STEP / np.maximum(relative.max(axis=0), 1e-300)
+    P = np.concatenate([p + (directions * h).T, p - (directions * h).T])
+    f = compiled_rhs(t, np.tile(x, (2 * n, 1)), P, Dg, stress, HR)
+    return ((f[:n] - f[n:]) / (2 * h)[:, None]).T
+
+
+def forward_sensitivity(patient, parameters, actions, n_steps, snapshot=None, method='BDF', rtol=1e-6, atol=1e-8):
+    '''
+    BG trajectory of patient and its sensitivities dBG/dtheta to compiled
+    parameters, from one integration of the forward sensitivity equations
+    dS/dt = J S + df/dtheta alongside the 57 states (S = dx/dtheta, J the
+    analytic Jacobian of compiled_jacobian). df/dtheta includes the basal
+    and derived parameters computed from theta, see parameter_directions.
+    Inputs:
+        - patient: a T2DPatient
+        - parameters: names (see compiled.parameter_index, e.g.
+          'glucoseMetabolicRates.c1', 'pancreasModel.Ks', 'vLmax') or indices
+          of the compiled parameters, base or basal entries
+        - actions: a patient Action of per minute inputs, scalars or
+          (n_steps,) arrays, as for simulation.rollout
+        - n_steps: horizon in minutes
+        - snapshot: PatientSnapshot to start from, the patient's current
+          state by default. From the patient's initial state (at t0, as
+          after reset) S starts at dX0/dtheta, so the result is the
+          derivative of a simulation of a patient built with theta. From
+          any other state, the state is held fixed and S starts at 0
+        - method, rtol, atol: solve_ivp settings, implicit methods get the
+          block diagonal Jacobian of the augmented system
+    Returns a SensitivityResult with the (n_steps + 1,) times and BG, the
+    (n_steps + 1, P) dBG/dtheta, the (n_steps + 1, 57, P) state
+    sensitivities, the parameter names and their values.
+    '''
+    indices = [name if isinstance(name, (int, np.integer)) else parameter_index(name) for name in parameters]
+    if any(i >= D_MIPGU0 for i in indices):
+        raise ValueError('Derived parameters follow from the base ones, pick those instead')
+    snapshot = patient.snapshot() if snapshot is None else snapshot
+    cohort = T2DCohort.from_snapshot(patient, snapshot, 1)
+    schedule = minute_schedule(cohort, actions, n_steps, patient.resting_heart_rate)
+    boundaries = segment_boundaries(schedule, n_steps)
+    inputs = MinuteInputs(schedule, snapshot.t, cohort.sample_time)
+    p = cohort.params[0]
+    n = len(indices)
+    directions, dX0 = parameter_directions(patient, indices)
+    X0 = np.array(patient.X0v, dtype=float)
+    X0[47] = X0[47] if X0[47] != 0 else 1.0
+    initial = snapshot.t == patient.t0 and np.array_equal(snapshot.state, X0)
+
+    def model(t, y):
+        x, S = y[:N_STATES], y[N_STATES:].reshape(N_STATES, n)
+        Dg, stress, HR = (value[0] for value in inputs(t))
+        dS = compiled_jacobian(t, x, p, Dg, stress, HR) @ S + parameter_jacobian(t, x, p, directions, Dg, stress, HR)
+        return np.concatenate([compiled_rhs(t, x, p, Dg, stress, HR), dS.ravel()])
+
+    def jacobian(t, y):
+        # the J S term of dS/dt is linear in S, its dependence on x through J
+        # is left out of the Newton matrix
+        Dg, stress, HR = (value[0] for value in inputs(t))
+        J = sparse.csr_matrix(compiled_jacobian(t, y[:N_STATES], p, Dg, stress, HR))
+        return sparse.bmat([[J, None], [None, sparse.kron(J, sparse.identity(n))]], format='csc')
+
+    kwargs = {'jac': jacobian} if method in ('BDF', 'Radau') else {}
+    time = snapshot.t + np.arange(n_steps + 1) * cohort.sample_time
+    y = np.concatenate([cohort.X0[0], dX0.ravel() if initial else np.zeros(N_STATES * n)])
+    Y = np.empty((n_steps + 1, len(y)))
+    Y[0] = y
+    for start, stop in zip(boundaries[:-1], boundaries[1:]):
+        action = Action(*(value[0, start] for value in schedule))
+        x, S = y[:N_STATES].copy(), y[N_STATES:].reshape(N_STATES, n).copy()
+        apply_doses(x, action)
+        if action.CHO > 0:
+            # the meal size state is reset to the stomach content
+            S[47] = S[46]
+        y = np.concatenate([x, S.ravel()])
+        sol = solve_ivp(model, (time[start], time[stop]), y, method=method,
+                        t_eval=time[start + 1:stop + 1], rtol=rtol, atol=atol, **kwargs)
+        if not sol.success:
+            raise RuntimeError('Sensitivity integration failed at t = {}: {}'.format(time[start], sol.message))
+        Y[start + 1:stop + 1] = sol.y.T
+        y = sol.y[:, -1]
+
+    S = Y[:, N_STATES:].reshape(-1, N_STATES, n)
+    return SensitivityResult(time=time, BG=Y[:, 34], dBG=S[:, 34, :], S=S,
+                             parameters=[PARAMETER_NAMES[i] for i in indices], values=p[indices])
+
+
+def rank_parameters(result):
+    '''
+    Parameters of a SensitivityResult sorted by the RMS over time of
+    theta * dBG/dtheta, the first order BG change (mg/dl) for doubling the
+    parameter. Returns a list of (name, score).
+    '''
+    scores = np.sqrt(np.mean((result.dBG * result.values) ** 2, axis=0))
+    order = np.argsort(scores)[::-1]
+    return [(result.parameters[i], scores[i]) for i in order]
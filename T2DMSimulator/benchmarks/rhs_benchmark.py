@@ -0,0 +1,37 @@
+'''
+Compares the cost of one RHS evaluation of the T2D model through
+GlucoseDynamics (attribute walking plus the T2DPatient.basal dict) against
+compiled_rhs on the flat parameter vector.
+
+    python -m T2DMSimulator.benchmarks.rhs_benchmark
+'''
+import timeit
+import numpy as np
+from T2DMSimulator.glucose.GlucoseDynamics import GlucoseDynamics
+from T2DMSimulator.glucose.compiled import compile_parameters, compiled_rhs
+from T2DMSimulator.patient.t2dpatient import T2DPatient
+from T2DMSimulator.utils.glucose_params_subtypes import get_mard_params
+
+
+def main(number=20000):
+    patient = T2DPatient({}, glucose_params=get_mard_params(), name="MARD")
+    x = np.array(patient.X0v, dtype=float)
+    x[47] = 1.0
+    p = compile_parameters(patient.param, patient.basal)
+
+    def attribute_rhs():
+        return GlucoseDynamics(0, x, 0, 0, 65, patient.basal, patient.param).compute()
+
+    def flat_rhs():
+        return compiled_rhs(0, x, p, 0, 0, 65)
+
+    assert np.allclose(attribute_rhs(), flat_rhs())
+    t_attribute = min(timeit.repeat(attribute_rhs, number=number, repeat=3)) / number
+    t_flat = min(timeit.repeat(flat_rhs, number=number, repeat=3)) / number
+    print('GlucoseDynamics RHS: {:8.2f} us/call'.format(t_attribute * 1e6))
+    print('compiled_rhs:        {:8.2f} us/call'.format(t_flat * 1e6))
+    print('speed-up:            {:8.2f}x'.format(t_attribute / t_flat))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+'''
+Accuracy and speed of the surrogate emulator against the ODE model: free
+run errors and coverage of the calibrated error estimate on fresh random
+days, then forecasts of those days from snapshots of the patient stepped by
+T2DPatient and by SurrogatePatient.
+
+    python -m T2DMSimulator.benchmarks.surrogate_benchmark [surrogate.npz]
+'''
+import contextlib
+import io
+import sys
+import time
+import numpy as np
+from T2DMSimulator.patient.t2dpatient import T2DPatient, Action
+from T2DMSimulator.surrogate.dataset import INPUT_FIELDS, NO_RECOMMENDATION, generate_dataset
+from T2DMSimulator.surrogate.emulator import SurrogatePatient
+from T2DMSimulator.surrogate.train import load_or_train
+from T2DMSimulator.utils.glucose_params_subtypes import get_mard_params
+
+HORIZONS = [15, 30, 60, 120, 240]
+
+
+def run(patient, schedule):
+    BG = np.empty(len(schedule))
+    start = time.perf_counter()
+    for i, row in enumerate(schedule):
+        patient.step(Action(physical=0, **dict(zip(INPUT_FIELDS, row))), NO_RECOMMENDATION)
+        BG[i] = patient.observation.Gsub
+    return BG, time.perf_counter() - start
+
+
+def main(path='surrogate.npz', n_days=4, horizon=120, max_error=5.0, seed=100):
+    patient = T2DPatient({}, glucose_params=get_mard_params(), name="MARD")
+    # the patient prints every meal
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = load_or_train(patient, path)
+        test = generate_dataset(patient, n_days, seed=seed)
+
+    errors = model.free_run_errors(test, HORIZONS[-1])
+    print('horizon  RMS error  estimate  within 2 sigma')
+    for h in HORIZONS:
+        e = errors[:, h - 1]
+        print('{:4d} min {:8.2f} {:9.2f} {:12.1%}'.format(
+            h, np.sqrt(np.mean(e ** 2)), model.estimated_error(h), np.mean(np.abs(e) <= 2 * model.estimated_error(h))))
+
+    # forecasts from snapshots taken every horizon minutes along the days
+    tracker = SurrogatePatient(patient, model, max_error=0)
+    t_ode = t_surrogate = 0
+    squared_error = []
+    for day in test:
+        with contextlib.redirect_stdout(io.StringIO()):
+            tracker.reset()
+            for start in range(0, len(day.inputs) - horizon + 1, horizon):
+                snapshot = tracker.snapshot()
+                schedule = day.inputs[start:start + horizon]
+                BG_ode, t = run(patient.fork(snapshot.patient), schedule)
+                t_ode += t
+                surrogate = tracker.fork(snapshot)
+                surrogate.max_error = max_error
+                BG_surrogate, t = run(surrogate, schedule)
+                t_surrogate += t
+                squared_error.append((BG_surrogate - BG_ode) ** 2)
+                run(tracker, schedule)
+    steps = np.size(squared_error)
+    print('{} forecasts of {} min, max_error {} mg/dl: BG RMS error {:.2f} mg/dl'.format(
+        len(squared_error), horizon, max_error, np.sqrt(np.mean(squared_error))))
+    print('T2DPatient:       {:8.1f} us/step'.format(t_ode / steps * 1e6))
+    print('SurrogatePatient: {:8.1f} us/step'.format(t_surrogate / steps * 1e6))
+    print('speed-up:         {:8.2f}x'.format(t_ode / t_surrogate))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
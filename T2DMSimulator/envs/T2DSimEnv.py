@@ -37,6 +37,15 @@ class T2DSimEnv(gym.Env):
             return self.env.step(act)
         return self.env.step(act, reward_fun=self.reward_fun)
 
+    def snapshot(self):
+        '''
+        Snapshot of the current episode, see simulation.env.T2DSimEnv.snapshot
+        '''
+        return self.env.snapshot()
+
+    def restore(self, snapshot):
+        self.env.restore(snapshot)
+
     def _raw_reset(self):
         return self.env.reset()
 
@@ -126,6 +135,15 @@ class T2DSimGymnasiumEnv(Env):
         truncated = False  # Controlled by TimeLimit wrapper when registering the env
         return np.array([obs.CGM], dtype=np.float32), reward, done, truncated, info
 
+    def snapshot(self):
+        '''
+        Snapshot of the current episode, see simulation.env.T2DSimEnv.snapshot
+        '''
+        return self.env.snapshot()
+
+    def restore(self, snapshot):
+        self.env.restore(snapshot)
+
     def reset(self, seed=None, options=None):
         super().reset(seed=seed)
         self.env, _, _, _ = self._create_env()
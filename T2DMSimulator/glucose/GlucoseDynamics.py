@@ -171,7 +171,8 @@ class GlucoseDynamics:
         self.dx[2] = dqint
         self.dx[46] = dDe
         self.dx[47] = dDNq
-        return absorption.fg * absorption.kabs * qint / 70, kempt #Ra
+        # Ra in mg/min: qint (mg) and the glucose compartment volumes are whole-body
+        return absorption.fg * absorption.kabs * qint, kempt #Ra
     
     def __glucose_submodel_rates(self, EGW,EL,EP):
         rates = self.glucose_parameters.glucoseMetabolicRates
@@ -188,7 +189,7 @@ class GlucoseDynamics:
         MGHGU = (5.66 + 5.66 * np.tanh(cGHGU * (GL / GBL - dGHGU))) / (5.66 + 5.66 * np.tanh(cGHGU * (1 - dGHGU)))
         rHGU = self.x[45] * MGHGU * self.basal['rHGU']
         if GK >= 460:
-            rKGE = 330 + 0.872 * GK
+            rKGE = -330 + 0.872 * GK
         else:
             rKGE = 71 + 71 * np.tanh(0.011 * (GK - 460))
         # Effect of Metformin:
@@ -0,0 +1,439 @@
+import math
+import numpy as np
+from T2DMSimulator.glucose.GlucoseParameters import GlucoseParameters
+
+# Flat parameter vector layout. compile_parameters freezes a GlucoseParameters
+# and the patient basal values into one float64 array indexed by the constants
+# below, so the RHS does array indexing instead of walking attributes.
+# glucoseSubmodel
+P_VGBC = 0
+P_VGBF = 1
+P_VGH = 2
+P_VGL = 3
+P_VGG = 4
+P_VGK = 5
+P_VGPC = 6
+P_VGPF = 7
+P_QGB = 8
+P_QGH = 9
+P_QGA = 10
+P_QGL = 11
+P_QGG = 12
+P_QGK = 13
+P_QGP = 14
+P_TGB = 15
+P_TGP = 16
+# InsulinSubmodel
+P_VIB = 17
+P_VIH = 18
+P_VIG = 19
+P_VIL = 20
+P_VIK = 21
+P_VIPF = 22
+P_QIB = 23
+P_QIH = 24
+P_QIA = 25
+P_QIK = 26
+P_QIP = 27
+P_QIG = 28
+P_TIP = 29
+P_mpan0 = 30
+P_QIL = 31
+P_VIPC = 32
+# glucagonSubmodel
+P_VGamma = 33
+# glucoseAbsorptionSubmodel
+P_fg = 34
+P_Kq1 = 35
+P_Kq2 = 36
+P_k12 = 37
+P_kmin = 38
+P_kmax = 39
+P_kabs = 40
+# glucoseMetabolicRates
+P_c1 = 41
+P_c2 = 42
+P_c3 = 43
+P_c4 = 44
+P_c5 = 45
+P_d1 = 46
+P_d2 = 47
+P_d3 = 48
+P_d4 = 49
+P_d5 = 50
+P_SHGU = 51
+P_SHGP = 52
+P_SPGU = 53
+# pancreasModel
+P_zeta1 = 54
+P_zeta2 = 55
+P_ml0 = 56
+P_Kl = 57
+P_Ks = 58
+P_gammapan = 59
+P_alphapan = 60
+P_betapan = 61
+P_N1 = 62
+P_N2 = 63
+P_KILLPAN = 64
+P_Sfactor = 65
+# gLP1Submodel
+P_VPHI = 66
+P_Kout = 67
+P_CF2 = 68
+P_tphi = 69
+P_zeta = 70
+# vildagliptinSubmodel
+P_Fv = 71
+P_ka1 = 72
+P_ka2 = 73
+P_CL = 74
+P_CLic = 75
+P_Vp = 76
+P_Vc = 77
+P_kvd = 78
+P_k2v = 79
+P_koff = 80
+P_RmaxP = 81
+P_kdeg = 82
+P_RmaxC = 83
+# metforminSubmodel
+P_kgo = 84
+P_kgg = 85
+P_kpg = 86
+P_kgl = 87
+P_kpl = 88
+P_klp = 89
+P_kpo = 90
+P_vGWmax = 91
+P_vLmax = 92
+P_vPmax = 93
+P_nGW = 94
+P_nL = 95
+P_nP = 96
+P_phiGW50 = 97
+P_phiL50 = 98
+P_phiP50 = 99
+P_rhoalpha = 100
+P_rhobeta = 101
+P_alpham = 102
+P_betam = 103
+# longActingInsulinSubmodel
+P_pla = 104
+P_rla = 105
+P_qla = 106
+P_bla = 107
+P_Cmax = 108
+P_kla = 109
+P_kcll = 110
+# fastActingInsulinSubmodel
+P_pfa = 111
+P_rfa = 112
+P_qfa = 113
+P_bfa = 114
+P_kclf = 115
+# physicalActivityParameters
+P_tHR = 116
+P_ne = 117
+P_ae = 118
+P_te = 119
+P_alphae = 120
+P_betae = 121
+P_HRb = 122
+P_ce1 = 123
+P_ce2 = 124
+# sMBGSigmaSubmodel
+P_sigsmbg = 125
+# basal values and rates, see T2DPatient.basal
+B_GPF = 126
+B_IPF = 127
+B_IL = 128
+B_GL = 129
+B_Gamma = 130
+B_SB = 131
+B_GH = 132
+B_IH = 133
+B_rPIR = 134
+B_rBGU = 135
+B_rRBCU = 136
+B_rGGU = 137
+B_rPGU = 138
+B_rHGP = 139
+B_rHGU = 140
+# derived constants, recomputed from the entries above by update_derived
+D_MIPGU0 = 141
+D_MIHGP0 = 142
+D_MGHGP0 = 143
+D_MIHGU0 = 144
+D_MGHGU0 = 145
+D_kPIC = 146
+D_kdmdpan = 147
+D_phiGW50n = 148
+D_phiL50n = 149
+D_phiP50n = 150
+N_PARAMETERS = 151
+
+BASAL_KEYS = ['GPF', 'IPF', 'IL', 'GL', 'Gamma', 'SB', 'GH', 'IH', 'rPIR', 'rBGU', 'rRBCU', 'rGGU', 'rPGU', 'rHGP', 'rHGU']
+N_GLUCOSE_PARAMETERS = B_GPF
+
+
+def parameter_layout(glucose_parameters=None):
+    '''
+    Return the (submodel, name) pairs of the GlucoseParameters entries in
+    compiled order, e.g. ('pancreasModel', 'Ks') sits at index P_Ks.
+    '''
+    glucose_parameters = GlucoseParameters() if glucose_parameters is None else glucose_parameters
+    return [(submodel_name, name) for submodel_name, submodel in vars(glucose_parameters).items() for name in vars(submodel)]
+
+
+PARAMETER_LAYOUT = parameter_layout()
+PARAMETER_NAMES = ['{}.{}'.format(submodel, name) for submodel, name in PARAMETER_LAYOUT] + ['basal.{}'.format(key) for key in BASAL_KEYS]
+
+
+def parameter_index(name):
+    '''
+    Index of a parameter given as 'submodel.name' (e.g. 'pancreasModel.Ks'),
+    'basal.key' or just the attribute name when it is unambiguous.
+    '''
+    if name in PARAMETER_NAMES:
+        return PARAMETER_NAMES.index(name)
+    matches = [i for i, full_name in enumerate(PARAMETER_NAMES) if full_name.split('.')[1] == name]
+    if len(matches) != 1:
+        raise KeyError('Unknown or ambiguous parameter name: {}'.format(name))
+    return matches[0]
+
+
+def update_derived(p):
+    '''
+    Recompute the derived entries of a compiled vector (or (N, N_PARAMETERS)
+    matrix) in place after its base entries were changed.
+    '''
+    q = p.T
+    q[D_MIPGU0] = 7.03 + q[P_SPGU] * 6.52 * np.tanh(q[P_c1] * (1 - q[P_d1]))
+    q[D_MIHGP0] = 1.21 - q[P_SHGP] * 1.14 * np.tanh(q[P_c2] * (1 - q[P_d2]))
+    q[D_MGHGP0] = 1.42 - 1.41 * np.tanh(q[P_c3] * (1 - q[P_d3]))
+    q[D_MIHGU0] = np.tanh(q[P_c4] * (1 - q[P_d4]))
+    q[D_MGHGU0] = 5.66 + 5.66 * np.tanh(q[P_c5] * (1 - q[P_d5]))
+    q[D_kPIC] = 1 / ((0.85) / (0.15 * q[P_QIP]) - 20 / q[P_VIPF])
+    q[D_kdmdpan] = q[P_ml0] * q[P_Kl]
+    q[D_phiGW50n] = q[P_phiGW50] ** q[P_nGW]
+    q[D_phiL50n] = q[P_phiL50] ** q[P_nL]
+    q[D_phiP50n] = q[P_phiP50] ** q[P_nP]
+    return p
+
+
+def compile_parameters(glucose_parameters: GlucoseParameters, basal):
+    '''
+    Freeze a GlucoseParameters and a basal dict (see T2DPatient.basal) into a
+    contiguous float64 vector of length N_PARAMETERS.
+    '''
+    p = np.empty(N_PARAMETERS)
+    for i, (submodel_name, name) in enumerate(PARAMETER_LAYOUT):
+        p[i] = getattr(getattr(glucose_parameters, submodel_name), name)
+    for i, key in enumerate(BASAL_KEYS):
+        p[N_GLUCOSE_PARAMETERS + i] = basal[key]
+    return update_derived(p)
+
+
+def compile_parameter_matrix(glucose_parameters_list, basal_list):
+    '''
+    Compile one parameter vector per patient into an (N, N_PARAMETERS) matrix.
+    '''
+    return np.stack([compile_parameters(params, basal) for params, basal in zip(glucose_parameters_list, basal_list)])
+
+
+def decompile_parameters(p):
+    '''
+    Inverse of compile_parameters, returns a GlucoseParameters and a basal dict.
+    '''
+    glucose_parameters = GlucoseParameters()
+    for i, (submodel_name, name) in enumerate(PARAMETER_LAYOUT):
+        setattr(getattr(glucose_parameters, submodel_name), name, float(p[i]))
+    basal = {key: float(p[N_GLUCOSE_PARAMETERS + i]) for i, key in enumerate(BASAL_KEYS)}
+    return glucose_parameters, basal
+
+
+def compiled_rhs(t, x, p, Dg, stress, HR, quiescent_tol=0):
+    '''
+    Right hand side of the T2D model on a compiled parameter vector. Same
+    equations as GlucoseDynamics.compute; x is a (57,) state with p a
+    (N_PARAMETERS,) vector, or an (N, 57) state with an (N, N_PARAMETERS)
+    matrix and Dg, stress, HR scalars or (N,) arrays.
+
+    With quiescent_tol > 0 the vildagliptin submodel (states 9-14) and the
+    insulin depots (17-21, 54-55) are frozen, their derivatives left at 0,
+    while all their states are below quiescent_tol in absolute value. Frozen
+    states stay below the tolerance, their coupling terms into the rest of
+    the model still use the actual values, and a dose lifts them above it so
+    the submodel runs again. This is a small single patient optimization
+    (about 5-13% of a simulation): a batch skips a submodel only while it is
+    idle in every patient, and gathering the idle patients out of a batch
+    costs more than the few operations it saves.
+    '''
+    if np.ndim(x) == 1 and np.isrealobj(x) and np.isrealobj(p):
+        # single patient: plain floats are several times cheaper than numpy
+        # scalars for this many small expressions
+        d = [0.0] * len(x)
+        _evaluate(x.tolist(), p.tolist(), d, Dg, stress, HR, math.tanh, _where, max, quiescent_tol, _quiescent)
+        return np.array(d)
+    dx = np.zeros(np.shape(x), dtype=np.result_type(x, p))
+    _evaluate(x.T, p.T, dx.T, Dg, stress, HR, np.tanh, np.where, np.maximum, quiescent_tol, _quiescent_batch)
+    return dx
+
+
+def _where(condition, a, b):
+    return a if condition else b
+
+
+def _quiescent(states, tol):
+    for v in states:
+        if not -tol < v < tol:
+            return False
+    return True
+
+
+def _quiescent_batch(states, tol):
+    return all(np.all(np.abs(v) < tol) for v in states)
+
+
+def _evaluate(xs, q, d, Dg, stress, HR, tanh, where, maximum, quiescent_tol=0, quiescent=_quiescent):
+    '''
+    Write the derivatives of state xs into d, indexing both along their first
+    axis so the same code runs on lists of floats and on transposed arrays.
+    '''
+    # glucose absorption
+    qss, qsl, qint, DNq = xs[0], xs[1], xs[2], xs[47]
+    QA1 = 5 / (2 * DNq * (1 - q[P_Kq1]))
+    QA2 = 5 / (2 * DNq * q[P_Kq2])
+    kempt = q[P_kmin] + ((q[P_kmax] - q[P_kmin]) / 2) * (tanh(QA1 * (qss + qsl - q[P_Kq1] * DNq)) - tanh(QA2 * (qss + qsl - q[P_Kq2] * DNq)) + 2)
+    d[0] = -q[P_k12] * qss
+    d[1] = -kempt * qsl + q[P_k12] * qss
+    d[2] = -q[P_kabs] * qint + kempt * qsl
+    d[46] = -q[P_kmin] * xs[46]
+    d[47] = q[P_kmin] * (Dg - DNq)
+    # qint is the whole-body gut glucose (mg) and the glucose compartments
+    # are whole-body volumes (dl), so Ra is in mg/min, not per kg
+    Ra = q[P_fg] * q[P_kabs] * qint
+
+    # metformin
+    MO1, MO2, MGl, MGW, ML, MP = xs[3], xs[4], xs[5], xs[6], xs[7], xs[8]
+    d[3] = -q[P_alpham] * MO1
+    d[4] = -q[P_betam] * MO2
+    d[5] = -(q[P_kgo] + q[P_kgg]) * MGl + q[P_rhoalpha] * MO1 + q[P_rhobeta] * MO2
+    d[6] = MGl * q[P_kgg] + MP * q[P_kpg] - MGW * q[P_kgl]
+    d[7] = MGW * q[P_kgl] + MP * q[P_kpl] - ML * q[P_klp]
+    d[8] = ML * q[P_klp] - (q[P_kpl] + q[P_kpg] + q[P_kpo]) * MP + MGl
+    MGWn, MLn, MPn = MGW ** q[P_nGW], ML ** q[P_nL], MP ** q[P_nP]
+    EGW = q[P_vGWmax] * MGWn / (q[D_phiGW50n] + MGWn)
+    EL = q[P_vLmax] * MLn / (q[D_phiL50n] + MLn)
+    EP = q[P_vPmax] * MPn / (q[D_phiP50n] + MPn)
+
+    # vildagliptin
+    AG1, AG2, Ac, Ap, DRc, DRp = xs[9], xs[10], xs[11], xs[12], xs[13], xs[14]
+    if not (quiescent_tol > 0 and quiescent((AG1, AG2, Ac, Ap, DRc, DRp), quiescent_tol)):
+        Cc, Cp = Ac / q[P_Vc], Ap / q[P_Vp]
+        bindc = (q[P_RmaxC] - DRc) * q[P_k2v] * Cc / (q[P_kvd] + Cc)
+        bindp = (q[P_RmaxP] - DRp) * q[P_k2v] * Cp / (q[P_kvd] + Cp)
+        d[9] = -q[P_ka1] * AG1
+        d[10] = q[P_ka1] * AG1 - q[P_ka2] * AG2
+        d[11] = q[P_ka2] * AG2 - ((q[P_CL] + q[P_CLic]) / q[P_Vc]) * Ac + (q[P_CLic] / q[P_Vp]) * Ap - bindc + q[P_koff] * DRc
+        d[12] = q[P_CLic] * (Cc - Cp) - bindp + q[P_koff] * DRp
+        d[13] = bindc - (q[P_koff] - q[P_kdeg]) * DRc
+        d[14] = bindp - (q[P_koff] + q[P_kdeg]) * DRp
+
+    # physical activity
+    E1, E2, TE = xs[15], xs[16], xs[48]
+    d[15] = (1 / q[P_tHR]) * (HR - q[P_HRb] - E1)
+    gEn = (E1 / (q[P_ae] * q[P_HRb])) ** q[P_ne]
+    gE = gEn / (1 + gEn)
+    d[48] = (1 / q[P_te]) * (q[P_ce1] * gE + q[P_ce2] - TE)
+    d[16] = -(gE + 1 / q[P_te]) * E2 + gE
+
+    # glucose metabolic rates
+    GBC, GBF, GH, GG, GL, GK, GPC, GPF = xs[32], xs[33], xs[34], xs[35], xs[36], xs[37], xs[38], xs[39]
+    IL, IPF = xs[28], xs[31]
+    MIPGU = (7.03 + q[P_SPGU] * 6.52 * tanh(q[P_c1] * (IPF / q[B_IPF] - q[P_d1]))) / q[D_MIPGU0]
+    rPGU = MIPGU * (GPF / q[B_GPF]) * q[B_rPGU]
+    MIHGPinft = (1.21 - q[P_SHGP] * 1.14 * tanh(q[P_c2] * (IL / q[B_IL] - q[P_d2]))) / q[D_MIHGP0]
+    MGHGP = (1.42 - 1.41 * tanh(q[P_c3] * (GL / q[B_GL] - q[P_d3]))) / q[D_MGHGP0]
+    Gammaf = 2.7 * tanh(0.39 * xs[40] / q[B_Gamma])
+    rHGP = xs[43] * MGHGP * (Gammaf - xs[44]) * q[B_rHGP]
+    MIHGUinft = tanh(q[P_c4] * (IL / q[B_IL] - q[P_d4])) / q[D_MIHGU0]
+    MGHGU = (5.66 + 5.66 * tanh(q[P_c5] * (GL / q[B_GL] - q[P_d5]))) / q[D_MGHGU0]
+    rHGU = xs[45] * MGHGU * q[B_rHGU]
+    rKGE = where(GK >= 460, -330 + 0.872 * GK, 71 + 71 * tanh(0.011 * (GK - 460)))
+    # Effect of Metformin:
+    rHGP = rHGP * (1 - EL)
+    rGGU = q[B_rGGU] * (1 + EGW)
+    rPGU = rPGU * (1 + EP)
+
+    # rates dynamic model
+    d[43] = 0.04 * (MIHGPinft - xs[43])
+    d[44] = 0.0154 * (0.5 * (Gammaf - 1) - xs[44])
+    d[45] = 0.04 * (MIHGUinft - xs[45])
+
+    # glucose
+    rBGU, rRBCU = q[B_rBGU], q[B_rRBCU]
+    exercise_uptake = 1 + q[P_alphae] * E2
+    hgp = (1 + stress) * (1 - q[P_alphae] * E2) * rHGP
+    d[32] = (1 / q[P_VGBC]) * (q[P_QGB] * (GH - GBC) - (q[P_VGBF] / q[P_TGB]) * (GBC - GBF))
+    d[33] = (1 / q[P_VGBF]) * ((q[P_VGBF] / q[P_TGB]) * (GBC - GBF) - rBGU)
+    d[34] = (1 / q[P_VGH]) * (q[P_QGB] * GBC + q[P_QGL] * GL + q[P_QGK] * GK + q[P_QGP] * GPC - q[P_QGH] * GH - rRBCU)
+    d[35] = (1 / q[P_VGG]) * (q[P_QGG] * (GH - GG) - rGGU + Ra)
+    d[36] = (1 / q[P_VGL]) * (q[P_QGA] * GH + q[P_QGG] * GG - q[P_QGL] * GL + hgp - exercise_uptake * rHGU)
+    d[37] = (1 / q[P_VGK]) * (q[P_QGK] * (GH - GK) - rKGE)
+    d[38] = (1 / q[P_VGPC]) * (q[P_QGP] * (GH - GPC) - (q[P_VGPF] / q[P_TGP]) * (GPC - GPF))
+    d[39] = (1 / q[P_VGPF]) * ((q[P_VGPF] / q[P_TGP]) * (GPC - (1 + q[P_betae] * E1) * GPF) - exercise_uptake * rPGU)
+    d[49] = rBGU + rRBCU + rGGU + exercise_uptake * rHGU + rKGE + q[P_betae] * E1 * GPF * q[P_QGP] + exercise_uptake * rPGU
+    d[50] = Ra + hgp
+    d[56] = GH
+
+    # glucagon
+    MGPGammaR = 1.31 - 0.61 * tanh(1.06 * ((GH / q[B_GH]) - 0.47))
+    MIPGammaR = 2.93 - 2.09 * tanh(4.18 * ((xs[26] / q[B_IH]) - 0.62))
+    d[40] = (1 / q[P_VGamma]) * ((1 + stress) * MGPGammaR * MIPGammaR * 9.1 - 9.1 * xs[40])
+
+    # GLP-1
+    d[41] = q[P_zeta] * kempt * qsl - xs[41] / q[P_tphi]
+    d[42] = (1 / q[P_VPHI]) * (xs[41] / q[P_tphi] - (q[P_Kout] + (q[P_RmaxC] - DRc) * q[P_CF2]) * xs[42])
+
+    # pancreas
+    PHI, mpan, P, R = xs[42], xs[22], xs[23], xs[24]
+    XG = GH ** (3.27) / (1.32 ** 3.27 + 5.93 * GH ** 3.02)
+    Pinft = XG ** (1.11) + q[P_zeta1] * PHI
+    S = q[P_Sfactor] * mpan * (q[P_N1] * Pinft + q[P_N2] * maximum(XG - R, 0) + q[P_zeta2] * PHI)
+    d[22] = q[D_kdmdpan] - q[P_Ks] * mpan + q[P_gammapan] * P - S
+    d[23] = q[P_alphapan] * (Pinft - P)
+    d[24] = q[P_betapan] * (XG - R)
+
+    # insulin depots
+    Hfa, Dfa, Ifa = xs[17], xs[18], xs[55]
+    Bla, Hla, Dla, Ila = xs[19], xs[20], xs[21], xs[54]
+    if not (quiescent_tol > 0 and quiescent((Hfa, Dfa, Ifa, Bla, Hla, Dla, Ila), quiescent_tol)):
+        fa_absorption = q[P_pfa] * (Hfa - q[P_qfa] * Dfa ** 3)
+        d[17] = -fa_absorption
+        d[18] = fa_absorption - q[P_bfa] * Dfa / (1 + Ifa)
+        d[55] = q[P_rfa] * q[P_bfa] * Dfa / (1 + Ifa) - q[P_kclf] * Ifa
+        la_dissociation = q[P_kla] * Bla * (q[P_Cmax] / (1 + Hla))
+        la_absorption = q[P_pla] * (Hla - q[P_qla] * Dla ** 3)
+        d[19] = -la_dissociation
+        d[20] = -la_absorption + la_dissociation
+        d[21] = la_absorption - q[P_bla] * Dla / (1 + Ila)
+        d[54] = q[P_rla] * q[P_bla] * Dla / (1 + Ila) - q[P_kcll] * Ila
+
+    # insulin
+    IB, IH, IG, IK, IPC = xs[25], xs[26], xs[27], xs[29], xs[30]
+    rPIR = (S / q[B_SB]) * q[B_rPIR]
+    rLIC = 0.4 * (q[P_QIA] * IH + q[P_QIG] * IG + rPIR)
+    rKIC = 0.3 * q[P_QIK] * IK
+    rPIC = IPF * q[D_kPIC]
+    d[25] = (q[P_QIB] / q[P_VIB]) * (IH - IB)
+    d[26] = (1 / q[P_VIH]) * (q[P_QIB] * IB + q[P_QIL] * IL + q[P_QIK] * IK + q[P_QIP] * IPF - q[P_QIH] * IH)
+    d[27] = (q[P_QIG] / q[P_VIG]) * (IH - IG)
+    d[28] = (1 / q[P_VIL]) * (q[P_QIA] * IH + q[P_QIG] * IG - q[P_QIL] * IL + (1 - stress) * rPIR - rLIC)
+    d[29] = (1 / q[P_VIK]) * (q[P_QIK] * (IH - IK) - rKIC)
+    d[30] = (1 / q[P_VIPC]) * (q[P_QIP] * (IH - IPC) - (q[P_VIPF] / q[P_TIP]) * (IPC - IPF)) + 10 * Ifa + 10 * Ila
+    d[31] = (1 / q[P_VIPF]) * ((q[P_VIPF] / q[P_TIP]) * (IPC - IPF) - rPIC)
+    d[51] = rLIC + rKIC + rPIC
+    d[52] = (1 - stress) * rPIR
+    d[53] = q[P_VIPF] * q[P_rla] * q[P_bla] * Dla / (1 + IPF) + q[P_VIPF] * q[P_rfa] * q[P_bfa] * Dfa / (1 + IPF)
@@ -1,6 +1,16 @@
 from T2DMSimulator.glucose.GlucoseParameters import GlucoseParameters
+from T2DMSimulator.glucose.compiled import compile_parameters, update_derived, PARAMETER_LAYOUT, BASAL_KEYS, N_GLUCOSE_PARAMETERS
+from T2DMSimulator.glucose.steady_state import find_steady_state
 # from T2DMSimulator.patient.t2dpatient import T2DPatient
 import numpy as np
+import hashlib
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+from types import SimpleNamespace
+
+logger = logging.getLogger(__name__)
 # Glucose Dynamics Parameters:
 # | Parameter                       | Index Range |
 # |---------------------------------|-------------|
@@ -31,6 +41,134 @@ import numpy as np
 # | Secreted insulin                | 52          |
 # | Injected insulin                | 53          |
 
+# part of every steady_state_key: bump it whenever GlucoseInitializer, the
+# compiled model or find_steady_state change the values they return, so
+# results cached on disk by an older version are not reused
+STEADY_STATE_VERSION = 2
+
+
+def steady_state_key(glucose_parameters: GlucoseParameters, GBPC0, IBPF0, brates):
+    '''
+    Content hash of everything GlucoseInitializer reads: every
+    GlucoseParameters entry, GBPC0, IBPF0 and the basal rates, salted
+    with STEADY_STATE_VERSION.
+    '''
+    entries = [(submodel_name, name, value)
+               for submodel_name, submodel in vars(glucose_parameters).items()
+               for name, value in vars(submodel).items()]
+    content = repr((STEADY_STATE_VERSION, entries, GBPC0, IBPF0, sorted(brates.items())))
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def basal_values(x, rates, SB, IBPF0):
+    '''
+    Basal dict of the model (see T2DPatient.basal) from the initial state,
+    rates and SB returned by GlucoseInitializer.calculate_values
+    '''
+    return {
+        'GPF': x[39],
+        'IPF': IBPF0,
+        'IL': x[28],
+        'GL': x[36],
+        'Gamma': x[40],
+        'SB': SB,
+        'GH': x[34],
+        'IH': x[26],
+        'rPIR': rates[0],
+        'rBGU': rates[1],
+        'rRBCU': rates[2],
+        'rGGU': rates[3],
+        'rPGU': rates[4],
+        'rHGP': rates[5],
+        'rHGU': rates[6]
+    }
+
+
+class SteadyStateCache(object):
+    '''
+    LRU of GlucoseInitializer results (x, rates, S) keyed by
+    steady_state_key. With a directory, results are also stored there as
+    <key>.npz files, so they survive the process and are shared between
+    processes using the same directory.
+    Inputs:
+        - maxsize: number of results kept in memory
+        - directory: optional on-disk cache directory, created if missing
+    '''
+    def __init__(self, maxsize=256, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        '''
+        Return a copy of the cached (x, rates, S) of key, None on a miss
+        '''
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        elif self.directory is not None:
+            value = self._load(key)
+            if value is not None:
+                self._remember(key, value)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        x, rates, S = value
+        return x.copy(), list(rates), S
+
+    def put(self, key, value):
+        x, rates, S = value
+        value = (np.array(x, dtype=float), [float(rate) for rate in rates], float(S))
+        self._remember(key, value)
+        if self.directory is not None:
+            self._store(key, value)
+
+    def clear(self):
+        '''
+        Empty the in-memory cache, files in the directory are kept
+        '''
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def _load(self, key):
+        try:
+            with np.load(self._path(key)) as data:
+                return data['x'], data['rates'].tolist(), float(data['S'])
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def _store(self, key, value):
+        x, rates, S = value
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # write then rename, so concurrent readers never see a partial file
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, x=x, rates=np.array(rates), S=S)
+            os.replace(tmp, self._path(key))
+        except OSError as e:
+            logger.warning('Could not write steady state cache entry {}: {}'.format(key, e))
+
+
+# shared by every GlucoseInitializer, set STEADY_STATE_CACHE.directory to
+# persist results on disk
+STEADY_STATE_CACHE = SteadyStateCache()
+
+
 class GlucoseInitializer():
     def __init__(self, glucose_parameters: GlucoseParameters, patient):
         self.glucose_parameters = glucose_parameters
@@ -38,7 +176,46 @@ class GlucoseInitializer():
         self.patient = patient
         self.x = np.zeros(57)
 
-    def calculate_values(self):
+    def calculate_values(self, cache=STEADY_STATE_CACHE):
+        '''
+        Return the initial state, basal rates and SB of the patient, looked
+        up in cache first (pass cache=None to always compute them)
+        '''
+        if cache is None:
+            return self.__compute_values()
+        key = steady_state_key(self.glucose_parameters, self.patient.GBPC0, self.patient.IBPF0, self.brates)
+        value = cache.get(key)
+        if value is None:
+            # the cache keeps its own copy
+            value = self.__compute_values()
+            cache.put(key, value)
+        return value
+
+    def steady_state(self, HR=None, cache=STEADY_STATE_CACHE, tol=1e-9, settle=24 * 60):
+        '''
+        Like calculate_values, but the returned state is the true fasting
+        fixed point of the full 57 state model (see find_steady_state) at
+        heart rate HR instead of the analytic glucose, insulin and pancreas
+        values with hand-set remaining states. The rates and SB, which
+        define the model's basal values, are unchanged. tol and settle are
+        passed to find_steady_state and are part of the cache key.
+        '''
+        x, rates, S = self.calculate_values(cache)
+        key = None
+        if cache is not None:
+            key = '{}-steady-{!r}-{!r}-{!r}'.format(
+                steady_state_key(self.glucose_parameters, self.patient.GBPC0, self.patient.IBPF0, self.brates),
+                HR, tol, settle)
+            value = cache.get(key)
+            if value is not None:
+                return value
+        p = compile_parameters(self.glucose_parameters, basal_values(x, rates, S, self.patient.IBPF0))
+        value = find_steady_state(x, p, HR=HR, tol=tol, settle=settle), rates, S
+        if cache is not None:
+            cache.put(key, value)
+        return value
+
+    def __compute_values(self):
         rHGP = self.__calculate_basal_values()
         rPIR = self.__calculate_insulin_values()
         S = self.__calculate_pancreas_values()
@@ -106,8 +283,10 @@ class GlucoseInitializer():
         
     def __calculate_pancreas_values(self):
         pancreas = self.glucose_parameters.pancreasModel
-        XG = self.x[34] ** 3.27 / (1.32 ** 3.27 + 5.93 * self.x[34] ** 3.02)
-        Pinft = XG ** 1.11
+        # np.power for one patient and for initialize_parameter_matrix alike,
+        # the scalar ** of NumPy rounds differently from its array loops
+        XG = np.power(self.x[34], 3.27) / (1.32 ** 3.27 + 5.93 * np.power(self.x[34], 3.02))
+        Pinft = np.power(XG, 1.11)
         Y = Pinft
         kdmdpan = pancreas.ml0 * pancreas.Kl
         mpan = (kdmdpan + pancreas.gammapan * Pinft) / (pancreas.Ks + pancreas.N1 * Y)
@@ -117,4 +296,27 @@ class GlucoseInitializer():
         self.x[24] = XG
         # Glucagon:
         self.x[40] = 1
-        return S
\ No newline at end of file
+        return S
+
+
+def initialize_parameter_matrix(P, GBPC0, IBPF0, brates):
+    '''
+    GlucoseInitializer.calculate_values for a whole (N, N_PARAMETERS)
+    compiled parameter matrix at once: the GlucoseParameters entries of P
+    must be set, its basal and derived entries are filled in place.
+    GBPC0, IBPF0 and the brates values are scalars or (N,) arrays.
+    Returns the (N, 57) initial states.
+    '''
+    glucose_parameters = GlucoseParameters()
+    for i, (submodel_name, name) in enumerate(PARAMETER_LAYOUT):
+        setattr(getattr(glucose_parameters, submodel_name), name, P[:, i])
+    patient = SimpleNamespace(GBPC0=GBPC0, IBPF0=IBPF0, brates=brates)
+    initializer = GlucoseInitializer(glucose_parameters, patient)
+    # the initializer's arithmetic runs elementwise on one column per patient
+    initializer.x = np.zeros((57, len(P)))
+    x, rates, S = initializer.calculate_values(cache=None)
+    basal = basal_values(x, rates, S, IBPF0)
+    for i, key in enumerate(BASAL_KEYS):
+        P[:, N_GLUCOSE_PARAMETERS + i] = basal[key]
+    update_derived(P)
+    return x.T.copy()
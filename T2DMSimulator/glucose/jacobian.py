@@ -0,0 +1,354 @@
+import numpy as np
+from scipy import sparse
+from T2DMSimulator.glucose.compiled import *
+
+N_STATES = 57
+
+
+def compiled_jacobian(t, x, p, Dg, stress, HR, out=None):
+    '''
+    Analytic Jacobian d(compiled_rhs)/dx of a single patient, a dense
+    (57, 57) array. Only the entries in JACOBIAN_SPARSITY are written, so a
+    preallocated out can be reused between calls.
+    For an (N, 57) state with an (N, N_PARAMETERS) matrix it returns the
+    (N, 57, 57) stack of the patients' Jacobians.
+    '''
+    if np.ndim(x) == 2:
+        J = np.zeros((len(x), N_STATES, N_STATES)) if out is None else out
+        # the patient axis goes last, as in compiled_rhs
+        _fill_jacobian(J.transpose(1, 2, 0), x.T, p.T, np.asarray(stress))
+        return J
+    J = np.zeros((N_STATES, N_STATES)) if out is None else out
+    _fill_jacobian(J, x, p, stress)
+    return J
+
+
+def sparse_jacobian(t, x, p, Dg, stress, HR):
+    '''
+    compiled_jacobian as a scipy.sparse csc matrix with the JACOBIAN_SPARSITY pattern.
+    '''
+    return sparse.csc_matrix(compiled_jacobian(t, x, p, Dg, stress, HR))
+
+
+def _sech2(u):
+    return 1 - np.tanh(u) ** 2
+
+
+def _hill_derivative(vmax, M, n, phin):
+    # d/dM of vmax * M^n / (phi^n + M^n)
+    return vmax * n * M ** (n - 1) * phin / (phin + M ** n) ** 2
+
+
+def _fill_jacobian(J, x, q, stress):
+    # glucose absorption
+    qss, qsl, qint, DNq = x[0], x[1], x[2], x[47]
+    a1 = 5 / (2 * (1 - q[P_Kq1]))
+    a2 = 5 / (2 * q[P_Kq2])
+    s = qss + qsl
+    u1 = a1 * (s - q[P_Kq1] * DNq) / DNq
+    u2 = a2 * (s - q[P_Kq2] * DNq) / DNq
+    h = (q[P_kmax] - q[P_kmin]) / 2
+    kempt = q[P_kmin] + h * (np.tanh(u1) - np.tanh(u2) + 2)
+    ks = h * (_sech2(u1) * a1 - _sech2(u2) * a2) / DNq  # dkempt/d(qss + qsl)
+    kD = -ks * s / DNq  # dkempt/dDNq
+    J[0, 0] = -q[P_k12]
+    J[1, 0] = -ks * qsl + q[P_k12]
+    J[1, 1] = -kempt - ks * qsl
+    J[1, 47] = -kD * qsl
+    J[2, 0] = ks * qsl
+    J[2, 1] = kempt + ks * qsl
+    J[2, 2] = -q[P_kabs]
+    J[2, 47] = kD * qsl
+    J[46, 46] = -q[P_kmin]
+    J[47, 47] = -q[P_kmin]
+    dRa = q[P_fg] * q[P_kabs]
+
+    # metformin
+    MGW, ML, MP = x[6], x[7], x[8]
+    J[3, 3] = -q[P_alpham]
+    J[4, 4] = -q[P_betam]
+    J[5, 3] = q[P_rhoalpha]
+    J[5, 4] = q[P_rhobeta]
+    J[5, 5] = -(q[P_kgo] + q[P_kgg])
+    J[6, 5] = q[P_kgg]
+    J[6, 6] = -q[P_kgl]
+    J[6, 8] = q[P_kpg]
+    J[7, 6] = q[P_kgl]
+    J[7, 7] = -q[P_klp]
+    J[7, 8] = q[P_kpl]
+    J[8, 5] = 1
+    J[8, 7] = q[P_klp]
+    J[8, 8] = -(q[P_kpl] + q[P_kpg] + q[P_kpo])
+    MLn, MPn = ML ** q[P_nL], MP ** q[P_nP]
+    EL = q[P_vLmax] * MLn / (q[D_phiL50n] + MLn)
+    EP = q[P_vPmax] * MPn / (q[D_phiP50n] + MPn)
+    dEGW = _hill_derivative(q[P_vGWmax], MGW, q[P_nGW], q[D_phiGW50n])
+    dEL = _hill_derivative(q[P_vLmax], ML, q[P_nL], q[D_phiL50n])
+    dEP = _hill_derivative(q[P_vPmax], MP, q[P_nP], q[D_phiP50n])
+
+    # vildagliptin
+    Ac, Ap, DRc, DRp = x[11], x[12], x[13], x[14]
+    Cc, Cp = Ac / q[P_Vc], Ap / q[P_Vp]
+    bcA = (q[P_RmaxC] - DRc) * q[P_k2v] * q[P_kvd] / (q[P_kvd] + Cc) ** 2 / q[P_Vc]
+    bcD = -q[P_k2v] * Cc / (q[P_kvd] + Cc)
+    bpA = (q[P_RmaxP] - DRp) * q[P_k2v] * q[P_kvd] / (q[P_kvd] + Cp) ** 2 / q[P_Vp]
+    bpD = -q[P_k2v] * Cp / (q[P_kvd] + Cp)
+    J[9, 9] = -q[P_ka1]
+    J[10, 9] = q[P_ka1]
+    J[10, 10] = -q[P_ka2]
+    J[11, 10] = q[P_ka2]
+    J[11, 11] = -(q[P_CL] + q[P_CLic]) / q[P_Vc] - bcA
+    J[11, 12] = q[P_CLic] / q[P_Vp]
+    J[11, 13] = -bcD + q[P_koff]
+    J[12, 11] = q[P_CLic] / q[P_Vc]
+    J[12, 12] = -q[P_CLic] / q[P_Vp] - bpA
+    J[12, 14] = -bpD + q[P_koff]
+    J[13, 11] = bcA
+    J[13, 13] = bcD - (q[P_koff] - q[P_kdeg])
+    J[14, 12] = bpA
+    J[14, 14] = bpD - (q[P_koff] + q[P_kdeg])
+
+    # physical activity
+    E1, E2 = x[15], x[16]
+    scale = q[P_ae] * q[P_HRb]
+    z = E1 / scale
+    gEn = z ** q[P_ne]
+    gE = gEn / (1 + gEn)
+    dgE = q[P_ne] * z ** (q[P_ne] - 1) / scale / (1 + gEn) ** 2
+    J[15, 15] = -1 / q[P_tHR]
+    J[16, 15] = dgE * (1 - E2)
+    J[16, 16] = -(gE + 1 / q[P_te])
+    J[48, 15] = q[P_ce1] * dgE / q[P_te]
+    J[48, 48] = -1 / q[P_te]
+
+    # glucose metabolic rates
+    GH, GL, GK, GPF = x[34], x[36], x[37], x[39]
+    IL, IPF = x[28], x[31]
+    uPGU = q[P_c1] * (IPF / q[B_IPF] - q[P_d1])
+    MIPGU = (7.03 + q[P_SPGU] * 6.52 * np.tanh(uPGU)) / q[D_MIPGU0]
+    dMIPGU = q[P_SPGU] * 6.52 * _sech2(uPGU) * q[P_c1] / q[B_IPF] / q[D_MIPGU0]
+    rPGU0 = MIPGU * (GPF / q[B_GPF]) * q[B_rPGU]
+    rPGU = rPGU0 * (1 + EP)
+    drPGU_31 = dMIPGU * (GPF / q[B_GPF]) * q[B_rPGU] * (1 + EP)
+    drPGU_39 = MIPGU / q[B_GPF] * q[B_rPGU] * (1 + EP)
+    drPGU_8 = rPGU0 * dEP
+
+    uIHGP = q[P_c2] * (IL / q[B_IL] - q[P_d2])
+    dMIHGP = -q[P_SHGP] * 1.14 * _sech2(uIHGP) * q[P_c2] / q[B_IL] / q[D_MIHGP0]
+    uGHGP = q[P_c3] * (GL / q[B_GL] - q[P_d3])
+    MGHGP = (1.42 - 1.41 * np.tanh(uGHGP)) / q[D_MGHGP0]
+    dMGHGP = -1.41 * _sech2(uGHGP) * q[P_c3] / q[B_GL] / q[D_MGHGP0]
+    uGamma = 0.39 * x[40] / q[B_Gamma]
+    Gammaf = 2.7 * np.tanh(uGamma)
+    dGammaf = 2.7 * _sech2(uGamma) * 0.39 / q[B_Gamma]
+    rHGP0 = x[43] * MGHGP * (Gammaf - x[44]) * q[B_rHGP]
+    rHGP = rHGP0 * (1 - EL)
+    drHGP_43 = MGHGP * (Gammaf - x[44]) * q[B_rHGP] * (1 - EL)
+    drHGP_36 = x[43] * dMGHGP * (Gammaf - x[44]) * q[B_rHGP] * (1 - EL)
+    drHGP_40 = x[43] * MGHGP * dGammaf * q[B_rHGP] * (1 - EL)
+    drHGP_44 = -x[43] * MGHGP * q[B_rHGP] * (1 - EL)
+    drHGP_7 = -rHGP0 * dEL
+
+    uIHGU = q[P_c4] * (IL / q[B_IL] - q[P_d4])
+    dMIHGU = _sech2(uIHGU) * q[P_c4] / q[B_IL] / q[D_MIHGU0]
+    uGHGU = q[P_c5] * (GL / q[B_GL] - q[P_d5])
+    MGHGU = (5.66 + 5.66 * np.tanh(uGHGU)) / q[D_MGHGU0]
+    dMGHGU = 5.66 * _sech2(uGHGU) * q[P_c5] / q[B_GL] / q[D_MGHGU0]
+    rHGU = x[45] * MGHGU * q[B_rHGU]
+    drHGU_45 = MGHGU * q[B_rHGU]
+    drHGU_36 = x[45] * dMGHGU * q[B_rHGU]
+    drKGE = np.where(GK >= 460, 0.872, 71 * _sech2(0.011 * (GK - 460)) * 0.011)
+    drGGU_6 = q[B_rGGU] * dEGW
+
+    # rates dynamic model
+    J[43, 28] = 0.04 * dMIHGP
+    J[43, 43] = -0.04
+    J[44, 40] = 0.0154 * 0.5 * dGammaf
+    J[44, 44] = -0.0154
+    J[45, 28] = 0.04 * dMIHGU
+    J[45, 45] = -0.04
+
+    # glucose
+    alphae, betae = q[P_alphae], q[P_betae]
+    eu = 1 + alphae * E2
+    hgp_scale = (1 + stress) * (1 - alphae * E2)
+    dhgp_16 = -(1 + stress) * alphae * rHGP
+    VGBC, VGBF, VGH, VGG, VGL, VGK, VGPC, VGPF = q[P_VGBC], q[P_VGBF], q[P_VGH], q[P_VGG], q[P_VGL], q[P_VGK], q[P_VGPC], q[P_VGPF]
+    J[32, 32] = -(q[P_QGB] + VGBF / q[P_TGB]) / VGBC
+    J[32, 33] = (VGBF / q[P_TGB]) / VGBC
+    J[32, 34] = q[P_QGB] / VGBC
+    J[33, 32] = 1 / q[P_TGB]
+    J[33, 33] = -1 / q[P_TGB]
+    J[34, 32] = q[P_QGB] / VGH
+    J[34, 34] = -q[P_QGH] / VGH
+    J[34, 36] = q[P_QGL] / VGH
+    J[34, 37] = q[P_QGK] / VGH
+    J[34, 38] = q[P_QGP] / VGH
+    J[35, 2] = dRa / VGG
+    J[35, 6] = -drGGU_6 / VGG
+    J[35, 34] = q[P_QGG] / VGG
+    J[35, 35] = -q[P_QGG] / VGG
+    J[36, 7] = hgp_scale * drHGP_7 / VGL
+    J[36, 16] = (dhgp_16 - alphae * rHGU) / VGL
+    J[36, 34] = q[P_QGA] / VGL
+    J[36, 35] = q[P_QGG] / VGL
+    J[36, 36] = (-q[P_QGL] + hgp_scale * drHGP_36 - eu * drHGU_36) / VGL
+    J[36, 40] = hgp_scale * drHGP_40 / VGL
+    J[36, 43] = hgp_scale * drHGP_43 / VGL
+    J[36, 44] = hgp_scale * drHGP_44 / VGL
+    J[36, 45] = -eu * drHGU_45 / VGL
+    J[37, 34] = q[P_QGK] / VGK
+    J[37, 37] = (-q[P_QGK] - drKGE) / VGK
+    J[38, 34] = q[P_QGP] / VGPC
+    J[38, 38] = -(q[P_QGP] + VGPF / q[P_TGP]) / VGPC
+    J[38, 39] = (VGPF / q[P_TGP]) / VGPC
+    J[39, 8] = -eu * drPGU_8 / VGPF
+    J[39, 15] = -betae * GPF / q[P_TGP]
+    J[39, 16] = -alphae * rPGU / VGPF
+    J[39, 31] = -eu * drPGU_31 / VGPF
+    J[39, 38] = 1 / q[P_TGP]
+    J[39, 39] = (-(VGPF / q[P_TGP]) * (1 + betae * E1) - eu * drPGU_39) / VGPF
+    J[49, 6] = drGGU_6
+    J[49, 8] = eu * drPGU_8
+    J[49, 15] = betae * GPF * q[P_QGP]
+    J[49, 16] = alphae * (rHGU + rPGU)
+    J[49, 31] = eu * drPGU_31
+    J[49, 36] = eu * drHGU_36
+    J[49, 37] = drKGE
+    J[49, 39] = betae * E1 * q[P_QGP] + eu * drPGU_39
+    J[49, 45] = eu * drHGU_45
+    J[50, 2] = dRa
+    J[50, 7] = hgp_scale * drHGP_7
+    J[50, 16] = dhgp_16
+    J[50, 36] = hgp_scale * drHGP_36
+    J[50, 40] = hgp_scale * drHGP_40
+    J[50, 43] = hgp_scale * drHGP_43
+    J[50, 44] = hgp_scale * drHGP_44
+    J[56, 34] = 1
+
+    # glucagon
+    uGP = 1.06 * ((GH / q[B_GH]) - 0.47)
+    uIP = 4.18 * ((x[26] / q[B_IH]) - 0.62)
+    MGPGammaR = 1.31 - 0.61 * np.tanh(uGP)
+    MIPGammaR = 2.93 - 2.09 * np.tanh(uIP)
+    dMGP = -0.61 * _sech2(uGP) * 1.06 / q[B_GH]
+    dMIP = -2.09 * _sech2(uIP) * 4.18 / q[B_IH]
+    J[40, 26] = (1 + stress) * 9.1 * MGPGammaR * dMIP / q[P_VGamma]
+    J[40, 34] = (1 + stress) * 9.1 * dMGP * MIPGammaR / q[P_VGamma]
+    J[40, 40] = -9.1 / q[P_VGamma]
+
+    # GLP-1
+    J[41, 0] = q[P_zeta] * ks * qsl
+    J[41, 1] = q[P_zeta] * (kempt + ks * qsl)
+    J[41, 41] = -1 / q[P_tphi]
+    J[41, 47] = q[P_zeta] * kD * qsl
+    J[42, 13] = q[P_CF2] * x[42] / q[P_VPHI]
+    J[42, 41] = 1 / (q[P_tphi] * q[P_VPHI])
+    J[42, 42] = -(q[P_Kout] + (q[P_RmaxC] - DRc) * q[P_CF2]) / q[P_VPHI]
+
+    # pancreas
+    PHI, mpan, R = x[42], x[22], x[24]
+    c = 1.32 ** 3.27
+    den = c + 5.93 * GH ** 3.02
+    XG = GH ** 3.27 / den
+    dXG = (3.27 * GH ** 2.27 * den - GH ** 3.27 * 5.93 * 3.02 * GH ** 2.02) / den ** 2
+    Pinft = XG ** 1.11 + q[P_zeta1] * PHI
+    dPinft = 1.11 * XG ** 0.11 * dXG
+    secreting = np.where(XG > R, 1.0, 0.0)
+    Sf = q[P_Sfactor]
+    dS_22 = Sf * (q[P_N1] * Pinft + q[P_N2] * secreting * (XG - R) + q[P_zeta2] * PHI)
+    dS_24 = -Sf * mpan * q[P_N2] * secreting
+    dS_34 = Sf * mpan * (q[P_N1] * dPinft + q[P_N2] * secreting * dXG)
+    dS_42 = Sf * mpan * (q[P_N1] * q[P_zeta1] + q[P_zeta2])
+    J[22, 22] = -q[P_Ks] - dS_22
+    J[22, 23] = q[P_gammapan]
+    J[22, 24] = -dS_24
+    J[22, 34] = -dS_34
+    J[22, 42] = -dS_42
+    J[23, 23] = -q[P_alphapan]
+    J[23, 34] = q[P_alphapan] * dPinft
+    J[23, 42] = q[P_alphapan] * q[P_zeta1]
+    J[24, 24] = -q[P_betapan]
+    J[24, 34] = q[P_betapan] * dXG
+
+    # insulin depots
+    Dfa, Ifa = x[18], x[55]
+    J[17, 17] = -q[P_pfa]
+    J[17, 18] = 3 * q[P_pfa] * q[P_qfa] * Dfa ** 2
+    J[18, 17] = q[P_pfa]
+    J[18, 18] = -3 * q[P_pfa] * q[P_qfa] * Dfa ** 2 - q[P_bfa] / (1 + Ifa)
+    J[18, 55] = q[P_bfa] * Dfa / (1 + Ifa) ** 2
+    J[55, 18] = q[P_rfa] * q[P_bfa] / (1 + Ifa)
+    J[55, 55] = -q[P_rfa] * q[P_bfa] * Dfa / (1 + Ifa) ** 2 - q[P_kclf]
+    Bla, Hla, Dla, Ila = x[19], x[20], x[21], x[54]
+    dis_19 = q[P_kla] * q[P_Cmax] / (1 + Hla)
+    dis_20 = -q[P_kla] * Bla * q[P_Cmax] / (1 + Hla) ** 2
+    J[19, 19] = -dis_19
+    J[19, 20] = -dis_20
+    J[20, 19] = dis_19
+    J[20, 20] = -q[P_pla] + dis_20
+    J[20, 21] = 3 * q[P_pla] * q[P_qla] * Dla ** 2
+    J[21, 20] = q[P_pla]
+    J[21, 21] = -3 * q[P_pla] * q[P_qla] * Dla ** 2 - q[P_bla] / (1 + Ila)
+    J[21, 54] = q[P_bla] * Dla / (1 + Ila) ** 2
+    J[54, 21] = q[P_rla] * q[P_bla] / (1 + Ila)
+    J[54, 54] = -q[P_rla] * q[P_bla] * Dla / (1 + Ila) ** 2 - q[P_kcll]
+
+    # insulin
+    VIPF = q[P_VIPF]
+    k = q[B_rPIR] / q[B_SB]  # drPIR/dS
+    secretion = {22: dS_22 * k, 24: dS_24 * k, 34: dS_34 * k, 42: dS_42 * k}
+    J[25, 25] = -q[P_QIB] / q[P_VIB]
+    J[25, 26] = q[P_QIB] / q[P_VIB]
+    J[26, 25] = q[P_QIB] / q[P_VIH]
+    J[26, 26] = -q[P_QIH] / q[P_VIH]
+    J[26, 28] = q[P_QIL] / q[P_VIH]
+    J[26, 29] = q[P_QIK] / q[P_VIH]
+    J[26, 31] = q[P_QIP] / q[P_VIH]
+    J[27, 26] = q[P_QIG] / q[P_VIG]
+    J[27, 27] = -q[P_QIG] / q[P_VIG]
+    J[28, 26] = 0.6 * q[P_QIA] / q[P_VIL]
+    J[28, 27] = 0.6 * q[P_QIG] / q[P_VIL]
+    J[28, 28] = -q[P_QIL] / q[P_VIL]
+    J[29, 26] = q[P_QIK] / q[P_VIK]
+    J[29, 29] = -1.3 * q[P_QIK] / q[P_VIK]
+    J[30, 26] = q[P_QIP] / q[P_VIPC]
+    J[30, 30] = -(q[P_QIP] + VIPF / q[P_TIP]) / q[P_VIPC]
+    J[30, 31] = (VIPF / q[P_TIP]) / q[P_VIPC]
+    J[30, 54] = 10
+    J[30, 55] = 10
+    J[31, 30] = 1 / q[P_TIP]
+    J[31, 31] = -1 / q[P_TIP] - q[D_kPIC] / VIPF
+    J[51, 26] = 0.4 * q[P_QIA]
+    J[51, 27] = 0.4 * q[P_QIG]
+    J[51, 29] = 0.3 * q[P_QIK]
+    J[51, 31] = q[D_kPIC]
+    for j, drPIR in secretion.items():
+        J[28, j] = ((1 - stress) - 0.4) * drPIR / q[P_VIL]
+        J[51, j] = 0.4 * drPIR
+        J[52, j] = (1 - stress) * drPIR
+    J[53, 18] = VIPF * q[P_rfa] * q[P_bfa] / (1 + IPF)
+    J[53, 21] = VIPF * q[P_rla] * q[P_bla] / (1 + IPF)
+    J[53, 31] = -VIPF * (q[P_rla] * q[P_bla] * Dla + q[P_rfa] * q[P_bfa] * Dfa) / (1 + IPF) ** 2
+    return J
+
+
+class _PatternRecorder(object):
+    def __init__(self):
+        self.entries = set()
+
+    def __setitem__(self, key, value):
+        self.entries.add(key)
+
+
+def _jacobian_sparsity():
+    recorder = _PatternRecorder()
+    x = np.ones(N_STATES)
+    p = np.full(N_PARAMETERS, 0.5)
+    _fill_jacobian(recorder, x, p, 0.0)
+    rows, cols = zip(*sorted(recorder.entries))
+    return sparse.csc_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(N_STATES, N_STATES))
+
+
+# Structural nonzeros of compiled_jacobian, e.g. for solve_ivp(jac_sparsity=...)
+JACOBIAN_SPARSITY = _jacobian_sparsity()
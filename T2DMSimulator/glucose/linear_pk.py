@@ -0,0 +1,85 @@
+import numpy as np
+from scipy.linalg import expm
+from T2DMSimulator.glucose.compiled import (P_alpham, P_betam, P_ka1, P_ka2, P_kgg, P_kgl, P_kgo, P_klp, P_kpg,
+                                            P_kpl, P_kpo, P_rhoalpha, P_rhobeta)
+
+# The metformin submodel (MO1, MO2, MGl, MGW, ML, MP) and the gut stages of
+# the vildagliptin submodel (AG1, AG2) are linear with constant coefficients
+# and get no input other than dose jumps, so they can be propagated exactly.
+LINEAR_PK_STATES = np.array([3, 4, 5, 6, 7, 8, 9, 10])
+
+# eigenvector matrices worse conditioned than this use expm on every call
+MAX_MODAL_CONDITION = 1e8
+
+
+def linear_pk_matrix(p):
+    '''
+    Return A with d/dt x[LINEAR_PK_STATES] = A @ x[LINEAR_PK_STATES] for the
+    compiled parameter vector p, the same equations as compiled_rhs.
+    '''
+    A = np.zeros((len(LINEAR_PK_STATES), len(LINEAR_PK_STATES)))
+    MO1, MO2, MGl, MGW, ML, MP, AG1, AG2 = range(8)
+    A[MO1, MO1] = -p[P_alpham]
+    A[MO2, MO2] = -p[P_betam]
+    A[MGl, MGl] = -(p[P_kgo] + p[P_kgg])
+    A[MGl, MO1] = p[P_rhoalpha]
+    A[MGl, MO2] = p[P_rhobeta]
+    A[MGW, MGl] = p[P_kgg]
+    A[MGW, MP] = p[P_kpg]
+    A[MGW, MGW] = -p[P_kgl]
+    A[ML, MGW] = p[P_kgl]
+    A[ML, MP] = p[P_kpl]
+    A[ML, ML] = -p[P_klp]
+    A[MP, ML] = p[P_klp]
+    A[MP, MP] = -(p[P_kpl] + p[P_kpg] + p[P_kpo])
+    A[MP, MGl] = 1
+    A[AG1, AG1] = -p[P_ka1]
+    A[AG2, AG1] = p[P_ka1]
+    A[AG2, AG2] = -p[P_ka2]
+    return A
+
+
+class LinearPropagator(object):
+    '''
+    Exact solution x(t0 + h) = expm(A h) x(t0) of a constant coefficient
+    linear system. Propagators for whole step sizes are computed once with
+    expm and cached, values inside a step come from the eigendecomposition
+    of A so the solver can evaluate them at any time.
+    '''
+    def __init__(self, A):
+        self.A = np.asarray(A, dtype=float)
+        self._propagators = {}
+        eigenvalues, V = np.linalg.eig(self.A)
+        if np.linalg.cond(V) < MAX_MODAL_CONDITION:
+            self._eigenvalues = eigenvalues
+            self._V = V
+            self._V_inv = np.linalg.inv(V)
+        else:
+            # defective or nearly so (e.g. ka1 == ka2)
+            self._V = None
+
+    def propagator(self, h):
+        '''
+        Return expm(A h), cached per step size h
+        '''
+        P = self._propagators.get(h)
+        if P is None:
+            P = self._propagators[h] = expm(self.A * h)
+        return P
+
+    def modes(self, x0):
+        '''
+        Return the modal coordinates of x0 for evaluate, None if A has no
+        well conditioned eigendecomposition
+        '''
+        if self._V is None:
+            return None
+        return self._V_inv @ x0
+
+    def evaluate(self, x0, h, modes=None):
+        '''
+        Return x(t0 + h) for x(t0) = x0, modes is x0 in modal coordinates
+        '''
+        if modes is None:
+            return expm(self.A * h) @ x0
+        return (self._V @ (np.exp(self._eigenvalues * h) * modes)).real
@@ -0,0 +1,64 @@
+import logging
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.optimize import root
+from T2DMSimulator.glucose.compiled import compiled_rhs, P_HRb
+from T2DMSimulator.glucose.jacobian import compiled_jacobian, N_STATES
+
+logger = logging.getLogger(__name__)
+
+# States without a fixed point, kept at their initial values: the meal size
+# DNq (47), which the gastric emptying rate divides by, and the cumulative
+# totals (49-53, 56).
+HELD_STATES = (47, 49, 50, 51, 52, 53, 56)
+FREE_STATES = np.setdiff1d(np.arange(N_STATES), HELD_STATES)
+
+
+def find_steady_state(x0, p, Dg=0, stress=0, HR=None, tol=1e-9, settle=24 * 60):
+    '''
+    Return the fixed point of compiled_rhs for a single patient under
+    constant fasting inputs, found by a Newton type root solve (MINPACK
+    hybrd with the analytic Jacobian) started from x0.
+    Inputs:
+        - x0: (57,) starting state, e.g. from GlucoseInitializer. A zero
+          meal size state x0[47] is seeded to 1 as in T2DPatient.reset
+        - p: compiled parameter vector
+        - Dg, stress, HR: the constant inputs, HR is the basal heart rate
+          HRb of p by default
+        - tol: largest accepted |dx/dt| of the returned state
+        - settle: if the root solve fails from x0, the model is integrated
+          for this many minutes and the solve retried from there
+    Raises RuntimeError if no fixed point within tol is found.
+    '''
+    x0 = np.array(x0, dtype=float)
+    if x0[47] == 0:
+        x0[47] = 1.0
+    HR = p[P_HRb] if HR is None else HR
+    x = _solve(x0, p, Dg, stress, HR, tol)
+    if x is None:
+        logger.info('Steady state solve failed from x0, settling for {} min first'.format(settle))
+        sol = solve_ivp(compiled_rhs, (0, settle), x0, method='BDF', args=(p, Dg, stress, HR),
+                        jac=lambda t, y, *args: compiled_jacobian(t, y, *args), rtol=1e-8, atol=1e-10)
+        if sol.success:
+            x = _solve(sol.y[:, -1], p, Dg, stress, HR, tol)
+    if x is None:
+        raise RuntimeError('No steady state found within tolerance {}'.format(tol))
+    return x
+
+
+def _solve(x0, p, Dg, stress, HR, tol):
+    x = x0.copy()
+
+    def residual(z):
+        x[FREE_STATES] = z
+        return compiled_rhs(0, x, p, Dg, stress, HR)[FREE_STATES]
+
+    def jacobian(z):
+        x[FREE_STATES] = z
+        return compiled_jacobian(0, x, p, Dg, stress, HR)[np.ix_(FREE_STATES, FREE_STATES)]
+
+    sol = root(residual, x0[FREE_STATES], jac=jacobian, method='hybr')
+    if not np.all(np.isfinite(sol.x)) or np.max(np.abs(residual(sol.x))) > tol:
+        return None
+    x[FREE_STATES] = sol.x
+    return x
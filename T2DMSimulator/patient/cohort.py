@@ -0,0 +1,212 @@
+import numpy as np
+import logging
+from scipy import sparse
+from T2DMSimulator.glucose.compiled import compile_parameter_matrix, compiled_rhs
+from T2DMSimulator.glucose.jacobian import compiled_jacobian, JACOBIAN_SPARSITY, N_STATES
+from T2DMSimulator.patient.t2dpatient import Action, Observation
+from T2DMSimulator.patient.inputs import apply_doses, input_changes, MinuteInputs
+from T2DMSimulator.patient.integrators import RowRosenbrock
+
+logger = logging.getLogger(__name__)
+
+
+class T2DCohort(object):
+    '''
+    Integrates N patients as a single (N, 57) state matrix with one
+    vectorized RHS (compiled_rhs on an (N, N_PARAMETERS) parameter matrix)
+    per evaluation. The solver (RowRosenbrock) keeps a step size and error
+    control per patient, so a stiff, dosed or reset patient does not slow
+    the others down, and integrate takes many minutes of inputs in one call.
+
+    Inputs are given as a T2DPatient Action whose fields are scalars or (N,)
+    arrays for a minute (step), or (N, n_steps) arrays of per minute inputs
+    (run). Meals are eaten at EAT_RATE like T2DPatient, doses are added to
+    the state at the start of the minute they are given in. The heart rate
+    goes straight into the physical activity submodel (action.physical), there
+    is no simulated resting heart rate as in T2DPatient.step.
+    '''
+    SAMPLE_TIME = 1  # min
+    EAT_RATE = 5  # g/min CHO
+
+    def __init__(self, patients, t0=0, names=None, quiescent_tol=0, rtol=1e-4, atol=1e-6):
+        '''
+        T2DCohort constructor.
+        Inputs:
+            - patients: a list of T2DPatient, used for their parameters,
+              basal rates and initial states
+            - t0: simulation start time, it is 0 by default
+            - quiescent_tol: skip the vildagliptin and insulin depot
+              submodels while they are idle in every patient, see
+              compiled_rhs. It rarely pays off beyond a single patient
+            - rtol, atol: error tolerances of every patient's state
+        '''
+        self.n = len(patients)
+        self.names = [p.name for p in patients] if names is None else names
+        self.params = compile_parameter_matrix([p.param for p in patients], [p.basal for p in patients])
+        self.X0 = np.stack([np.array(p.X0v, dtype=float) for p in patients])
+        self.t0 = t0
+        self.quiescent_tol = quiescent_tol
+        self.rtol = rtol
+        self.atol = atol
+        self.reset()
+
+    @classmethod
+    def from_snapshot(cls, patient, snapshot, n, names=None, rtol=1e-4, atol=1e-6):
+        '''
+        A cohort of n copies of patient, all starting from snapshot (a
+        PatientSnapshot of patient), e.g. to simulate n candidate futures
+        '''
+        cohort = cls.__new__(cls)
+        cohort.n = n
+        cohort.names = [patient.name] * n if names is None else names
+        cohort.params = np.tile(patient._compiled_params, (n, 1))
+        cohort.X0 = np.tile(np.asarray(snapshot.state, dtype=float), (n, 1))
+        cohort.t0 = snapshot.t
+        cohort.quiescent_tol = patient.quiescent_tol
+        cohort.rtol = rtol
+        cohort.atol = atol
+        cohort.reset()
+        cohort.planned_meal[:] = snapshot.planned_meal
+        return cohort
+
+    @classmethod
+    def from_virtual_cohort(cls, virtual_cohort, t0=0, quiescent_tol=0, rtol=1e-4, atol=1e-6):
+        '''
+        A cohort of the rows of virtual_cohort, a structured array from
+        virtual_cohort.generate_virtual_cohort
+        '''
+        cohort = cls.__new__(cls)
+        cohort.n = len(virtual_cohort)
+        cohort.names = ['{}#{}'.format(subtype, i) for subtype, i in zip(virtual_cohort['subtype'], virtual_cohort['id'])]
+        cohort.params = np.ascontiguousarray(virtual_cohort['params'])
+        cohort.X0 = np.ascontiguousarray(virtual_cohort['X0'])
+        cohort.t0 = t0
+        cohort.quiescent_tol = quiescent_tol
+        cohort.rtol = rtol
+        cohort.atol = atol
+        cohort.reset()
+        return cohort
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def t(self):
+        return self._t
+
+    @property
+    def sample_time(self):
+        return self.SAMPLE_TIME
+
+    @property
+    def observation(self):
+        return Observation(Gsub=self.state[:, 34])
+
+    def step(self, action):
+        '''
+        One minute of action, whose fields are scalars or (N,) arrays.
+        Returns action with the meal eaten this minute as CHO.
+        '''
+        schedule, _ = self.run(Action(*(np.broadcast_to(np.asarray(value, dtype=float), (self.n,))[:, None]
+                                        for value in action)))
+        return Action(*(value[:, 0] for value in schedule))
+
+    def run(self, actions):
+        '''
+        Take the (N, n_steps) per minute inputs of actions, announced meals
+        as in step, in a single integrate call.
+        Returns the inputs taken, the meals eaten each minute as CHO, and
+        the (N, n_steps, 57) states at the end of every minute.
+        '''
+        to_eat = np.empty(np.shape(actions.CHO))
+        for i in range(to_eat.shape[1]):
+            to_eat[:, i] = self._announce_meal(actions.CHO[:, i])
+        schedule = actions._replace(CHO=to_eat)
+        return schedule, self.integrate(schedule)
+
+    def integrate(self, schedule):
+        '''
+        Integrate the cohort through schedule, an Action of (N, n_steps) per
+        minute inputs whose CHO is the meal eaten that minute. Doses are
+        given at the start of their minute, and every patient only breaks
+        its steps where its own inputs change.
+        Returns the (N, n_steps, 57) states at the end of every minute.
+        '''
+        n_steps = schedule.CHO.shape[1]
+        time = self._t + np.arange(n_steps + 1) * self.sample_time
+        self._inputs = MinuteInputs(schedule, self._t, self.sample_time)
+        self._schedule = schedule
+        changes = input_changes(schedule)
+        changes[:, 0] = False
+        breaks = np.sort(np.where(changes, time[None, :-1], np.inf), axis=1)[:, :max(changes.sum(axis=1).max(), 1)]
+        x = apply_doses(self._state.copy(), Action(*(value[:, 0] for value in schedule)))
+        try:
+            states = self._integrator.integrate(self._t, x, time[1:], breaks=breaks, jump=self._jump)
+        except RuntimeError:
+            logger.error('ODE solver failed!!')
+            raise
+        self._state = states[:, -1].copy()
+        self._t = time[-1]
+        return states
+
+    def model(self, t, x, Dg, stress, physical):
+        if self.n == 1:
+            # a single patient takes the plain float path of compiled_rhs
+            return compiled_rhs(t, x, self.params[0], *_scalars(Dg, stress, physical), self.quiescent_tol)
+        return compiled_rhs(t, x.reshape(self.n, -1), self.params, Dg, stress, physical, self.quiescent_tol).ravel()
+
+    def jacobian(self, t, x, Dg, stress, physical):
+        '''
+        Block diagonal Jacobian of model, a (57N, 57N) scipy.sparse bsr matrix
+        (a dense (57, 57) array for a single patient)
+        '''
+        if self.n == 1:
+            return compiled_jacobian(t, x, self.params[0], *_scalars(Dg, stress, physical))
+        blocks = compiled_jacobian(t, x.reshape(self.n, -1), self.params, Dg, stress, physical)
+        return sparse.bsr_matrix((blocks, np.arange(self.n), np.arange(self.n + 1)), shape=(self.n * N_STATES, self.n * N_STATES))
+
+    def _minutes(self, t):
+        return np.rint((t - self._inputs.t0) / self.sample_time).astype(int)
+
+    def _row_model(self, t, x, rows, since):
+        Dg, stress, physical = self._inputs.rows(rows, self._minutes(since))
+        return compiled_rhs(t, x, self.params[rows], Dg, stress, physical, self.quiescent_tol)
+
+    def _row_jacobian(self, t, x, rows, since):
+        return compiled_jacobian(t, x, self.params[rows], *self._inputs.rows(rows, self._minutes(since)))
+
+    def _jump(self, rows, t, x):
+        minutes = self._minutes(t)
+        return apply_doses(x, Action(*(value[rows, minutes] for value in self._schedule)))
+
+    def _announce_meal(self, meal):
+        self.planned_meal = self.planned_meal + meal
+        to_eat = np.minimum(self.EAT_RATE, np.maximum(self.planned_meal, 0))
+        self.planned_meal = np.maximum(self.planned_meal - to_eat, 0)
+        return to_eat
+
+    def reset(self, rows=None):
+        '''
+        Reset every patient to its initial state, or only the patients in
+        rows (an index or (N,) mask), which then restart from their initial
+        state at the current time while the others carry on
+        '''
+        X0 = self.X0.copy()
+        # the meal size state is seeded as in T2DPatient.reset so the gastric
+        # emptying rate stays finite
+        X0[X0[:, 47] == 0, 47] = 1.0
+        if rows is None:
+            self._integrator = RowRosenbrock(self._row_model, self._row_jacobian, JACOBIAN_SPARSITY.toarray(),
+                                             rtol=self.rtol, atol=self.atol)
+            self._state = X0
+            self._t = self.t0
+            self.planned_meal = np.zeros(self.n)
+            return
+        self._state[rows] = X0[rows]
+        self._integrator.reset(rows)
+        self.planned_meal[rows] = 0
+
+
+def _scalars(*values):
+    return [float(np.ravel(value)[0]) for value in values]
@@ -0,0 +1,186 @@
+import numpy as np
+from bisect import bisect_right
+
+# state indices and unit conversions of the bolus inputs
+DOSE_INDICES = {
+    'CHO': (0, 46),
+    'metformin': (3, 4),
+    'vildagliptin': (9,),
+    'insulin_fast': (17,),
+    'insulin_long': (19,),
+}
+DOSE_SCALES = {
+    'CHO': 1e3,
+    'metformin': 1e3,
+    'vildagliptin': 1 / (303.406) * 10 ** 6,
+    'insulin_fast': 1e2 / 6.76,
+    'insulin_long': 1e2 / 6.76,
+}
+
+
+def has_doses(action):
+    '''
+    True if action gives any meal or drug bolus
+    '''
+    return any(np.any(np.asarray(getattr(action, field)) != 0) for field in DOSE_INDICES)
+
+
+def apply_doses(x, action):
+    '''
+    Add the meal and drug amounts of action to the state x (one (57,) state
+    or an (N, 57) matrix with (N,) action fields) as a jump, in place.
+    '''
+    for field, indices in DOSE_INDICES.items():
+        dose = np.asarray(getattr(action, field), dtype=float) * DOSE_SCALES[field]
+        if np.any(dose != 0):
+            for index in indices:
+                x[..., index] += dose
+    # Meal size state restarts at the new meal
+    x[..., 47] = np.where(np.asarray(action.CHO) > 0, x[..., 46], x[..., 47])
+    return x
+
+
+class PiecewiseConstant(object):
+    '''
+    Right-continuous step function of time: the value at t is the last one
+    set at or before t.
+    '''
+    def __init__(self, value=0.0, t0=0.0):
+        self.times = [t0]
+        self.values = [value]
+
+    def set(self, t, value):
+        '''
+        Set the value from time t on, t must not be before the last change.
+        Returns True if the function jumps at t.
+        '''
+        if t < self.times[-1]:
+            raise ValueError('Input set at t = {} before its last change at t = {}'.format(t, self.times[-1]))
+        if value == self.values[-1]:
+            return False
+        if t == self.times[-1]:
+            self.values[-1] = value
+        else:
+            self.times.append(t)
+            self.values.append(value)
+        return True
+
+    def __call__(self, t):
+        return self.values[max(bisect_right(self.times, t) - 1, 0)]
+
+    def copy(self):
+        other = PiecewiseConstant.__new__(PiecewiseConstant)
+        other.times = list(self.times)
+        other.values = list(self.values)
+        return other
+
+    def discard_before(self, t):
+        '''
+        Forget the changes that are no longer needed to evaluate times >= t
+        '''
+        i = max(bisect_right(self.times, t) - 1, 0)
+        del self.times[:i]
+        del self.values[:i]
+
+
+class InputSchedule(object):
+    '''
+    Inputs of one patient over time, split by how they enter the model:
+        - boluses (meals, insulin, metformin, vildagliptin) are state jumps,
+          applied between integration segments with apply_doses
+        - the meal rate Dg, stress and heart rate are piecewise constant
+          arguments of the RHS
+
+    The RHS never sees a bolus, so it is a pure function of (t, x) and an
+    integration segment can run as long as the inputs do not jump.
+    '''
+    def __init__(self, t0=0):
+        self.doses = {}
+        self.Dg = PiecewiseConstant(0.0, t0)
+        self.stress = PiecewiseConstant(0.0, t0)
+        self.heart_rate = PiecewiseConstant(0.0, t0)
+
+    def add(self, t, action, heart_rate=None):
+        '''
+        Schedule the inputs of action from time t on.
+        Inputs:
+            - action: a patient Action, CHO is the amount eaten at t (g),
+              which is both a bolus into the stomach and the meal rate Dg
+            - heart_rate: the piecewise constant heart rate from t on, it is
+              action.physical by default
+        Returns True if the inputs are discontinuous at t.
+        '''
+        jump = False
+        if has_doses(action):
+            self.doses[t] = action
+            jump = True
+        jump |= self.Dg.set(t, action.CHO * 1e3)
+        jump |= self.stress.set(t, action.stress)
+        jump |= self.heart_rate.set(t, action.physical if heart_rate is None else heart_rate)
+        return jump
+
+    def pop_doses(self, t):
+        '''
+        Return and remove the boluses given at time t, None if there are none
+        '''
+        return self.doses.pop(t, None)
+
+    def rhs_inputs(self, t):
+        '''
+        Return the (Dg, stress, heart rate) arguments of the RHS at time t
+        '''
+        return self.Dg(t), self.stress(t), self.heart_rate(t)
+
+    def copy(self):
+        other = InputSchedule.__new__(InputSchedule)
+        other.doses = dict(self.doses)
+        other.Dg = self.Dg.copy()
+        other.stress = self.stress.copy()
+        other.heart_rate = self.heart_rate.copy()
+        return other
+
+    def discard_before(self, t):
+        self.doses = {s: action for s, action in self.doses.items() if s >= t}
+        self.Dg.discard_before(t)
+        self.stress.discard_before(t)
+        self.heart_rate.discard_before(t)
+
+
+def input_changes(schedule):
+    '''
+    (N, n_steps) bool, True where a row of schedule, an Action of (N,
+    n_steps) per minute inputs, gets a dose or its continuous inputs differ
+    from the minute before (always True at minute 0)
+    '''
+    changes = np.zeros(schedule.CHO.shape, dtype=bool)
+    changes[:, 0] = True
+    for field, value in zip(schedule._fields, schedule):
+        changes[:, 1:] |= value[:, 1:] != value[:, :-1]
+        if field in DOSE_INDICES:
+            changes |= value != 0
+    return changes
+
+
+class MinuteInputs(object):
+    '''
+    Piecewise constant (Dg, stress, heart rate) of every row of a schedule
+    of (N, n_steps) per minute inputs (CHO is the meal eaten that minute, g)
+    at time t
+    '''
+    def __init__(self, schedule, t0, sample_time):
+        self.Dg = schedule.CHO * 1e3
+        self.stress = schedule.stress
+        self.heart_rate = schedule.physical
+        self.t0 = t0
+        self.sample_time = sample_time
+
+    def __call__(self, t):
+        i = min(max(int((t - self.t0) // self.sample_time), 0), self.Dg.shape[1] - 1)
+        return self.Dg[:, i], self.stress[:, i], self.heart_rate[:, i]
+
+    def rows(self, rows, minutes):
+        '''
+        The inputs of rows in their minutes (per row indices)
+        '''
+        minutes = np.clip(minutes, 0, self.Dg.shape[1] - 1)
+        return self.Dg[rows, minutes], self.stress[rows, minutes], self.heart_rate[rows, minutes]
@@ -0,0 +1,474 @@
+import numpy as np
+from scipy.integrate import solve_ivp, RK23, RK45, DOP853, Radau, BDF, LSODA
+
+IVP_METHODS = ('BDF', 'Radau', 'LSODA', 'RK45', 'RK23', 'DOP853')
+SOLVER_CLASSES = {'RK23': RK23, 'RK45': RK45, 'DOP853': DOP853, 'Radau': Radau, 'BDF': BDF, 'LSODA': LSODA}
+
+
+class IVPIntegrator(object):
+    '''
+    scipy.integrate.solve_ivp behind the small part of the
+    scipy.integrate.ode interface that T2DPatient uses (y, t,
+    set_initial_value, set_f_params, successful, integrate), so implicit
+    methods can be used with an analytic Jacobian.
+    '''
+    def __init__(self, f, jac=None, method='BDF', rtol=1e-6, atol=1e-8):
+        if method not in IVP_METHODS:
+            raise ValueError('Unknown solve_ivp method {}, expected one of {}'.format(method, IVP_METHODS))
+        self.f = f
+        self.jac = jac
+        self.method = method
+        self.rtol = rtol
+        self.atol = atol
+        self.f_params = ()
+        self.nfev = 0
+        self.njev = 0
+        self._success = True
+
+    def set_initial_value(self, y, t=0.0):
+        self.y = np.array(y, dtype=float)
+        self.t = t
+        return self
+
+    def set_f_params(self, *args):
+        self.f_params = args
+        return self
+
+    def successful(self):
+        return self._success
+
+    def integrate(self, t):
+        kwargs = {}
+        if self.jac is not None and self.method in ('BDF', 'Radau', 'LSODA'):
+            kwargs['jac'] = self.jac
+        sol = solve_ivp(self.f, (self.t, t), self.y, method=self.method, args=self.f_params,
+                        rtol=self.rtol, atol=self.atol, **kwargs)
+        self._success = sol.success
+        self.nfev += sol.nfev
+        self.njev += sol.njev
+        if sol.success:
+            self.y = sol.y[:, -1]
+            self.t = t
+        return self.y
+
+
+class HorizonIntegrator(IVPIntegrator):
+    '''
+    Keeps one solve_ivp OdeSolver running across integrate calls and answers
+    them from its dense output, so the adaptive step size is not reset every
+    sample. The solver is only restarted when the state jumps
+    (set_initial_value) or the RHS arguments change (set_f_params), i.e. at
+    input discontinuities.
+    '''
+    def __init__(self, f, jac=None, method='LSODA', rtol=1e-6, atol=1e-8):
+        self._solver = None
+        self._dense = None
+        super().__init__(f, jac=jac, method=method, rtol=rtol, atol=atol)
+        self.restarts = 0
+
+    @property
+    def nfev(self):
+        return self._nfev + (self._solver.nfev if self._solver is not None else 0)
+
+    @nfev.setter
+    def nfev(self, value):
+        self._nfev = value
+
+    @property
+    def njev(self):
+        return self._njev + (self._solver.njev if self._solver is not None else 0)
+
+    @njev.setter
+    def njev(self, value):
+        self._njev = value
+
+    def set_initial_value(self, y, t=0.0):
+        self._drop_solver()
+        return super().set_initial_value(y, t)
+
+    def set_f_params(self, *args):
+        if len(args) != len(self.f_params) or not all(_same_argument(a, b) for a, b in zip(args, self.f_params)):
+            self._drop_solver()
+        return super().set_f_params(*args)
+
+    def integrate(self, t):
+        if t == self.t:
+            return self.y
+        if self._solver is None:
+            self._start()
+        while self._solver.t < t:
+            self._solver.step()
+            if self._solver.status == 'failed':
+                self._success = False
+                return self.y
+            self._dense = self._solver.dense_output()
+        self.y = self._solver.y.copy() if self._solver.t == t else self._dense(t)
+        self.t = t
+        return self.y
+
+    def _drop_solver(self):
+        if self._solver is not None:
+            self._nfev += self._solver.nfev
+            self._njev += self._solver.njev
+            self._solver = None
+
+    def _start(self):
+        args = self.f_params
+        kwargs = {}
+        if self.jac is not None and self.method in ('BDF', 'Radau', 'LSODA'):
+            kwargs['jac'] = lambda t, y: self.jac(t, y, *args)
+        self._solver = SOLVER_CLASSES[self.method](lambda t, y: self.f(t, y, *args), self.t, self.y, np.inf,
+                                                   rtol=self.rtol, atol=self.atol, **kwargs)
+        self.restarts += 1
+
+
+def _same_argument(a, b):
+    if a is b:
+        return True
+    if np.isscalar(a) and np.isscalar(b):
+        return a == b
+    return False
+
+
+class HybridIntegrator(object):
+    '''
+    Splits the state into a linear constant coefficient block, propagated in
+    closed form by a LinearPropagator, and the nonlinear remainder, which is
+    all the wrapped solver integrates. Inside a step the remainder's RHS sees
+    the exact linear states at its evaluation time.
+    Inputs:
+        - f, jac: RHS and Jacobian of the full state, jac may be None
+        - linear_states: indices of the linear block
+        - propagator: a LinearPropagator of the linear block
+        - make_integrator: builds the solver of the remainder from (f, jac),
+          e.g. lambda f, jac: IVPIntegrator(f, jac=jac, method='BDF')
+    '''
+    def __init__(self, f, jac, linear_states, propagator, make_integrator):
+        self.f = f
+        self.jac = jac
+        self.linear_states = np.asarray(linear_states)
+        self.propagator = propagator
+        self.nonlinear_states = None
+        self._full = None
+        self.solver = make_integrator(self._nonlinear_rhs, self._nonlinear_jacobian if jac is not None else None)
+
+    def __getattr__(self, name):
+        # solver statistics (nfev, njev, restarts, ...) are the wrapped solver's
+        if name == 'solver':
+            raise AttributeError(name)
+        return getattr(self.solver, name)
+
+    @property
+    def t(self):
+        return self.solver.t
+
+    @property
+    def y(self):
+        y = np.empty(len(self._full))
+        y[self.nonlinear_states] = self.solver.y
+        y[self.linear_states] = self._linear_state(self.solver.t)
+        return y
+
+    def set_initial_value(self, y, t=0.0):
+        y = np.asarray(y, dtype=float)
+        if self._full is None or len(self._full) != len(y):
+            self.nonlinear_states = np.setdiff1d(np.arange(len(y)), self.linear_states)
+            self._full = np.empty(len(y))
+        self._rebase(y[self.linear_states], t)
+        self.solver.set_initial_value(y[self.nonlinear_states], t)
+        return self
+
+    def set_f_params(self, *args):
+        self.solver.set_f_params(*args)
+        return self
+
+    def successful(self):
+        return self.solver.successful()
+
+    def integrate(self, t):
+        self.solver.integrate(t)
+        if self.solver.successful():
+            # move the origin of the linear block to t with the cached propagator
+            self._rebase(self.propagator.propagator(t - self._t0) @ self._x0, t)
+        return self.y
+
+    def _rebase(self, x0, t0):
+        self._x0 = np.array(x0, dtype=float)
+        self._t0 = t0
+        self._modes = self.propagator.modes(self._x0)
+
+    def _linear_state(self, t):
+        if t == self._t0:
+            return self._x0
+        return self.propagator.evaluate(self._x0, t - self._t0, self._modes)
+
+    def _full_state(self, t, x):
+        full = self._full
+        full[self.nonlinear_states] = x
+        full[self.linear_states] = self._linear_state(t)
+        return full
+
+    def _nonlinear_rhs(self, t, x, *args):
+        return self.f(t, self._full_state(t, x), *args)[self.nonlinear_states]
+
+    def _nonlinear_jacobian(self, t, x, *args):
+        J = self.jac(t, self._full_state(t, x), *args)
+        return J[np.ix_(self.nonlinear_states, self.nonlinear_states)]
+
+
+class BatchedSparseLU(object):
+    '''
+    LU factorization without pivoting of I - s J for a batch of (m, m)
+    matrices J that share one sparsity pattern, the Newton matrices of many
+    patients. The elimination order (Markowitz) and the fill-in are worked
+    out once from the pattern and the factors are stored compactly, so
+    factor and solve only touch the structural nonzeros, with one vectorized
+    operation per pivot across the batch.
+    Inputs:
+        - pattern: (m, m) bool structural nonzeros of J
+    '''
+    def __init__(self, pattern):
+        pattern = np.asarray(pattern, dtype=bool) | np.eye(len(pattern), dtype=bool)
+        m = len(pattern)
+        self.order = _markowitz_order(pattern)
+        filled = pattern[np.ix_(self.order, self.order)]
+        for k in range(m):
+            filled[np.ix_(filled[:, k] & (np.arange(m) > k), filled[k] & (np.arange(m) > k))] = True
+        self.fill = int(filled.sum() - pattern.sum())
+        rows, cols = np.nonzero(filled)
+        position = np.full((m, m), -1)
+        position[rows, cols] = np.arange(len(rows))
+        # J entries in the compact layout, in the elimination order
+        self.gather = (self.order[rows], self.order[cols])
+        self.diagonal = position[np.arange(m), np.arange(m)]
+        self.pivots = []
+        for k in range(m):
+            below = np.flatnonzero(filled[k + 1:, k]) + k + 1
+            right = np.flatnonzero(filled[k, k + 1:]) + k + 1
+            self.pivots.append((k, below, position[below, k], position[np.ix_(below, right)].ravel(),
+                                np.repeat(position[below, k], right.size), np.tile(position[k, right], below.size)))
+        # the triangular solves go level by level: the unknowns of a level
+        # only depend on earlier levels and are updated together
+        lower = np.tril(filled, -1)
+        upper = np.triu(filled, 1)
+        self.forward = _levels(lower, position, range(m))
+        self.backward = _levels(upper, position, reversed(range(m)))
+        self.first = np.array([i for i in range(m) if not upper[i].any()])
+
+    def factor(self, J, scale):
+        '''
+        The compact L (unit diagonal) and U factors of I - scale J, for the
+        (n, m, m) batch J and (n,) scale
+        '''
+        LU = -scale[:, None] * J[:, self.gather[0], self.gather[1]]
+        LU[:, self.diagonal] += 1
+        for k, below, lower, target, left, top in self.pivots:
+            if below.size:
+                LU[:, lower] /= LU[:, self.diagonal[k], None]
+                if target.size:
+                    LU[:, target] -= LU[:, left] * LU[:, top]
+        return LU
+
+    def solve(self, LU, b):
+        '''
+        Solve (I - scale J) x = b for the (n, m) right hand sides b
+        '''
+        y = b[:, self.order]
+        for unknowns, entries, sources, starts in self.forward:
+            y[:, unknowns] -= np.add.reduceat(LU[:, entries] * y[:, sources], starts, axis=1)
+        y[:, self.first] /= LU[:, self.diagonal[self.first]]
+        for unknowns, entries, sources, starts in self.backward:
+            y[:, unknowns] = (y[:, unknowns] - np.add.reduceat(LU[:, entries] * y[:, sources], starts, axis=1)) / \
+                LU[:, self.diagonal[unknowns]]
+        x = np.empty_like(y)
+        x[:, self.order] = y
+        return x
+
+
+def _levels(triangle, position, order):
+    '''
+    Level schedule of a triangular solve: per level the unknowns whose
+    dependencies (the nonzeros of their row of triangle) are all solved at
+    earlier levels, with the compact positions and columns of those
+    nonzeros grouped by unknown (starts, for np.add.reduceat)
+    '''
+    level = np.zeros(len(triangle), dtype=int)
+    for i in order:
+        dependencies = np.flatnonzero(triangle[i])
+        level[i] = level[dependencies].max() + 1 if dependencies.size else 0
+    levels = []
+    for depth in range(1, level.max() + 1):
+        unknowns = np.flatnonzero(level == depth)
+        rows, sources = np.nonzero(triangle[unknowns])
+        starts = np.searchsorted(rows, np.arange(len(unknowns)))
+        levels.append((unknowns, position[unknowns[rows], sources], sources, starts))
+    return levels
+
+
+def _markowitz_order(pattern):
+    '''
+    Greedy elimination order of a square pattern: each step eliminates the
+    pivot whose (row count - 1) * (column count - 1) in the remaining
+    submatrix, the fill it can create, is smallest
+    '''
+    remaining = pattern.copy()
+    alive = np.ones(len(pattern), dtype=bool)
+    order = []
+    for _ in range(len(pattern)):
+        rows = remaining[:, alive].sum(axis=1)
+        cols = remaining[alive, :].sum(axis=0)
+        cost = np.where(alive, (rows - 1) * (cols - 1), np.iinfo(np.int64).max)
+        k = int(np.argmin(cost))
+        below = np.flatnonzero(remaining[:, k] & alive)
+        right = np.flatnonzero(remaining[k, :] & alive)
+        remaining[np.ix_(below, right)] = True
+        alive[k] = False
+        order.append(k)
+    return np.array(order)
+
+
+class RowRosenbrock(object):
+    '''
+    Integrates n independent systems, the rows of an (n, m) state, with the
+    Rosenbrock 2(3) pair of Shampine and Reichelt (MATLAB's ode23s) and a
+    step size and error control of their own per row. Every stage is one
+    batched RHS or Jacobian evaluation over the rows still stepping, but a
+    stiff or dosed row never shortens the steps of the others, and a jump
+    in one row (jump) is seen by that row's error control alone, nothing
+    restarts. The method is linearly implicit: one LU of I - d h J per
+    step (BatchedSparseLU), no Newton iterations.
+    The inputs are piecewise constant between per row breaks, which no step
+    crosses, and the step sizes are kept across breaks and integrate calls.
+    Inputs:
+        - f(t, x, rows, since): the (len(rows), m) derivatives of rows at
+          their times t (len(rows),) and states x (len(rows), m), since is
+          the time each row's current input piece started at (its last
+          break), so the input of a step ending on a break is its left limit
+        - jac(t, x, rows, since): the (len(rows), m, m) Jacobian blocks
+        - sparsity: (m, m) bool pattern of the Jacobian blocks
+        - rtol, atol: per row error tolerances (RMS norm over the row)
+        - first_step: step size of every row at the start
+    '''
+    D = 1 / (2 + np.sqrt(2))
+    E32 = 6 + np.sqrt(2)
+
+    def __init__(self, f, jac, sparsity, rtol=1e-4, atol=1e-6, first_step=0.05):
+        self.f = f
+        self.jac = jac
+        self.lu = BatchedSparseLU(sparsity)
+        self.rtol = rtol
+        self.atol = atol
+        self.first_step = first_step
+        self.h = None
+        self.nfev = 0
+        self.njev = 0
+        self.nsteps = 0
+
+    def reset(self, rows=None):
+        '''
+        Forget the step sizes of every row, or of the rows given
+        '''
+        if rows is None or self.h is None:
+            self.h = None
+        else:
+            self.h[rows] = self.first_step
+
+    def integrate(self, t, x, t_eval, breaks=None, jump=None):
+        '''
+        Advance every row from time t to t_eval[-1].
+        Inputs:
+            - t: start time of every row
+            - x: (n, m) states at t
+            - t_eval: (T,) increasing output times after t
+            - breaks: (n, B) sorted input changes of each row inside
+              (t, t_eval[-1]), padded with np.inf
+            - jump(rows, t, x): called as rows reach a break at their times
+              t with their states x, returns their states after the break
+              (e.g. with doses added). A row keeps its step size across
+              a jump, its error control shrinks the step if the jump calls
+              for it
+        Returns the (n, T, m) states at t_eval.
+        '''
+        x = np.array(x, dtype=float)
+        n, m = x.shape
+        t_eval = np.asarray(t_eval, dtype=float)
+        t_end = t_eval[-1]
+        breaks = np.full((n, 0), np.inf) if breaks is None else np.asarray(breaks, dtype=float)
+        breaks = np.hstack([breaks, np.full((n, 1), np.inf)])
+        if self.h is None or len(self.h) != n:
+            self.h = np.full(n, self.first_step)
+        h = self.h
+        now = np.full(n, float(t))
+        since = now.copy()
+        next_break = np.zeros(n, dtype=int)
+        next_eval = np.zeros(n, dtype=int)
+        F = np.empty((n, m))
+        fresh = np.zeros(n, dtype=bool)
+        out = np.empty((n, len(t_eval), m))
+        padded = np.append(t_eval, np.inf)
+
+        while True:
+            rows = np.flatnonzero(now < t_end)
+            if not rows.size:
+                return out
+            stale = rows[~fresh[rows]]
+            if stale.size:
+                F[stale] = self.f(now[stale], x[stale], stale, since[stale])
+                self.nfev += 1
+                fresh[stale] = True
+            t0, y, piece, F0 = now[rows], x[rows], since[rows], F[rows]
+            stop = np.minimum(breaks[rows, next_break[rows]], t_end)
+            hits = h[rows] >= stop - t0
+            step = np.where(hits, stop - t0, h[rows])
+            t1 = np.where(hits, stop, t0 + step)
+
+            J = self.jac(t0, y, rows, piece)
+            LU = self.lu.factor(J, self.D * step)
+            k1 = self.lu.solve(LU, F0)
+            F1 = self.f(t0 + step / 2, y + (step / 2)[:, None] * k1, rows, piece)
+            k2 = self.lu.solve(LU, F1 - k1) + k1
+            y1 = y + step[:, None] * k2
+            F2 = self.f(t1, y1, rows, piece)
+            k3 = self.lu.solve(LU, F2 - self.E32 * (k2 - F1) - 2 * (k1 - F0))
+            self.nfev += 2
+            self.njev += 1
+            self.nsteps += 1
+
+            error = (step / 6)[:, None] * (k1 - 2 * k2 + k3)
+            scale = self.atol + self.rtol * np.maximum(np.abs(y), np.abs(y1))
+            with np.errstate(invalid='ignore', over='ignore'):
+                norm = np.sqrt(np.mean((error / scale) ** 2, axis=1))
+            norm[~np.isfinite(norm) | ~np.all(np.isfinite(y1), axis=1)] = np.inf
+            accepted = norm <= 1
+            with np.errstate(divide='ignore'):
+                factor = np.clip(0.8 * norm ** (-1 / 3), 0.2, 5)
+            h_new = step * factor
+            # a step cut short by a break says nothing against the longer one
+            h[rows] = np.where(accepted & hits, np.maximum(h_new, h[rows]), h_new)
+            tiny = h[rows] < 1e-12 * np.maximum(np.abs(t0), 1)
+            if np.any(tiny):
+                raise RuntimeError('Step size too small at t = {}'.format(t0[tiny].min()))
+
+            done = rows[accepted]
+            t0, step, y, k1, k2, t1 = t0[accepted], step[accepted], y[accepted], k1[accepted], k2[accepted], t1[accepted]
+            # continuous extension of the step for the outputs it passes
+            while True:
+                due = np.flatnonzero(padded[next_eval[done]] <= t1)
+                if not due.size:
+                    break
+                passed = done[due]
+                theta = ((padded[next_eval[passed]] - t0[due]) / step[due])[:, None]
+                out[passed, next_eval[passed]] = y[due] + step[due, None] / (1 - 2 * self.D) * (
+                    theta * (1 - theta) * k1[due] + theta * (theta - 2 * self.D) * k2[due])
+                next_eval[passed] += 1
+            x[done] = y1[accepted]
+            now[done] = t1
+            F[done] = F2[accepted]
+
+            crossed = done[(now[done] == breaks[done, next_break[done]])]
+            if crossed.size:
+                since[crossed] = now[crossed]
+                next_break[crossed] += 1
+                fresh[crossed] = False
+                if jump is not None:
+                    x[crossed] = jump(crossed, now[crossed], x[crossed].copy())
@@ -5,26 +5,40 @@ import pandas as pd
 from collections import namedtuple
 import logging
 import pkg_resources
-from T2DMSimulator.glucose.GlucoseDynamics import GlucoseDynamics
 from T2DMSimulator.glucose.GlucoseParameters import GlucoseParameters
-from T2DMSimulator.glucose.glucose_initializer import GlucoseInitializer
-from T2DMSimulator.utils.TimerQueue import TimerQueue
+from T2DMSimulator.glucose.compiled import compile_parameters, compiled_rhs
+from T2DMSimulator.glucose.jacobian import compiled_jacobian
+from T2DMSimulator.glucose.linear_pk import LINEAR_PK_STATES, LinearPropagator, linear_pk_matrix
+from T2DMSimulator.patient.integrators import IVPIntegrator, HorizonIntegrator, HybridIntegrator
+from T2DMSimulator.patient.inputs import InputSchedule, apply_doses
+from T2DMSimulator.patient.timeline import InputTimeline
+from T2DMSimulator.glucose.glucose_initializer import GlucoseInitializer, basal_values, STEADY_STATE_CACHE
+from T2DMSimulator.utils.scheduler import RecommendationScheduler
 from T2DMSimulator.utils.TrapezoidFunc import TrapezoidFunc
-import random
 import queue
+import copy
 
 logger = logging.getLogger(__name__)
 
 Action = namedtuple("patient_action", ['CHO', 'insulin_fast', 'insulin_long', 'metformin', 'vildagliptin', 'stress', 'physical'])
 Observation = namedtuple("observation", ['Gsub'])
+PatientSnapshot = namedtuple("patient_snapshot", ['t', 'state', 'inputs', 'last_action', 'is_eating', 'planned_meal', 'last_foodtaken',
+                                                  'reccomended_actions', 'timeline', 'random_state'])
+
+# basal glucose utilization rates (mg/min), see GlucoseInitializer
+DEFAULT_BRATES = {'rBGU': 70, 'rRBCU': 10, 'rGGU': 20, 'rPGU': 35, 'rHGU': 20}
 
 PATIENT_PARA_FILE = pkg_resources.resource_filename(
     'T2DMSimulator', 'params/vpatient_params.csv')
 
-
 class T2DPatient(Patient):
     SAMPLE_TIME = 1  # min
     EAT_RATE = 5  # g/min CHO
+    HEART_RATE_STD = 5  # bpm, noise of the simulated resting heart rate
+    HEART_RATE_COEFFICIENTS = [0.5, 0.3, 0.2]  # AR weights of the resting heart rate
+    HORIZON_HEART_RATE_HOLD = 30  # min, horizon mode holds the resting heart rate at its mean over these blocks
+    RECOMMENDATION_TIME_SCALE = 5  # units of a recommendation's time per minute
+    RECOMMENDATION_JITTER = (10, 20)  # recommendation time units
 
     def __init__(self,
                  params,
@@ -38,7 +52,13 @@ class T2DPatient(Patient):
                  glucose_params=None,
                  name="testing",
                  prob_of_actioning=1,
-                 constraints=[]):
+                 constraints=[],
+                 solver='dopri5',
+                 integration='minute',
+                 hybrid_pk=False,
+                 quiescent_tol=0,
+                 steady_state=False,
+                 steady_state_cache=STEADY_STATE_CACHE):
         '''
         T2DPatient constructor.
         Inputs:
@@ -47,45 +67,70 @@ class T2DPatient(Patient):
               If not specified, load the default initial state in
               params.iloc[2:15]
             - t0: simulation start time, it is 0 by default
+            - solver: 'dopri5' (scipy ode, default) or a solve_ivp method
+              such as 'BDF', 'Radau' or 'LSODA', the implicit ones use the
+              analytic Jacobian of the model
+            - integration: 'minute' restarts the solver every SAMPLE_TIME,
+              'horizon' keeps one solver running between input
+              discontinuities (meals, doses, exercise, stress changes) and
+              reads the state from its dense output. The resting heart rate
+              is then held at its mean over blocks of
+              HORIZON_HEART_RATE_HOLD minutes, a new block restarts the
+              solver. Its minute to minute noise would cap the step size,
+              and it only moves the glucose through the exercise effect
+              gE, which is ~1e-6 at rest.
+              Horizon mode uses LSODA in place of dopri5, the model is stiff
+              enough that explicit methods gain little from longer steps.
+            - hybrid_pk: propagate the linear PK compartments (metformin and
+              the vildagliptin gut stages) exactly with matrix exponentials,
+              the solver only integrates the remaining states
+            - quiescent_tol: the vildagliptin and insulin depot submodels
+              are skipped in the RHS while all their states are below this
+              tolerance, see compiled_rhs. 0 (default) never skips them
+            - steady_state: start from the fasting fixed point of the full
+              model at the mean resting heart rate, so no burn-in is needed
+            - steady_state_cache: SteadyStateCache the initial state and
+              basal values are looked up in, the shared STEADY_STATE_CACHE
+              by default, None to always compute them
         '''
         self._params = params
         self.name = name
         self.param = GlucoseParameters() if glucose_params == None else glucose_params
         self.GBPC0 = 7/0.0555 if GBPC0 is None else GBPC0
         self.IBPF0 = 1 if IBPF0 is None else IBPF0
-        self.brates = {'rBGU': 70, 'rRBCU': 10, 'rGGU': 20, 'rPGU': 35, 'rHGU': 20} if brates is None else brates
+        self.brates = dict(DEFAULT_BRATES) if brates is None else brates
         self._init_state = init_state
         self.random_init_bg = random_init_bg
         self._seed = seed
         self.t0 = t0
         self.prob = prob_of_actioning
-        self.reccomended_actions = TimerQueue()
-        self.physical_activity_queue = []
+        self.reccomended_actions = RecommendationScheduler(self.RECOMMENDATION_TIME_SCALE, seed)
         self.heart_rates_running = [55,56,55]
         self.constraints = constraints
-        self.X0v, self.rates, self.SB = GlucoseInitializer(self.param, self).calculate_values()
+        self.solver = solver
+        self.integration = integration
+        self.hybrid_pk = hybrid_pk
+        self.quiescent_tol = quiescent_tol
+        self.steady_state = steady_state
+        initializer = GlucoseInitializer(self.param, self)
+        # the basal values of the model always come from the analytic initial state
+        self._basal_state, self.rates, self.SB = initializer.calculate_values(steady_state_cache)
+        if steady_state:
+            self.X0v = initializer.steady_state(HR=self.resting_heart_rate, cache=steady_state_cache)[0]
+        else:
+            self.X0v = self._basal_state
         self.reset()
 
     @property
     def basal(self):
-        basal0 = {
-            'GPF': self.X0v[39],
-            'IPF': self.IBPF0,
-            'IL': self.X0v[28],
-            'GL': self.X0v[36],
-            'Gamma': self.X0v[40],
-            'SB': self.SB,
-            'GH': self.X0v[34],
-            'IH': self.X0v[26],
-            'rPIR': self.rates[0],
-            'rBGU': self.rates[1],
-            'rRBCU': self.rates[2],
-            'rGGU': self.rates[3],
-            'rPGU': self.rates[4],
-            'rHGP': self.rates[5],
-            'rHGU': self.rates[6]
-        }
-        return basal0
+        return basal_values(self._basal_state, self.rates, self.SB, self.IBPF0)
+
+    @property
+    def resting_heart_rate(self):
+        '''
+        Fixed point of simulate_running_heart_rate without noise
+        '''
+        return sum(coeff * self.heart_rates_running[-lag] for lag, coeff in enumerate(self.HEART_RATE_COEFFICIENTS, start=1))
 
     @classmethod
     def withID(cls, patient_id, **kwargs):
@@ -123,67 +168,85 @@ class T2DPatient(Patient):
         return self.SAMPLE_TIME
     
     def add_reccomended_action(self, reccomended_action):
+        '''
+        Queue a recommended action, due reccomended_action.time (in units of
+        1/RECOMMENDATION_TIME_SCALE minute) from now. Returns a handle for
+        self.reccomended_actions.cancel, None if nothing was queued.
+        '''
         if not all(getattr(reccomended_action, field) == 0 for field in reccomended_action._fields if field != 'time'):
-            random.seed(self.seed)
-            # random chance for action to be carried out later or earlier by 10-20 minutes
-            if random.random() < 0.4:
-                noise = random.randint(10,20)
-                # may be added or negated to the original time
-                newTime = reccomended_action.time + noise if random.random() > 0.5 else reccomended_action.time - noise
-                self.reccomended_actions.put(reccomended_action, newTime)
-            else:
-                self.reccomended_actions.put(reccomended_action, reccomended_action.time)
-
-    def simulate_running_heart_rate(self):
-        std_deviation = 5
-        coefficients = [0.5, 0.3, 0.2]
+            # random chance for action to be carried out later or earlier
+            return self.reccomended_actions.put(reccomended_action, self._minute(self.t), reccomended_action.time,
+                                                jitter=self.RECOMMENDATION_JITTER)
+        return None
+
+    def simulate_running_heart_rate(self, n=None, random_state=None):
+        '''
+        Draw the next resting heart rate sample, or the next n as an array,
+        from random_state (the patient's own RandomState by default).
+        The running history keeps its initial values, so the samples are
+        independent noise around resting_heart_rate and are drawn at once.
+        '''
         lower_bound = 50
         upper_bound = 85
-        
-        next_value = sum(coeff * self.heart_rates_running[-lag] for lag, coeff in enumerate(coefficients, start=1)) \
-                    + np.random.normal(0, std_deviation)
-        
+        random_state = self.random_state if random_state is None else random_state
+        next_value = self.resting_heart_rate + random_state.normal(0, self.HEART_RATE_STD, n)
         # Ensure the next value stays within the specified bounds
-        next_value = min(max(next_value, lower_bound), upper_bound)
-        self.heart_rates_running.append(next_value)
-        self.heart_rates_running.pop()
-        return next_value
+        return np.clip(next_value, lower_bound, upper_bound)
+
+    def schedule(self, t, action):
+        '''
+        Give the inputs of a patient Action at time t (at or after the
+        current time) ahead of the step that takes them, e.g. a whole
+        scenario at once. The meal is announced at t, see InputTimeline.add.
+        '''
+        minute = self._minute(t)
+        if minute < self._minute(self.t):
+            raise ValueError('Inputs scheduled at t = {} before the current time {}'.format(t, self.t))
+        self._timeline.add(minute, action)
+
+    @property
+    def planned_meal(self):
+        '''
+        CHO (g) announced but not eaten yet
+        '''
+        return self._timeline.planned_meal(self._minute(self.t))
+
+    @property
+    def physical_activity_queue(self):
+        '''
+        Exercise heart rates of the coming minutes
+        '''
+        return self._timeline.exercise(self._minute(self.t))
 
     def step(self, action, reccomended_action):
-        curr_recc_action = self.reccomended_actions.get()
+        minute = self._minute(self.t)
+        # random chance to not carry out action
+        curr_recc_action = self.reccomended_actions.get(minute, self.prob)
         
         self.add_reccomended_action(reccomended_action)
-        # Convert announcing meal to the meal amount to eat at the moment
-        to_eat = self._announce_meal(action.CHO)
-        action = action._replace(CHO=to_eat)
-
-        heart_rate = self.simulate_running_heart_rate()
-        action = action._replace(physical=heart_rate)
+        # the inputs of the minute are read from the timeline, where meals
+        # are spread at EAT_RATE and exercise is laid out ahead of time
+        self._timeline.add(minute, action)
 
         if curr_recc_action != None:
-            random.seed(self.seed)
-            # random chance to not carry out action
-            if random.random() < self.prob:
-                if curr_recc_action.meal != 0:
-                    print(f"eating {curr_recc_action.meal}")
-                    to_eat = self._announce_meal(curr_recc_action.meal)
-                    action = action._replace(CHO=to_eat)
-                elif curr_recc_action.physical != 0:
-                    print("exercising")
-                    heartbeat = TrapezoidFunc(curr_recc_action.physical, 
-                                              curr_recc_action.times[0], 
-                                              curr_recc_action.times[1], 
-                                              curr_recc_action.times[2], 
-                                              curr_recc_action.times[3])
-                    action = action._replace(physical=heartbeat.pop(0) + action.physical)
-                    self.physical_activity_queue.extend(heartbeat)
-                if curr_recc_action.metformin != 0:
-                    action = action._replace(metformin=curr_recc_action.metformin)
-        physical_activity_heart_beat = 0
-        original_heart_beat = action.physical
-        if len(self.physical_activity_queue) != 0:
-            physical_activity_heart_beat = self.physical_activity_queue.pop(0)
-            action = action._replace(physical=physical_activity_heart_beat + action.physical)
+            if curr_recc_action.meal != 0:
+                print(f"eating {curr_recc_action.meal}")
+                self._timeline.announce_meal(minute, curr_recc_action.meal)
+            elif curr_recc_action.physical != 0:
+                print("exercising")
+                heartbeat = TrapezoidFunc(curr_recc_action.physical, 
+                                          curr_recc_action.times[0], 
+                                          curr_recc_action.times[1], 
+                                          curr_recc_action.times[2], 
+                                          curr_recc_action.times[3])
+                self._timeline.add_exercise(minute, heartbeat)
+            if curr_recc_action.metformin != 0:
+                self._timeline.set(minute, 'metformin', curr_recc_action.metformin)
+        to_eat, insulin_fast, insulin_long, metformin, vildagliptin, stress, physical_activity_heart_beat, onset, heart_rate = \
+            self._timeline.row(minute)
+        original_heart_beat = heart_rate + onset
+        action = Action(CHO=to_eat, insulin_fast=insulin_fast, insulin_long=insulin_long, metformin=metformin,
+                        vildagliptin=vildagliptin, stress=stress, physical=original_heart_beat + physical_activity_heart_beat)
 
         # Detect eating or not and update last digestion amount
         if action.CHO > 0 and self._last_action.CHO <= 0:
@@ -211,8 +274,21 @@ class T2DPatient(Patient):
         # Update last input
         self._last_action = action
 
-        # ODE solver
-        self._odesolver.set_f_params(action, self.basal, self.param, self)
+        # Inputs: boluses are state jumps applied between integration
+        # segments, the rest are piecewise constant arguments of a pure RHS
+        if self.integration == 'horizon':
+            # the resting heart rate is a slow input, see HORIZON_HEART_RATE_HOLD
+            self._inputs.add(self.t, action, action.physical - heart_rate +
+                             self._timeline.resting_mean(minute, self.HORIZON_HEART_RATE_HOLD))
+        else:
+            self._inputs.add(self.t, action)
+        doses = self._inputs.pop_doses(self.t)
+        if doses is not None:
+            self._odesolver.set_initial_value(apply_doses(self.state.copy(), doses), self.t)
+        # the horizon solver only restarts when these arguments change
+        self._odesolver.set_f_params(*self._inputs.rhs_inputs(self.t), self._compiled_params, self.quiescent_tol)
+        self._inputs.discard_before(self.t)
+        self._timeline.discard_before(minute)
         if self._odesolver.successful():
             self._odesolver.integrate(self._odesolver.t + self.sample_time)
         else:
@@ -222,39 +298,38 @@ class T2DPatient(Patient):
         return action._replace(physical=physical_activity_heart_beat), original_heart_beat
 
     @staticmethod
-    def model(t, x, action, basal, glucose_parameters, self):
-        t = round(t)
-        action = self._last_action
-        Dg = action.CHO * 1e3
-        long_insulin = action.insulin_long * 1e2
-        fast_insulin = action.insulin_fast * 1e2
-        # Doesn't seem to have an effect?
-        if long_insulin != 0 or fast_insulin != 0:
-            action = action._replace(insulin_long = 0)
-            action = action._replace(insulin_fast = 0)
-
-        metformin = action.metformin * 1e3
-        if metformin != 0:
-            action = action._replace(metformin = 0)
-
-        vildagliptin = action.vildagliptin * (1 / (303.406) * 10 ** 6)
-        physical = action.physical
-        stress = action.stress
-        if t == 0.0 and Dg == 0:
-            DM = 1.0
-        elif (Dg != 0):
-            DM = x[46] + Dg - x[47]
+    def model(t, x, Dg, stress, heart_rate, compiled_params, quiescent_tol=0):
+        '''
+        Pure RHS of the model, doses are applied to the state by step.
+        Inputs:
+            - Dg, stress, heart_rate: piecewise constant inputs of the segment
+            - compiled_params: the vector from compile_parameters
+            - quiescent_tol: tolerance for skipping idle submodels
+        '''
+        return compiled_rhs(t, x, compiled_params, Dg, stress, heart_rate, quiescent_tol)
+
+    @staticmethod
+    def jacobian(t, x, Dg, stress, heart_rate, compiled_params, quiescent_tol=0):
+        # the Jacobian does not depend on the heart rate
+        return compiled_jacobian(t, x, compiled_params, Dg, stress, 0)
+
+    def _create_solver(self):
+        if self.hybrid_pk:
+            propagator = LinearPropagator(linear_pk_matrix(self._compiled_params))
+            self._odesolver = HybridIntegrator(self.model, self.jacobian, LINEAR_PK_STATES, propagator, self._make_integrator)
         else:
-            DM = 0
-        indices = [0, 46, 47, 3, 4, 9, 17, 19]
-        values = [Dg, Dg, DM, metformin, metformin, vildagliptin, fast_insulin / 6.76, long_insulin / 6.76]
-
-        for index, value in zip(indices, values):
-            x[index] = value + x[index]
-        glucose_dynamics = GlucoseDynamics(t,x,Dg,stress,physical,basal,glucose_parameters)
-        dxdt = glucose_dynamics.compute()
-        self._last_action = action
-        return dxdt
+            self._odesolver = self._make_integrator(self.model, self.jacobian)
+
+    def _make_integrator(self, f, jac):
+        if self.integration == 'horizon':
+            method = 'LSODA' if self.solver == 'dopri5' else self.solver
+            return HorizonIntegrator(f, jac=jac, method=method)
+        if self.solver == 'dopri5':
+            return ode(f).set_integrator('dopri5')
+        return IVPIntegrator(f, jac=jac, method=self.solver)
+
+    def _minute(self, t):
+        return int(round((t - self.t0) / self.sample_time))
 
     @property
     def observation(self):
@@ -268,21 +343,56 @@ class T2DPatient(Patient):
         observation = Observation(Gsub=GM)
         return observation
 
-    def _announce_meal(self, meal):
+    def snapshot(self):
         '''
-        patient announces meal.
-        The announced meal will be added to self.planned_meal
-        The meal is consumed in self.EAT_RATE
-        The function will return the amount to eat at current time
+        Capture everything step depends on: the solver state and time, the
+        input schedule and timeline, the recommendation queue and the state
+        of the patient's RandomState that draws the heart rate noise.
+        Parameters are not copied, a snapshot can be restored into this
+        patient or any of its forks.
         '''
-        self.planned_meal += meal
-        if self.planned_meal > 0:
-            to_eat = min(self.EAT_RATE, self.planned_meal)
-            self.planned_meal -= to_eat
-            self.planned_meal = max(0, self.planned_meal)
-        else:
-            to_eat = 0
-        return to_eat
+        return PatientSnapshot(
+            t=self.t,
+            state=np.array(self.state, dtype=float),
+            inputs=self._inputs.copy(),
+            last_action=np.array(self._last_action, dtype=float),
+            is_eating=self.is_eating,
+            planned_meal=self.planned_meal,
+            last_foodtaken=self._last_foodtaken,
+            reccomended_actions=self.reccomended_actions.copy(),
+            timeline=self._timeline.copy(),
+            random_state=self.random_state.get_state())
+
+    def restore(self, snapshot):
+        '''
+        Return the patient to a PatientSnapshot. A horizon mode solver
+        restarts at the snapshot, so its results match an uninterrupted run
+        to the solver tolerance rather than exactly.
+        '''
+        self._odesolver.set_initial_value(snapshot.state, snapshot.t)
+        self._inputs = snapshot.inputs.copy()
+        self._last_action = Action(*snapshot.last_action.tolist())
+        self.is_eating = snapshot.is_eating
+        self._last_foodtaken = snapshot.last_foodtaken
+        self.reccomended_actions = snapshot.reccomended_actions.copy()
+        # a generator of its own, forks do not share draws
+        self.random_state = np.random.RandomState()
+        self.random_state.set_state(snapshot.random_state)
+        self._timeline = snapshot.timeline.copy()
+        self._timeline.resting_heart_rate = self.simulate_running_heart_rate
+        self._timeline.random_state = self.random_state
+
+    def fork(self, snapshot=None):
+        '''
+        Return an independent patient that continues from snapshot (the
+        current state by default) without re-running the initialization or
+        replaying the history.
+        '''
+        snapshot = self.snapshot() if snapshot is None else snapshot
+        other = copy.copy(self)
+        other._create_solver()
+        other.restore(snapshot)
+        return other
 
     @property
     def seed(self):
@@ -291,6 +401,7 @@ class T2DPatient(Patient):
     @seed.setter
     def seed(self, seed):
         self._seed = seed
+        self.reccomended_actions.seed = seed
         self.reset()
 
     def reset(self):
@@ -323,9 +434,16 @@ class T2DPatient(Patient):
        # self.name = self._params.Name
 
         ## should be fine but order is 4 (5) while other tested is order 5(4)
-        self._odesolver = ode(self.model).set_integrator('dopri5')
-        self._odesolver.set_initial_value(self.X0v, self.t0)
+        # parameters and basal rates are frozen into a flat vector for the RHS,
+        # changes to self.param take effect on the next reset
+        self._compiled_params = compile_parameters(self.param, self.basal)
+        self._timeline = InputTimeline(self.simulate_running_heart_rate, self.EAT_RATE, self.random_state)
+        self._create_solver()
+        X0 = np.array(self.X0v, dtype=float)
+        # the meal size state is seeded so the gastric emptying rate stays finite
+        X0[47] = X0[47] if X0[47] != 0 else 1.0
+        self._odesolver.set_initial_value(X0, self.t0)
+        self._inputs = InputSchedule(self.t0)
 
         self._last_action = Action(CHO=0, insulin_fast=0, insulin_long=0, metformin=0, vildagliptin=0, stress=0, physical=0)
         self.is_eating = False
-        self.planned_meal = 0
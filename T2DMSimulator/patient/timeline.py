@@ -0,0 +1,161 @@
+import numpy as np
+
+# columns of InputTimeline: the patient Action inputs of the minute, the
+# exercise heart rate reported back by T2DPatient.step, the extra heart rate
+# at the onset of an exercise and the resting heart rate
+TIMELINE_FIELDS = ['CHO', 'insulin_fast', 'insulin_long', 'metformin', 'vildagliptin', 'stress',
+                   'exercise', 'onset', 'resting']
+CHO, METFORMIN, EXERCISE, ONSET, RESTING = (TIMELINE_FIELDS.index(field) for field in
+                                            ('CHO', 'metformin', 'exercise', 'onset', 'resting'))
+
+
+class InputTimeline(object):
+    '''
+    Exogenous inputs of one patient per simulated minute, stored as one
+    contiguous (minutes, len(TIMELINE_FIELDS)) array so a step only reads a
+    row. Minutes count from the patient's t0.
+
+    Inputs are written ahead of time: meals are spread at eat_rate over the
+    minutes they take to eat when they are announced, exercise heart rate
+    profiles are laid out over the following minutes and the resting heart
+    rate is drawn a chunk of minutes at a time. The array grows by chunks
+    and drops the chunks that are behind the current minute. The resting
+    heart rate comes from random_state only, so a copy of the timeline
+    draws the same future chunks.
+    '''
+    CHUNK = 1440  # min
+
+    def __init__(self, resting_heart_rate, eat_rate, random_state, chunk=None):
+        '''
+        InputTimeline constructor.
+        Inputs:
+            - resting_heart_rate: function of n and a numpy RandomState
+              returning the next n resting heart rate samples drawn from it
+            - eat_rate: g/min CHO
+            - random_state: the numpy RandomState of the patient
+            - chunk: minutes added at a time, CHUNK by default
+        '''
+        self.resting_heart_rate = resting_heart_rate
+        self.eat_rate = eat_rate
+        self.random_state = random_state
+        self.chunk = self.CHUNK if chunk is None else chunk
+        self.start = 0  # minute of the first row
+        self.data = np.zeros((0, len(TIMELINE_FIELDS)))
+        self.exercise_end = 0  # minute after the last laid out exercise sample
+
+    @property
+    def end(self):
+        return self.start + len(self.data)
+
+    def row(self, minute):
+        '''
+        Inputs of minute as a list in TIMELINE_FIELDS order
+        '''
+        self._reserve(minute + 1)
+        return self.data[minute - self.start].tolist()
+
+    def resting(self, minute):
+        self._reserve(minute + 1)
+        return self.data[minute - self.start, RESTING]
+
+    def resting_mean(self, minute, block):
+        '''
+        Mean resting heart rate of the block of minutes (of length block,
+        counted from minute 0) that minute falls in
+        '''
+        first = minute - minute % block
+        self._reserve(first + block)
+        return float(self.data[first - self.start:first - self.start + block, RESTING].mean())
+
+    def add(self, minute, action):
+        '''
+        Add the inputs of a patient Action given at minute: the meal is
+        announced (see announce_meal), the doses and stress add to those
+        already scheduled. action.physical is ignored, the heart rate comes
+        from the resting heart rate and add_exercise.
+        '''
+        self.announce_meal(minute, action.CHO)
+        self._reserve(minute + 1)
+        i = minute - self.start
+        for j, field in enumerate(TIMELINE_FIELDS[CHO + 1:EXERCISE], start=CHO + 1):
+            value = getattr(action, field)
+            if value != 0:
+                self.data[i, j] += value
+
+    def set(self, minute, field, value):
+        self._reserve(minute + 1)
+        self.data[minute - self.start, TIMELINE_FIELDS.index(field)] = value
+
+    def announce_meal(self, minute, amount):
+        '''
+        Schedule eating amount g of CHO from minute on, as fast as eat_rate
+        allows next to the meals already scheduled. Meals are eaten in the
+        order they are announced, as with a single planned meal counter.
+        '''
+        if amount <= 0:
+            return
+        self._reserve(minute + 1)
+        i = minute - self.start
+        eaten = np.cumsum(self.eat_rate - self.data[i:, CHO])
+        while eaten[-1] < amount:
+            self._reserve(self.end + self.chunk)
+            eaten = np.cumsum(self.eat_rate - self.data[i:, CHO])
+        n = int(np.searchsorted(eaten, amount))
+        self.data[i:i + n, CHO] = self.eat_rate
+        self.data[i + n, CHO] += amount - (eaten[n - 1] if n else 0)
+
+    def planned_meal(self, minute):
+        '''
+        CHO (g) still to be eaten from minute on
+        '''
+        return float(self.data[max(minute - self.start, 0):, CHO].sum())
+
+    def add_exercise(self, minute, profile):
+        '''
+        Lay out an exercise heart rate profile (bpm over the resting heart
+        rate, one sample per minute) started at minute. The first sample is
+        added at minute, the rest follow the exercise already laid out.
+        '''
+        profile = np.asarray(profile, dtype=float)
+        if len(profile) == 0:
+            return
+        begin = max(self.exercise_end, minute)
+        self._reserve(max(minute + 1, begin + len(profile) - 1))
+        self.data[minute - self.start, ONSET] += profile[0]
+        self.data[begin - self.start:begin - self.start + len(profile) - 1, EXERCISE] += profile[1:]
+        self.exercise_end = begin + len(profile) - 1
+
+    def exercise(self, minute):
+        '''
+        Exercise heart rates laid out from minute on
+        '''
+        if minute >= self.exercise_end:
+            return []
+        return self.data[max(minute - self.start, 0):self.exercise_end - self.start, EXERCISE].tolist()
+
+    def discard_before(self, minute):
+        '''
+        Drop the whole chunks more than a chunk behind minute
+        '''
+        n = (minute - self.start) // self.chunk - 1
+        if n > 0:
+            self.data = self.data[n * self.chunk:].copy()
+            self.start += n * self.chunk
+
+    def copy(self):
+        other = InputTimeline.__new__(InputTimeline)
+        other.__dict__.update(self.__dict__)
+        other.data = self.data.copy()
+        other.random_state = np.random.RandomState()
+        other.random_state.set_state(self.random_state.get_state())
+        return other
+
+    def _reserve(self, end):
+        # grow the array to cover the minutes before end, drawing the
+        # resting heart rate of the new rows
+        if end <= self.end:
+            return
+        n = -(-(end - self.end) // self.chunk) * self.chunk
+        rows = np.zeros((n, len(TIMELINE_FIELDS)))
+        rows[:, RESTING] = self.resting_heart_rate(n, self.random_state)
+        self.data = np.concatenate([self.data, rows])
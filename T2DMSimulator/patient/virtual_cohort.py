@@ -0,0 +1,157 @@
+import logging
+import numpy as np
+from T2DMSimulator.glucose.compiled import parameter_index, PARAMETER_LAYOUT, N_PARAMETERS, N_GLUCOSE_PARAMETERS
+from T2DMSimulator.glucose.glucose_initializer import initialize_parameter_matrix
+from T2DMSimulator.glucose.jacobian import N_STATES
+from T2DMSimulator.patient.t2dpatient import DEFAULT_BRATES
+from T2DMSimulator.utils.glucose_params_subtypes import SUBTYPES
+
+logger = logging.getLogger(__name__)
+
+BRATE_KEYS = ['rBGU', 'rRBCU', 'rGGU', 'rPGU', 'rHGU']
+
+# coefficient of variation of the log-normal multiplier of each varied parameter
+DEFAULT_VARIATION = {
+    'glucoseMetabolicRates.c1': 0.2,
+    'glucoseMetabolicRates.c2': 0.2,
+    'glucoseMetabolicRates.c3': 0.2,
+    'glucoseMetabolicRates.c4': 0.2,
+    'glucoseMetabolicRates.c5': 0.2,
+    'pancreasModel.Ks': 0.25,
+    'pancreasModel.ml0': 0.2,
+    'glucoseAbsorptionSubmodel.kmin': 0.2,
+    'glucoseAbsorptionSubmodel.kmax': 0.2,
+    'glucoseAbsorptionSubmodel.kabs': 0.2,
+    'metforminSubmodel.vGWmax': 0.3,
+    'metforminSubmodel.vLmax': 0.3,
+    'metforminSubmodel.vPmax': 0.3,
+}
+
+# correlations of the multipliers' logs: the insulin action terms on
+# peripheral and hepatic uptake and production move together, as do the
+# gastric emptying rates and the metformin effects
+DEFAULT_CORRELATIONS = [
+    ('glucoseMetabolicRates.c1', 'glucoseMetabolicRates.c4', 0.6),
+    ('glucoseMetabolicRates.c2', 'glucoseMetabolicRates.c4', 0.4),
+    ('glucoseMetabolicRates.c1', 'glucoseMetabolicRates.c2', 0.3),
+    ('glucoseAbsorptionSubmodel.kmin', 'glucoseAbsorptionSubmodel.kmax', 0.5),
+    ('metforminSubmodel.vGWmax', 'metforminSubmodel.vLmax', 0.5),
+    ('metforminSubmodel.vGWmax', 'metforminSubmodel.vPmax', 0.5),
+    ('metforminSubmodel.vLmax', 'metforminSubmodel.vPmax', 0.5),
+]
+
+
+def virtual_patient_dtype():
+    '''
+    Row type of generate_virtual_cohort: the compiled parameter vector
+    (basal and derived entries filled) and initial state of each patient
+    '''
+    return np.dtype([('id', np.int64), ('subtype', 'U4'), ('GBPC0', np.float64), ('IBPF0', np.float64),
+                     ('brates', np.float64, (len(BRATE_KEYS),)), ('params', np.float64, (N_PARAMETERS,)),
+                     ('X0', np.float64, (N_STATES,))])
+
+
+class SubtypeDistribution(object):
+    '''
+    Virtual patients of one subtype: the subtype's GlucoseParameters with
+    each varied parameter multiplied by a mean one log-normal factor, the
+    factors' logs jointly normal with the given correlations, and a
+    log-normal fasting plasma glucose GBPC0.
+    '''
+    def __init__(self, glucose_params, brates=None, variation=None, correlations=None,
+                 GBPC0=7 / 0.0555, GBPC0_cv=0.1, IBPF0=1):
+        '''
+        SubtypeDistribution constructor.
+        Inputs:
+            - glucose_params: the subtype's GlucoseParameters
+            - brates: basal rates, the T2DPatient defaults if None
+            - variation: {parameter name: coefficient of variation},
+              DEFAULT_VARIATION if None
+            - correlations: list of (name, name, correlation),
+              DEFAULT_CORRELATIONS if None, pairs of parameters that are not
+              varied are ignored
+            - GBPC0, GBPC0_cv: mean and coefficient of variation of the
+              fasting plasma glucose (mg/dl)
+            - IBPF0: basal peripheral interstitial insulin
+        '''
+        self.center = np.array([getattr(getattr(glucose_params, submodel), name) for submodel, name in PARAMETER_LAYOUT])
+        self.brates = dict(DEFAULT_BRATES if brates is None else brates)
+        variation = DEFAULT_VARIATION if variation is None else variation
+        correlations = DEFAULT_CORRELATIONS if correlations is None else correlations
+        self.names = list(variation)
+        self.indices = np.array([parameter_index(name) for name in self.names], dtype=int)
+        if np.any(self.indices >= N_GLUCOSE_PARAMETERS):
+            raise ValueError('Only GlucoseParameters entries can be varied')
+        cv = np.array([variation[name] for name in self.names], dtype=float)
+        self.sigma = np.sqrt(np.log1p(cv ** 2))
+        self.correlation = np.eye(len(self.names))
+        for a, b, rho in correlations:
+            if a in variation and b in variation:
+                i, j = self.names.index(a), self.names.index(b)
+                self.correlation[i, j] = self.correlation[j, i] = rho
+        try:
+            self._cholesky = np.linalg.cholesky(self.correlation)
+        except np.linalg.LinAlgError:
+            raise ValueError('The parameter correlations are not positive definite')
+        self.GBPC0 = GBPC0
+        self.GBPC0_sigma = np.sqrt(np.log1p(GBPC0_cv ** 2))
+        self.IBPF0 = IBPF0
+
+    @classmethod
+    def subtype(cls, name, **kwargs):
+        '''
+        Distribution around a preset of glucose_params_subtypes.SUBTYPES
+        '''
+        glucose_params, brates = SUBTYPES[name]
+        return cls(glucose_params(), brates=kwargs.pop('brates', brates), **kwargs)
+
+    def sample(self, rows, rng):
+        '''
+        Fill the GlucoseParameters entries of rows['params'] and the
+        GBPC0, IBPF0 and brates fields with draws from rng, a numpy RandomState
+        '''
+        n = len(rows)
+        z = rng.standard_normal((n, len(self.names))) @ self._cholesky.T
+        params = np.tile(self.center, (n, 1))
+        params[:, self.indices] *= np.exp(self.sigma * z - self.sigma ** 2 / 2)
+        rows['params'][:, :N_GLUCOSE_PARAMETERS] = params
+        rows['GBPC0'] = self.GBPC0 * np.exp(self.GBPC0_sigma * rng.standard_normal(n) - self.GBPC0_sigma ** 2 / 2)
+        rows['IBPF0'] = self.IBPF0
+        rows['brates'] = [self.brates[key] for key in BRATE_KEYS]
+
+
+def generate_virtual_cohort(n, proportions=None, seed=None, distributions=None):
+    '''
+    Sample and initialize n virtual patients over the T2D subtypes.
+    Inputs:
+        - proportions: {subtype: weight}, equal weights of the
+          distributions' subtypes by default
+        - seed: seed of the single RandomState all draws come from
+        - distributions: {subtype: SubtypeDistribution}, by default
+          SubtypeDistribution.subtype of every SUBTYPES entry
+    Returns a structured array of virtual_patient_dtype, one row per patient,
+    whose params and X0 are ready for a batched engine (see
+    T2DCohort.from_virtual_cohort). Initial states come from a vectorized
+    GlucoseInitializer.
+    '''
+    distributions = {name: SubtypeDistribution.subtype(name) for name in SUBTYPES} if distributions is None else distributions
+    names = list(distributions) if proportions is None else list(proportions)
+    weights = np.ones(len(names)) if proportions is None else np.array([proportions[name] for name in names], dtype=float)
+    rng = np.random.RandomState(seed)
+
+    cohort = np.zeros(n, dtype=virtual_patient_dtype())
+    cohort['id'] = np.arange(n)
+    subtype = rng.choice(len(names), size=n, p=weights / weights.sum())
+    for k, name in enumerate(names):
+        rows = np.flatnonzero(subtype == k)
+        cohort['subtype'][rows] = name
+        block = cohort[rows]
+        distributions[name].sample(block, rng)
+        cohort[rows] = block
+
+    brates = {key: cohort['brates'][:, i] for i, key in enumerate(BRATE_KEYS)}
+    cohort['X0'] = initialize_parameter_matrix(cohort['params'], cohort['GBPC0'], cohort['IBPF0'], brates)
+    invalid = ~np.all(np.isfinite(cohort['params']), axis=1) | ~np.all(np.isfinite(cohort['X0']), axis=1)
+    if np.any(invalid):
+        logger.warning('{} virtual patients have non finite parameters or initial states'.format(invalid.sum()))
+    return cohort
@@ -1,6 +1,7 @@
 # from .noise_gen import CGMNoiseGenerator
 from .noise_gen import CGMNoise
 import pandas as pd
+import copy
 import logging
 import pkg_resources
 
@@ -35,6 +36,26 @@ class CGMSensor(object):
         # Zero-Order Hold
         return self._last_CGM
 
+    def snapshot(self):
+        '''
+        Return the noise sequence position and last reading for restore
+        '''
+        return self._noise_generator.get_state(), self._last_CGM
+
+    def restore(self, snapshot):
+        noise_state, self._last_CGM = snapshot
+        self._noise_generator.set_state(noise_state)
+
+    def fork(self, snapshot=None):
+        '''
+        Return an independent sensor continuing from snapshot
+        '''
+        snapshot = self.snapshot() if snapshot is None else snapshot
+        other = copy.copy(self)
+        other._noise_generator = CGMNoise(self._params, seed=self.seed)
+        other.restore(snapshot)
+        return other
+
     @property
     def seed(self):
         return self._seed
@@ -55,6 +55,17 @@ class CGMNoise(object):
 
         return noise2return
 
+    def get_state(self):
+        '''
+        Return the position of the noise sequence as (arrays, scalars)
+        '''
+        return (np.array(self.noise), self._noise_init, self.count) + self._noise15_gen.get_state()
+
+    def set_state(self, state):
+        noise, self._noise_init, self.count = state[:3]
+        self.noise = deque(noise.tolist())
+        self._noise15_gen.set_state(state[3:])
+
     def __iter__(self):
         return self
 
@@ -78,6 +89,14 @@ class noise15_iter:
         self.e = 0
         self.count = 0
 
+    def get_state(self):
+        return self.rand_gen.get_state(), self.e, self.count
+
+    def set_state(self, state):
+        random_state, self.e, self.count = state
+        self.rand_gen = np.random.RandomState()
+        self.rand_gen.set_state(random_state)
+
     def __iter__(self):
         return self
 
@@ -94,4 +113,68 @@ class noise15_iter:
                                    self._params["delta"],
                                    self.e)
         self.count += 1
-        return eps
\ No newline at end of file
+        return eps
+
+
+class VectorCGMNoise(object):
+    '''
+    CGMNoise of n sensors at once: the AR(1) noise in the Johnson SU
+    transform every 15 minutes, cubic interpolated to the sample times of
+    the sensor. Every sensor draws PRECOMPUTE 15 minute knots at a time
+    from one shared numpy Generator (or RandomState) rng.
+    '''
+    PRECOMPUTE = CGMNoise.PRECOMPUTE
+    MDL_SAMPLE_TIME = CGMNoise.MDL_SAMPLE_TIME
+
+    def __init__(self, params, n, rng):
+        self._params = params
+        self.n = n
+        self.rng = rng
+        self._t15 = np.arange(self.PRECOMPUTE + 1) * self.MDL_SAMPLE_TIME
+        nsample = int(math.floor(self.PRECOMPUTE * self.MDL_SAMPLE_TIME / params["sample_time"])) + 1
+        self._t = np.arange(nsample) * params["sample_time"]
+        self.noise = np.zeros((n, nsample - 1))
+        self.position = np.zeros(n, dtype=int)
+        self._e = np.zeros(n)
+        self._knot = np.zeros(n)
+        self.reset(np.ones(n, dtype=bool))
+
+    def reset(self, rows):
+        '''
+        Restart the noise sequences of the sensors in the (n,) mask rows
+        '''
+        self._e[rows] = self.rng.standard_normal(np.count_nonzero(rows))
+        self._knot[rows] = self._transform(self._e[rows])
+        # the restarted rows draw a new sequence on the next call
+        self.position[rows] = self.noise.shape[1]
+
+    def __call__(self, rows=None):
+        '''
+        The next noise sample of every sensor, or of the sensors in the (n,)
+        mask rows only
+        '''
+        rows = np.ones(self.n, dtype=bool) if rows is None else rows
+        used_up = rows & (self.position >= self.noise.shape[1])
+        if np.any(used_up):
+            self._extend(used_up)
+        value = self.noise[rows, self.position[rows]]
+        self.position[rows] += 1
+        return value
+
+    def _extend(self, rows):
+        # a new sequence for the rows that used theirs up, continuous with
+        # their last knot as in CGMNoise._get_noise_seq
+        e = self._e[rows]
+        knots = np.empty((len(e), self.PRECOMPUTE + 1))
+        knots[:, 0] = self._knot[rows]
+        for k in range(1, self.PRECOMPUTE + 1):
+            e = self._params["PACF"] * (e + self.rng.standard_normal(len(e)))
+            knots[:, k] = self._transform(e)
+        self._e[rows] = e
+        self._knot[rows] = knots[:, -1]
+        self.noise[rows] = interp1d(self._t15, knots, kind='cubic', axis=1)(self._t)[:, 1:]
+        self.position[rows] = 0
+
+    def _transform(self, e):
+        return johnson_transform_SU(self._params["xi"], self._params["lambda"], self._params["gamma"],
+                                    self._params["delta"], e)
@@ -3,13 +3,15 @@ from T2DMSimulator.sensor.cgm import CGMSensor
 from T2DMSimulator.simulation.scenario import CustomScenario
 from T2DMSimulator.utils.glucose_params_subtypes import get_mard_params
 from ..patient.t2dpatient import Action, T2DPatient
-from ..analysis.risk import risk_index
+from ..analysis.risk import risk_index, risk_array
 import pandas as pd
-from datetime import timedelta
+from datetime import datetime, timedelta
 import logging
 from collections import namedtuple
 from ..simulation.rendering import Viewer
+from ..simulation.history import History, Downsampler
 import numpy as np
+import copy
 
 try:
     from rllab.envs.base import Step
@@ -26,6 +28,13 @@ except ImportError:
 
 
 Observation = namedtuple("Observation", ["CGM"])
+EnvSnapshot = namedtuple("EnvSnapshot", ["patient", "sensor", "scenario", "history_length", "accumulators"])
+# per sample arrays of step_n and run_until, named as the Step results
+MACRO_STEP_FIELDS = ["time", "observation", "reward", "done", "meal", "bg", "lbgi", "hbgi", "risk"]
+MacroStep = namedtuple("MacroStep", MACRO_STEP_FIELDS + ["patient_state"])
+# history columns of the former per field lists, see T2DSimEnv.history
+HISTORY_FIELDS = {"BG_hist": "BG", "CGM_hist": "CGM", "risk_hist": "risk", "LBGI_hist": "LBGI", "HBGI_hist": "HBGI",
+                  "BPM_hist": "BPM", "CHO_hist": "CHO", "insulin_hist": "insulin", "action_hist": "actions"}
 logger = logging.getLogger(__name__)
 
 def add_tuples(t1, t2):
@@ -41,14 +50,11 @@ def risk_diff(BG_last_hour):
     if len(BG_last_hour) < 2:
         return 0
     else:
-        _, _, risk_current = risk_index([BG_last_hour[-1]], 1)
-        _, _, risk_prev = risk_index([BG_last_hour[-2]], 1)
+        _, _, (risk_prev, risk_current) = risk_array(BG_last_hour[-2:])
         return risk_prev - risk_current
 
 
 def create_month_scenario():
-    from datetime import timedelta
-    from datetime import datetime
     now = datetime.now()
     start_time = datetime.combine(now.date(), datetime.min.time())
     scen = []
@@ -58,11 +64,21 @@ def create_month_scenario():
     return scenario
 
 class T2DSimEnv(object):
-    def __init__(self, patient=T2DPatient({},glucose_params=get_mard_params(), name="MARD"), sensor=CGMSensor.withName('Dexcom', seed=1), pump=InsulinPump.withName('Insulet'), scenario=create_month_scenario()):
+    def __init__(self, patient=T2DPatient({},glucose_params=get_mard_params(), name="MARD"), sensor=CGMSensor.withName('Dexcom', seed=1), pump=InsulinPump.withName('Insulet'), scenario=create_month_scenario(), accumulators=None):
+        '''
+        T2DSimEnv constructor.
+        Inputs:
+            - accumulators: analysis.accumulators Accumulator instances
+              updated with every sample (restarted on reset), e.g.
+              accumulators.default_accumulators(), read with metrics()
+        '''
         self.patient = patient
         self.sensor = sensor
         self.pump = pump
         self.scenario = scenario
+        self.sink = None
+        self.tiers = ()
+        self.accumulators = [] if accumulators is None else list(accumulators)
         self._reset()
 
     @property
@@ -92,6 +108,83 @@ class T2DSimEnv(object):
         """
         action is a namedtuple with keys: basal, bolus
         """
+        CGM, reward, done, CHO, BG, LBGI, HBGI, risk = self._sample(action, reward_fun)
+        obs = Observation(CGM=CGM)
+
+        return Step(
+            observation=obs,
+            reward=reward,
+            done=done,
+            sample_time=self.sample_time,
+            patient_name=self.patient.name,
+            meal=CHO,
+            patient_state=self.patient.state,
+            time=self.time,
+            bg=BG,
+            lbgi=LBGI,
+            hbgi=HBGI,
+            risk=risk,
+        )
+
+    def step_n(self, action, n, reward_fun=risk_diff):
+        '''
+        Hold action for n sensor samples, or until the episode is done,
+        without building a Step per sample.
+        Returns a MacroStep of the arrays of every sample taken (the
+        step results of each sample stacked) and the state at the last one.
+        '''
+        results = np.empty((n, len(MACRO_STEP_FIELDS)))
+        taken, _ = self._run(action, results, lambda: False, reward_fun)
+        return self._macro_step(results[:taken])
+
+    def run_until(self, until, action, reward_fun=risk_diff, max_samples=None):
+        '''
+        Hold action until until, or until the episode is done or
+        max_samples were taken.
+        Inputs:
+            - until: a datetime to simulate up to, a timedelta to simulate
+              for, or a function of the env called after every sample that
+              returns True to stop
+        Returns a MacroStep as step_n.
+        '''
+        if isinstance(until, timedelta):
+            until = self.time + until
+        if isinstance(until, datetime):
+            n = max(int(np.ceil((until - self.time) / timedelta(minutes=self.sample_time))), 0)
+            return self.step_n(action, n if max_samples is None else min(n, max_samples), reward_fun)
+        # the number of samples is not known ahead, they are taken a day at a time
+        chunk = int(24 * 60 / self.sample_time)
+        blocks = []
+        taken = 0
+        stopped = False
+        while not stopped and (max_samples is None or taken < max_samples):
+            size = chunk if max_samples is None else min(chunk, max_samples - taken)
+            block = np.empty((size, len(MACRO_STEP_FIELDS)))
+            n, stopped = self._run(action, block, lambda: until(self), reward_fun)
+            blocks.append(block[:n])
+            taken += n
+        return self._macro_step(np.concatenate(blocks) if blocks else np.empty((0, len(MACRO_STEP_FIELDS))))
+
+    def _run(self, action, results, stop, reward_fun):
+        # fill the rows of results with MACRO_STEP_FIELDS, one per sample,
+        # until stop() or the episode is done; returns the rows filled and
+        # whether it stopped before filling them all
+        for i in range(len(results)):
+            CGM, reward, done, CHO, BG, LBGI, HBGI, risk = self._sample(action, reward_fun)
+            results[i] = (self.patient.t, CGM, reward, done, CHO, BG, LBGI, HBGI, risk)
+            if done or stop():
+                return i + 1, True
+        return len(results), False
+
+    def _macro_step(self, results):
+        columns = dict(zip(MACRO_STEP_FIELDS, results.T))
+        columns['time'] = (self.scenario.start_time + pd.to_timedelta(columns['time'], unit='min')).to_numpy()
+        columns['done'] = columns['done'].astype(bool)
+        return MacroStep(patient_state=self.patient.state, **columns)
+
+    def _sample(self, action, reward_fun):
+        # advance one sensor sample, record it in the history and return
+        # (CGM, reward, done, CHO, BG, LBGI, HBGI, risk)
         CHO = 0.0
         insulin = 0.0
         BG = 0.0
@@ -114,40 +207,21 @@ class T2DSimEnv(object):
         LBGI, HBGI, risk = risk_index([BG], horizon)
 
         # Record current action
-        self.CHO_hist.append(CHO)
-        self.insulin_hist.append(insulin)
+        self.history.set_last(CHO=CHO, insulin=insulin, BPM=heart_beat,
+                              actions=(merged_taken_action.CHO, merged_taken_action.insulin_fast, merged_taken_action.insulin_long,
+                                       merged_taken_action.metformin, merged_taken_action.physical, merged_taken_action.stress,
+                                       merged_taken_action.vildagliptin))
 
         # Record next observation
-        self.time_hist.append(self.time)
-        self.BG_hist.append(BG)
-        self.CGM_hist.append(CGM)
-        self.risk_hist.append(risk)
-        self.LBGI_hist.append(LBGI)
-        self.HBGI_hist.append(HBGI)
-        self.BPM_hist.append(heart_beat)
-        self.action_hist.append(np.array([merged_taken_action.CHO, merged_taken_action.insulin_fast, merged_taken_action.insulin_long, merged_taken_action.metformin, merged_taken_action.physical, merged_taken_action.stress, merged_taken_action.vildagliptin], dtype=np.float32))
+        self.history.append(time=self.patient.t, BG=BG, CGM=CGM, risk=risk, LBGI=LBGI, HBGI=HBGI)
+        self._accumulate(BG=BG, CGM=CGM, CHO=CHO, insulin=insulin, LBGI=LBGI, HBGI=HBGI, risk=risk)
 
         # Compute reward, and decide whether game is over
         window_size = int(60 / self.sample_time)
         BG_last_hour = self.CGM_hist[-window_size:]
         reward = reward_fun(BG_last_hour)
         done = BG < 10 or BG > 600
-        obs = Observation(CGM=CGM)
-
-        return Step(
-            observation=obs,
-            reward=reward,
-            done=done,
-            sample_time=self.sample_time,
-            patient_name=self.patient.name,
-            meal=CHO,
-            patient_state=self.patient.state,
-            time=self.time,
-            bg=BG,
-            lbgi=LBGI,
-            hbgi=HBGI,
-            risk=risk,
-        )
+        return CGM, reward, done, CHO, BG, LBGI, HBGI, risk
 
     def _reset(self):
         self.sample_time = self.sensor.sample_time
@@ -157,16 +231,28 @@ class T2DSimEnv(object):
         horizon = 1
         LBGI, HBGI, risk = risk_index([BG], horizon)
         CGM = self.sensor.measure(self.patient)
-        self.time_hist = [self.scenario.start_time]
-        self.BG_hist = [BG]
-        self.CGM_hist = [CGM]
-        self.risk_hist = [risk]
-        self.LBGI_hist = [LBGI]
-        self.HBGI_hist = [HBGI]
-        self.BPM_hist = []
-        self.CHO_hist = []
-        self.insulin_hist = []
-        self.action_hist = []
+        if 'history' in self.__dict__:
+            self.history.finish()
+        self.history = self._new_history()
+        self.history.append(time=self.patient.t, BG=BG, CGM=CGM, risk=risk, LBGI=LBGI, HBGI=HBGI)
+        for accumulator in self.accumulators:
+            accumulator.reset()
+        # the inputs leading to the first observation are not known
+        self._accumulate(BG=BG, CGM=CGM, CHO=np.nan, insulin=np.nan, LBGI=LBGI, HBGI=HBGI, risk=risk)
+
+    def _accumulate(self, **values):
+        if self.accumulators:
+            start = self.scenario.start_time
+            values.update(time=self.patient.t, sample_time=self.sample_time,
+                          time_of_day=(start.hour * 60 + start.minute + self.patient.t) % (24 * 60))
+            for accumulator in self.accumulators:
+                accumulator.add(values)
+
+    def metrics(self):
+        '''
+        Value of every accumulator so far, {accumulator name: value}
+        '''
+        return {accumulator.name: accumulator.value() for accumulator in self.accumulators}
 
     def reset(self):
         self.patient.reset()
@@ -191,6 +277,54 @@ class T2DSimEnv(object):
             risk=self.risk_hist[0],
         )
 
+    def snapshot(self):
+        '''
+        Capture the patient (see T2DPatient.snapshot), sensor noise and
+        scenario state, the accumulators plus the length of the history. The
+        history itself is not copied: restore truncates it back to that
+        length.
+        '''
+        return EnvSnapshot(patient=self.patient.snapshot(),
+                           sensor=self.sensor.snapshot(),
+                           scenario=self.scenario.snapshot(),
+                           history_length=len(self.history),
+                           accumulators=copy.deepcopy(self.accumulators))
+
+    def restore(self, snapshot):
+        '''
+        Return to an EnvSnapshot taken on this env (or the env it was forked
+        from) at a time its history still reaches
+        '''
+        if len(self.history) < snapshot.history_length:
+            raise ValueError('History is shorter than the snapshot, it was taken on another branch')
+        self.patient.restore(snapshot.patient)
+        self.sensor.restore(snapshot.sensor)
+        self.scenario.restore(snapshot.scenario)
+        self.history.truncate(snapshot.history_length)
+        # copies, so the snapshot can be restored again
+        self.accumulators = copy.deepcopy(snapshot.accumulators)
+        # the inputs taken from the snapshot on are not known yet
+        self.history.set_last(CHO=np.nan, insulin=np.nan, BPM=np.nan, actions=np.nan)
+
+    def fork(self, snapshot=None):
+        '''
+        Return an independent env continuing from snapshot (the current
+        state by default), for evaluating a candidate action sequence
+        without replaying the simulation from the start
+        '''
+        snapshot = self.snapshot() if snapshot is None else snapshot
+        other = copy.copy(self)
+        other.patient = self.patient.fork(snapshot.patient)
+        other.sensor = self.sensor.fork(snapshot.sensor)
+        # scenarios restore into fresh objects, a shallow copy does not share state
+        other.scenario = copy.copy(self.scenario)
+        other.viewer = None
+        # forks keep their history in memory
+        other.sink = None
+        other.history = self.history.copy()
+        other.restore(snapshot)
+        return other
+
     def render(self, close=False):
         if close:
             self._close_viewer()
@@ -206,17 +340,51 @@ class T2DSimEnv(object):
             self.viewer.close()
             self.viewer = None
 
+    def stream(self, sink, tiers=(15, 24 * 60), chunk=4096):
+        '''
+        Write the history to sink from now on (and after resets) and keep
+        only its latest chunk to two chunks of samples in memory, see
+        History.
+        Inputs:
+            - sink: e.g. history.NpzSink(directory) or ParquetSink(directory)
+            - tiers: bin lengths (min) of the downsampled aggregates also
+              written to the sink, see history.Downsampler
+            - chunk: samples written at a time, at least the longest
+              window a reward function looks back over
+        '''
+        self.sink = sink
+        self.tiers = tuple(tiers)
+        self._chunk = chunk
+        history = self._new_history()
+        for i in range(len(self.history)):
+            history.append(**{name: self.history[name][i] for name in history.names})
+        self.history = history
+
+    def close(self):
+        '''
+        Write the rest of a streamed history, close its sink and the viewer
+        '''
+        self.history.finish()
+        if self.sink is not None:
+            self.sink.close()
+        self._close_viewer()
+
+    def _new_history(self):
+        if self.sink is None:
+            return History()
+        return History(chunk=self._chunk, sink=self.sink, tiers=[Downsampler(minutes) for minutes in self.tiers])
+
+    @property
+    def time_hist(self):
+        return list(self.scenario.start_time + pd.to_timedelta(self.history['time'], unit='min'))
+
+    def __getattr__(self, name):
+        # read-only views of the history columns under their former list names
+        if name in HISTORY_FIELDS and 'history' in self.__dict__:
+            column = self.history[HISTORY_FIELDS[name]]
+            # the inputs of the last observation are not taken yet
+            return column if name in ('BG_hist', 'CGM_hist', 'risk_hist', 'LBGI_hist', 'HBGI_hist') else column[:-1]
+        raise AttributeError(name)
+
     def show_history(self):
-        df = pd.DataFrame()
-        df["Time"] = pd.Series(self.time_hist)
-        df["BG"] = pd.Series(self.BG_hist)
-        df["CGM"] = pd.Series(self.CGM_hist)
-        df["CHO"] = pd.Series(self.CHO_hist)
-        df["insulin"] = pd.Series(self.insulin_hist)
-        df["LBGI"] = pd.Series(self.LBGI_hist)
-        df["HBGI"] = pd.Series(self.HBGI_hist)
-        df["BPM"] = pd.Series(self.BPM_hist)
-        df["Risk"] = pd.Series(self.risk_hist)
-        df["actions"] = pd.Series(self.action_hist)
-        df = df.set_index("Time")
-        return df
\ No newline at end of file
+        return self.history.to_dataframe(self.scenario.start_time)
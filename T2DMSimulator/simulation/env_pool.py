@@ -0,0 +1,257 @@
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from datetime import timedelta
+import traceback
+import logging
+from T2DMSimulator.simulation.env import Observation
+from T2DMSimulator.controller.base import Action
+from T2DMSimulator.glucose.jacobian import N_STATES
+
+logger = logging.getLogger(__name__)
+
+# shared arrays of EnvPool, one row per env: the Step results of
+# T2DSimEnv.step and reset, time is the patient's minute (Step info time is
+# the scenario start time plus it)
+POOL_SCHEMA = [
+    ('CGM', np.float64, ()),
+    ('reward', np.float64, ()),
+    ('done', np.bool_, ()),
+    ('time', np.float64, ()),
+    ('bg', np.float64, ()),
+    ('lbgi', np.float64, ()),
+    ('hbgi', np.float64, ()),
+    ('risk', np.float64, ()),
+    ('meal', np.float64, ()),
+    ('patient_state', np.float64, (N_STATES,)),
+]
+# Step info keys that do not change during an episode, sent on reset
+EPISODE_INFO = ('patient_name', 'sample_time', 'start_time')
+
+
+class EnvPool(object):
+    '''
+    T2DSimEnv instances stepped in worker processes, one env per worker,
+    for per-patient controllers that stay Python objects in the parent.
+
+    Workers write the observation, reward, done flag and info of every step
+    into POOL_SCHEMA arrays in multiprocessing.shared_memory, so the pipes
+    only carry the actions and a short reply instead of pickled Step
+    namedtuples with their info and patient state. step_async sends the
+    actions without waiting, so the controllers of the next step can run
+    while the envs are stepped.
+    '''
+
+    def __init__(self, env_fns, context=None):
+        '''
+        EnvPool constructor.
+        Inputs:
+            - env_fns: one function per env returning a T2DSimEnv, called
+              in the worker (it must pickle unless the start method is
+              fork)
+            - context: multiprocessing start method, the platform's default
+              by default
+        '''
+        ctx = mp.get_context(context)
+        self.n = len(env_fns)
+        self._shm = {}
+        self.buffers = {}
+        for name, dtype, shape in POOL_SCHEMA:
+            size = max(int(np.prod((self.n,) + shape)) * np.dtype(dtype).itemsize, 1)
+            self._shm[name] = shared_memory.SharedMemory(create=True, size=size)
+            self.buffers[name] = np.ndarray((self.n,) + shape, dtype=dtype, buffer=self._shm[name].buf)
+        self.episode_info = [None] * self.n
+        self._waiting = []
+        self._pipes = []
+        self._processes = []
+        for index, env_fn in enumerate(env_fns):
+            parent_pipe, child_pipe = ctx.Pipe()
+            process = ctx.Process(target=_worker, args=(index, self.n, env_fn, child_pipe, parent_pipe,
+                                                        {name: shm.name for name, shm in self._shm.items()}),
+                                  daemon=True)
+            process.start()
+            child_pipe.close()
+            self._pipes.append(parent_pipe)
+            self._processes.append(process)
+        self.closed = False
+
+    def reset(self, indices=None, copy=True):
+        '''
+        Reset the envs (those in indices only if it is given) and return the
+        results of all envs as step_wait does
+        '''
+        indices = self._indices(indices)
+        self._send('reset', [None] * len(indices), indices)
+        for i, info in zip(indices, self._receive()):
+            self.episode_info[i] = info
+        return self._results(copy)
+
+    def step_async(self, actions, indices=None):
+        '''
+        Send the controller actions (one per env in indices, every env by
+        default) to the workers and return at once
+        '''
+        indices = self._indices(indices)
+        if len(actions) != len(indices):
+            raise ValueError('{} actions for {} envs'.format(len(actions), len(indices)))
+        # controller Actions do not pickle under their type name, they are
+        # sent as tuples
+        self._send('step', [tuple(action) for action in actions], indices)
+
+    def step_wait(self, copy=True):
+        '''
+        Wait for the envs stepped by step_async.
+        Returns the (n,) CGM observations, rewards and done flags and a dict
+        of the info arrays of every env (those not stepped keep their last
+        values), copies of the shared arrays unless copy is False (the views
+        are overwritten by the next step)
+        '''
+        self._receive()
+        return self._results(copy)
+
+    def step(self, actions, indices=None, copy=True):
+        self.step_async(actions, indices)
+        return self.step_wait(copy)
+
+    def observation(self, i):
+        '''
+        Observation of env i, as returned by T2DSimEnv.step
+        '''
+        return Observation(CGM=float(self.buffers['CGM'][i]))
+
+    def info(self, i):
+        '''
+        Step info of env i, e.g. for controller.policy(observation, reward,
+        done, **info)
+        '''
+        info = dict(self.episode_info[i])
+        info['time'] = info.pop('start_time') + timedelta(minutes=float(self.buffers['time'][i]))
+        info['patient_state'] = self.buffers['patient_state'][i].copy()
+        for name in ('meal', 'bg', 'lbgi', 'hbgi', 'risk'):
+            info[name] = float(self.buffers[name][i])
+        return info
+
+    def call(self, name, *args, indices=None, **kwargs):
+        '''
+        Call method name of the envs (or get attribute name if it is not
+        callable), e.g. call('show_history') at the end of a simulation.
+        Returns the pickled results, one per env in indices.
+        '''
+        indices = self._indices(indices)
+        self._send('call', [(name, args, kwargs)] * len(indices), indices)
+        return self._receive()
+
+    def close(self):
+        '''
+        Close the envs, stop the workers and free the shared arrays
+        '''
+        if self.closed:
+            return
+        if self._waiting:
+            self._receive()
+        for pipe, process in zip(self._pipes, self._processes):
+            if process.is_alive():
+                try:
+                    pipe.send(('close', None))
+                    pipe.recv()
+                except (EOFError, OSError, BrokenPipeError):
+                    pass
+            process.join()
+            pipe.close()
+        self.buffers = {}
+        for shm in self._shm.values():
+            shm.close()
+            shm.unlink()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        if not getattr(self, 'closed', True):
+            self.close()
+
+    def _indices(self, indices):
+        return list(range(self.n)) if indices is None else list(indices)
+
+    def _send(self, command, data, indices):
+        if self.closed:
+            raise RuntimeError('The pool is closed')
+        if self._waiting:
+            raise RuntimeError('Waiting for a previous call, see step_wait')
+        for i, value in zip(indices, data):
+            self._pipes[i].send((command, value))
+        self._waiting = indices
+
+    def _receive(self):
+        indices, self._waiting = self._waiting, []
+        replies = [self._pipes[i].recv() for i in indices]
+        errors = ['env {}: {}'.format(i, value) for i, (ok, value) in zip(indices, replies) if not ok]
+        if errors:
+            raise RuntimeError('Worker error\n' + '\n'.join(errors))
+        return [value for _, value in replies]
+
+    def _results(self, copy):
+        buffers = {name: value.copy() for name, value in self.buffers.items()} if copy else self.buffers
+        info = {name: buffers[name] for name in ('time', 'bg', 'lbgi', 'hbgi', 'risk', 'meal', 'patient_state')}
+        return buffers['CGM'], buffers['reward'], buffers['done'], info
+
+
+def _worker(index, n, env_fn, pipe, parent_pipe, shm_names):
+    parent_pipe.close()
+    shms = {name: shared_memory.SharedMemory(name=shm_name) for name, shm_name in shm_names.items()}
+    buffers = {name: np.ndarray((n,) + shape, dtype=dtype, buffer=shms[name].buf)[index:index + 1]
+               for name, dtype, shape in POOL_SCHEMA}
+    env, error = None, None
+    try:
+        env = env_fn()
+    except Exception:
+        # reported on every command but close
+        error = traceback.format_exc()
+    try:
+        while True:
+            command, data = pipe.recv()
+            if command == 'close':
+                if env is not None:
+                    env.close()
+                pipe.send((True, None))
+                break
+            if error is not None:
+                pipe.send((False, error))
+                continue
+            try:
+                if command == 'step':
+                    _write(buffers, env, env.step(Action(*data)))
+                    pipe.send((True, None))
+                elif command == 'reset':
+                    step = env.reset()
+                    _write(buffers, env, step)
+                    info = {key: step.info[key] for key in EPISODE_INFO if key in step.info}
+                    info['start_time'] = env.scenario.start_time
+                    pipe.send((True, info))
+                elif command == 'call':
+                    name, args, kwargs = data
+                    value = getattr(env, name)
+                    pipe.send((True, value(*args, **kwargs) if callable(value) else value))
+                else:
+                    raise ValueError('Unknown command {}'.format(command))
+            except Exception:
+                pipe.send((False, traceback.format_exc()))
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        del buffers
+        for shm in shms.values():
+            shm.close()
+
+
+def _write(buffers, env, step):
+    buffers['CGM'][0] = step.observation.CGM
+    buffers['reward'][0] = step.reward
+    buffers['done'][0] = step.done
+    buffers['time'][0] = env.patient.t
+    for name in ('bg', 'lbgi', 'hbgi', 'risk', 'meal', 'patient_state'):
+        buffers[name][0] = step.info[name]
@@ -0,0 +1,371 @@
+import glob
+import os
+import numpy as np
+import pandas as pd
+
+pyarrow = True
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pyarrow = False
+
+# (name, dtype, shape) of the T2DSimEnv history columns. time is in minutes
+# since the scenario start, BG to HBGI are observed at that time and BPM to
+# actions are the inputs taken from it until the next row
+ENV_HISTORY_SCHEMA = [
+    ('time', np.float64, ()),
+    ('BG', np.float64, ()),
+    ('CGM', np.float64, ()),
+    ('risk', np.float64, ()),
+    ('LBGI', np.float64, ()),
+    ('HBGI', np.float64, ()),
+    ('BPM', np.float64, ()),
+    ('CHO', np.float64, ()),
+    ('insulin', np.float64, ()),
+    ('actions', np.float32, (7,)),
+]
+# show_history column of each schema field
+DATAFRAME_COLUMNS = {'BG': 'BG', 'CGM': 'CGM', 'CHO': 'CHO', 'insulin': 'insulin', 'LBGI': 'LBGI', 'HBGI': 'HBGI',
+                     'BPM': 'BPM', 'risk': 'Risk', 'actions': 'actions'}
+HISTORY_TABLE = 'history'
+
+
+class History(object):
+    '''
+    Growable columnar record of a simulation with a fixed schema. Rows are
+    written into preallocated NumPy chunks of chunk rows, so recording a
+    step allocates nothing. Fields not given when a row is appended are NaN
+    until they are set.
+
+    column returns a view of a field, the chunks are joined into one block
+    the first time they are read and later chunks are joined onto it, so
+    reading the history as it grows stays cheap.
+
+    With a sink the history streams: it keeps between one and two chunks
+    of the latest rows in one block and writes the older chunk to the sink
+    (table HISTORY_TABLE) when the block fills, so memory stays flat
+    however long the simulation runs. column then only reaches back over
+    the rows in memory, at least chunk rows once the first chunk is
+    written. Each tier (see Downsampler) gets the written rows as well.
+    '''
+    def __init__(self, schema=None, chunk=4096, sink=None, tiers=()):
+        '''
+        History constructor.
+        Inputs:
+            - schema: list of (name, dtype, shape), ENV_HISTORY_SCHEMA by default
+            - chunk: rows allocated at a time
+            - sink: NpzSink, ParquetSink or any object with write(table,
+              columns) and close(), None keeps every row in memory
+            - tiers: Downsampler aggregates also written to the sink
+        '''
+        self.schema = ENV_HISTORY_SCHEMA if schema is None else schema
+        self.chunk = chunk
+        self.sink = sink
+        self.tiers = list(tiers)
+        self.clear()
+
+    def clear(self):
+        # blocks[name] holds the joined rows first, then the chunks
+        self.blocks = {name: [] for name, _, _ in self.schema}
+        self.length = 0
+        self.capacity = 0
+        self.start = 0  # first row in memory
+        self.flushed = 0  # rows written to the sink
+        self._offset = 0  # first row of the block being written
+        self._dataframe = None
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def names(self):
+        return [name for name, _, _ in self.schema]
+
+    def append(self, **values):
+        '''
+        Add a row with the given fields
+        '''
+        if self.length == self.capacity:
+            self._allocate()
+        i = self.length - self._offset
+        for name, value in values.items():
+            self.blocks[name][-1][i] = value
+        self.length += 1
+
+    def set_last(self, **values):
+        '''
+        Set fields of the last row
+        '''
+        i = self.length - 1 - self._offset
+        if i < 0:
+            raise ValueError('The last row is not in memory')
+        for name, value in values.items():
+            self.blocks[name][-1][i] = value
+
+    def column(self, name):
+        '''
+        The rows of field name in memory as a read-only view
+        '''
+        blocks = self.blocks[name]
+        if len(blocks) > 1:
+            self._join()
+            blocks = self.blocks[name]
+        if not blocks:
+            dtype, shape = self._types(name)
+            return np.empty((0,) + shape, dtype=dtype)
+        view = blocks[0][:self.length - self.start]
+        view.flags.writeable = False
+        return view
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+    def truncate(self, length):
+        '''
+        Drop the rows from length on
+        '''
+        if length > self.length:
+            raise ValueError('Cannot truncate a history of {} rows to {}'.format(self.length, length))
+        if length < max(self.start, self.flushed):
+            raise ValueError('Rows before {} are no longer in memory'.format(max(self.start, self.flushed)))
+        if length == self.length:
+            return
+        self._join()
+        self.length = length
+        self._offset = self.start
+        self.capacity = self.start + len(self.blocks[self.schema[0][0]][0])
+        for name, _, _ in self.schema:
+            self.blocks[name][0][length - self.start:] = np.nan
+        self._dataframe = None
+
+    def copy(self):
+        '''
+        Copy of the rows in memory. The copy does not stream, rows it
+        records stay in memory.
+        '''
+        other = History.__new__(History)
+        other.__dict__.update(self.__dict__)
+        other.blocks = {name: [block.copy() for block in blocks] for name, blocks in self.blocks.items()}
+        other.sink = None
+        other.tiers = []
+        return other
+
+    def flush(self):
+        '''
+        Write the rows in memory that are not in the sink yet, but the last
+        one whose inputs may still be set
+        '''
+        if self.sink is not None:
+            self._write(self.length - 1)
+
+    def finish(self):
+        '''
+        Write every remaining row and tier aggregate to the sink, the sink
+        stays open for the next history
+        '''
+        if self.sink is None:
+            return
+        self._write(self.length)
+        for tier in self.tiers:
+            tier.finish(self.sink)
+
+    def to_dataframe(self, start_time=None):
+        '''
+        The rows in memory as a pandas DataFrame indexed by Time (start_time
+        plus the time column, in minutes, or the minutes if start_time is
+        None) in the layout of T2DSimEnv.show_history. The frame is rebuilt
+        only after new rows are recorded.
+        '''
+        key = (self.start, self.length, start_time)
+        if self._dataframe is not None and self._dataframe[0] == key:
+            return self._dataframe[1]
+        df = columns_dataframe({name: self.column(name) for name in self.names}, start_time)
+        self._dataframe = (key, df)
+        return df
+
+    def _types(self, name):
+        for field, dtype, shape in self.schema:
+            if field == name:
+                return dtype, shape
+        raise KeyError(name)
+
+    def _allocate(self):
+        if self.sink is None:
+            for name, dtype, shape in self.schema:
+                self.blocks[name].append(np.full((self.chunk,) + shape, np.nan, dtype=dtype))
+            self._offset = self.capacity
+            self.capacity += self.chunk
+        elif self.capacity == 0:
+            for name, dtype, shape in self.schema:
+                self.blocks[name] = [np.full((2 * self.chunk,) + shape, np.nan, dtype=dtype)]
+            self.capacity = 2 * self.chunk
+        else:
+            # write out the older chunk and slide the newer one to the front
+            self._join()
+            self._write(self.start + self.chunk)
+            for name, _, _ in self.schema:
+                block = self.blocks[name][0]
+                block[:self.chunk] = block[self.chunk:]
+                block[self.chunk:] = np.nan
+            self.start += self.chunk
+            self._offset = self.start
+            self.capacity = self.start + 2 * self.chunk
+
+    def _join(self):
+        # one block of every row in memory, writes continue in its tail
+        for name, blocks in self.blocks.items():
+            if len(blocks) > 1:
+                self.blocks[name] = [np.concatenate(blocks)]
+        self._offset = self.start
+
+    def _write(self, stop):
+        # send rows [flushed, stop) to the sink and the tiers
+        if stop <= self.flushed:
+            return
+        self._join()
+        rows = slice(self.flushed - self.start, stop - self.start)
+        columns = {name: self.blocks[name][0][rows] for name in self.names}
+        self.sink.write(HISTORY_TABLE, columns)
+        for tier in self.tiers:
+            tier.add(columns, self.sink)
+        self.flushed = stop
+
+
+class Downsampler(object):
+    '''
+    Aggregates of the history over fixed time bins (e.g. 15 minutes or a
+    day) for a downsampled tier of a streamed History: the bin start time,
+    the number of rows and the mean, min and max of every scalar field.
+    Rows of the bin in progress are kept until it ends. The tier is
+    written to the sink as table '<minutes>min'.
+    '''
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self.table = '{:g}min'.format(minutes)
+        self._pending = None
+
+    def add(self, columns, sink):
+        columns = {name: values for name, values in columns.items() if values.ndim == 1}
+        if self._pending is not None:
+            columns = {name: np.concatenate([self._pending[name], values]) for name, values in columns.items()}
+        bins = np.floor(columns['time'] / self.minutes)
+        # the last bin may still get rows
+        done = bins < bins[-1] if len(bins) else bins.astype(bool)
+        if np.any(done):
+            sink.write(self.table, self._aggregate({name: values[done] for name, values in columns.items()}))
+        self._pending = {name: values[~done].copy() for name, values in columns.items()}
+
+    def finish(self, sink):
+        if self._pending is not None and len(self._pending['time']):
+            sink.write(self.table, self._aggregate(self._pending))
+        self._pending = None
+
+    def _aggregate(self, columns):
+        bins = np.floor(columns['time'] / self.minutes)
+        starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+        count = np.diff(np.r_[starts, len(bins)])
+        result = {'time': bins[starts] * self.minutes, 'count': count}
+        for name, values in columns.items():
+            if name == 'time':
+                continue
+            valid = ~np.isnan(values)
+            n = np.add.reduceat(valid, starts)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result[name + '_mean'] = np.add.reduceat(np.where(valid, values, 0), starts) / n
+            result[name + '_min'] = np.where(n > 0, np.minimum.reduceat(np.where(valid, values, np.inf), starts), np.nan)
+            result[name + '_max'] = np.where(n > 0, np.maximum.reduceat(np.where(valid, values, -np.inf), starts), np.nan)
+        return result
+
+
+class NpzSink(object):
+    '''
+    Writes every batch of rows of a table to its own compressed .npz file in
+    directory, <table>-<part>.npz
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._parts = {}
+
+    def write(self, table, columns):
+        part = self._parts.get(table, len(self._files(table)))
+        np.savez_compressed(os.path.join(self.directory, '{}-{:06d}.npz'.format(table, part)), **columns)
+        self._parts[table] = part + 1
+
+    def close(self):
+        pass
+
+    def read(self, table=HISTORY_TABLE):
+        '''
+        The written rows of table as a dict of arrays
+        '''
+        parts = [np.load(path) for path in self._files(table)]
+        if not parts:
+            raise ValueError('No rows of table {} in {}'.format(table, self.directory))
+        return {name: np.concatenate([part[name] for part in parts]) for name in parts[0].files}
+
+    def _files(self, table):
+        return sorted(glob.glob(os.path.join(self.directory, glob.escape(table) + '-[0-9]*.npz')))
+
+
+class ParquetSink(object):
+    '''
+    Appends the rows of each table to <table>-<part>.parquet in directory
+    as row groups, a new part each time the sink is opened. Fields with more
+    than one value per row are split into <name>_<i> columns. Needs pyarrow.
+    '''
+    def __init__(self, directory):
+        if not pyarrow:
+            raise RuntimeError('ParquetSink needs pyarrow, use NpzSink without it')
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._writers = {}
+
+    def write(self, table, columns):
+        flat = {}
+        for name, values in columns.items():
+            if values.ndim == 1:
+                flat[name] = values
+            else:
+                for i, column in enumerate(values.reshape(len(values), -1).T):
+                    flat['{}_{}'.format(name, i)] = column
+        batch = pa.table(flat)
+        if table not in self._writers:
+            path = os.path.join(self.directory, '{}-{:06d}.parquet'.format(table, len(self._files(table))))
+            self._writers[table] = pq.ParquetWriter(path, batch.schema)
+        self._writers[table].write_table(batch)
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+    def read(self, table=HISTORY_TABLE):
+        parts = [pq.read_table(path) for path in self._files(table)]
+        if not parts:
+            raise ValueError('No rows of table {} in {}'.format(table, self.directory))
+        rows = pa.concat_tables(parts)
+        return {name: rows.column(name).to_numpy() for name in rows.column_names}
+
+    def _files(self, table):
+        return sorted(glob.glob(os.path.join(self.directory, glob.escape(table) + '-[0-9]*.parquet')))
+
+
+def columns_dataframe(columns, start_time=None):
+    '''
+    show_history DataFrame of History columns (e.g. read back from a sink)
+    '''
+    df = pd.DataFrame()
+    minutes = columns['time']
+    df["Time"] = minutes if start_time is None else pd.Timestamp(start_time) + pd.to_timedelta(minutes, unit='min')
+    for name, column in DATAFRAME_COLUMNS.items():
+        values = columns[name]
+        if values.ndim > 1:
+            # one array per row as the env recorded them, missing rows NaN
+            rows = np.empty(len(values), dtype=object)
+            rows[:] = list(values)
+            rows[np.isnan(values).all(axis=tuple(range(1, values.ndim)))] = np.nan
+            values = rows
+        df[column] = values
+    return df.set_index("Time")
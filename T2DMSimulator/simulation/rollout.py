@@ -0,0 +1,113 @@
+import numpy as np
+from collections import namedtuple
+from scipy.integrate import solve_ivp
+from T2DMSimulator.glucose.jacobian import N_STATES
+from T2DMSimulator.patient.cohort import T2DCohort
+from T2DMSimulator.patient.t2dpatient import Action
+from T2DMSimulator.patient.inputs import apply_doses, has_doses, MinuteInputs
+from T2DMSimulator.analysis.risk import risk_array
+
+RolloutResult = namedtuple("RolloutResult", ["time", "BG", "LBGI", "HBGI", "risk"])
+
+
+def candidate_count(actions):
+    '''
+    Number of candidates K in a schedule of actions, the largest leading
+    dimension of its 2D fields (1 if every field is a scalar or 1D)
+    '''
+    return max([np.shape(value)[0] for value in actions if np.ndim(value) == 2] + [1])
+
+
+def rollout(patient, actions, n_steps, snapshot=None, method='rows', rtol=1e-4, atol=1e-6):
+    '''
+    Simulate K candidate action schedules from one patient snapshot as a
+    single batched integration and score them with the risk index of
+    analysis.risk.
+    Inputs:
+        - patient: the T2DPatient to forecast
+        - actions: a patient Action whose fields are per minute inputs:
+          scalars, (n_steps,) arrays shared by every candidate or
+          (K, n_steps) arrays. CHO is the announced meal (g), eaten at
+          T2DCohort.EAT_RATE as in T2DPatient.step, doses are given at the
+          start of their minute and physical is the exercise heart rate on
+          top of the patient's noise free resting heart rate
+        - n_steps: forecast horizon in minutes
+        - snapshot: PatientSnapshot to start from, the patient's current
+          state by default
+        - method: 'rows' integrates every candidate with a step size and
+          error control of its own (T2DCohort.integrate), so a dose or an
+          input change only bounds the steps of the candidate it is given
+          to. A solve_ivp method name integrates the K
+          patients as one (K * 57) system instead, restarted at every dose
+          of any candidate (implicit methods get the block diagonal
+          analytic Jacobian, T2DCohort.jacobian)
+        - rtol, atol: error tolerances
+    Returns a RolloutResult with the (n_steps + 1,) times, the (K, n_steps + 1)
+    BG trajectories starting at the snapshot and the (K,) mean LBGI, HBGI and
+    risk over each trajectory.
+    '''
+    snapshot = patient.snapshot() if snapshot is None else snapshot
+    k = candidate_count(actions)
+    cohort = T2DCohort.from_snapshot(patient, snapshot, k, rtol=rtol, atol=atol)
+    schedule = minute_schedule(cohort, actions, n_steps, patient.resting_heart_rate)
+    time = snapshot.t + np.arange(n_steps + 1) * cohort.sample_time
+    BG = np.empty((k, n_steps + 1))
+    BG[:, 0] = cohort.state[:, 34]
+    if method == 'rows':
+        BG[:, 1:] = cohort.integrate(schedule)[:, :, 34]
+    else:
+        BG[:, 1:] = _integrate_stacked(cohort, schedule, time, method, rtol, atol)[:, 34, :]
+
+    LBGI, HBGI, risk = (r.mean(axis=1) for r in risk_array(BG))
+    return RolloutResult(time=time, BG=BG, LBGI=LBGI, HBGI=HBGI, risk=risk)
+
+
+def _integrate_stacked(cohort, schedule, time, method, rtol, atol):
+    '''
+    The (K, 57, n_steps) states of the cohort at time[1:], integrated by
+    solve_ivp as one (K * 57) system restarted at every dose
+    '''
+    k, n_steps = cohort.n, len(time) - 1
+    inputs = MinuteInputs(schedule, time[0], cohort.sample_time)
+    x = cohort.state.copy()
+    model = lambda t, x: cohort.model(t, x, *inputs(t))
+    kwargs = {'jac': lambda t, x: cohort.jacobian(t, x, *inputs(t))} if method in ('BDF', 'Radau') else {}
+    boundaries = segment_boundaries(schedule, n_steps)
+    states = np.empty((k, N_STATES, n_steps))
+    for start, stop in zip(boundaries[:-1], boundaries[1:]):
+        x = apply_doses(x, Action(*(value[:, start] for value in schedule)))
+        sol = solve_ivp(model, (time[start], time[stop]), x.ravel(), method=method,
+                        t_eval=time[start + 1:stop + 1], rtol=rtol, atol=atol, **kwargs)
+        if not sol.success:
+            raise RuntimeError('Rollout integration failed at t = {}: {}'.format(time[start], sol.message))
+        states[:, :, start:stop] = sol.y.reshape(k, N_STATES, stop - start)
+        x = states[:, :, stop - 1].copy()
+    return states
+
+
+def minute_schedule(cohort, actions, n_steps, resting_heart_rate):
+    '''
+    The inputs the cohort takes each minute of a schedule of actions (see
+    rollout) as an Action of (K, n_steps) arrays: the meals to eat per minute
+    at the cohort's EAT_RATE, and physical on top of resting_heart_rate.
+    Advances the cohort's planned meals.
+    '''
+    schedule = Action(*(np.broadcast_to(np.asarray(value, dtype=float), (cohort.n, n_steps)) for value in actions))
+    to_eat = np.empty((cohort.n, n_steps))
+    for i in range(n_steps):
+        to_eat[:, i] = cohort._announce_meal(schedule.CHO[:, i])
+    return schedule._replace(CHO=to_eat, physical=schedule.physical + resting_heart_rate)
+
+
+def segment_boundaries(schedule, n_steps):
+    '''
+    Minutes where a solver of the stacked system restarts: the start, the
+    end and wherever any candidate gets a dose (a state jump). The
+    continuous inputs are looked up per minute by MinuteInputs.
+    '''
+    boundaries = [0]
+    for i in range(1, n_steps):
+        if has_doses(Action(*(value[:, i] for value in schedule))):
+            boundaries.append(i)
+    boundaries.append(n_steps)
+    return boundaries
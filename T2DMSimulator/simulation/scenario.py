@@ -5,6 +5,7 @@ from datetime import timedelta
 
 logger = logging.getLogger(__name__)
 Action = namedtuple('scenario_action', ['meal', 'stress', 'metformin', 'insulin_long','insulin_fast', 'exercise'])
+NO_ACTION = Action(meal=0, stress=0, metformin=0, insulin_long=0, insulin_fast=0, exercise=0)
 
 
 class Scenario(object):
@@ -17,6 +18,15 @@ class Scenario(object):
     def reset(self):
         raise NotImplementedError
 
+    def snapshot(self):
+        '''
+        Return the scenario's mutable state for restore, None if it has none
+        '''
+        return None
+
+    def restore(self, snapshot):
+        pass
+
 
 class CustomScenario(Scenario):
     def __init__(self, start_time, scenario):
@@ -29,31 +39,26 @@ class CustomScenario(Scenario):
         '''
         Scenario.__init__(self, start_time=start_time)
         self.scenario = scenario
+        self._actions = None
 
     def get_action(self, t):
-        if not self.scenario:
-            return Action(meal=0,stress=0, metformin=0, insulin_long=0, insulin_fast=0, exercise=0)
-        else:
-            times, actionValue, action = tuple(zip(*self.scenario))
-            times2compare = [parseTime(time, self.start_time) for time in times]
-            if t in times2compare:
-                idx = times2compare.index(t)
-                actionType = action[idx]
-                meal, metformin, stress, insulin_long,insulin_fast,exercise = 0,0,0,0,0,0
-                if actionType == "meal":
-                    meal = actionValue[idx]
-                if actionType == "metformin":
-                    metformin = actionValue[idx]
-                if actionType == "stress":
-                    stress = actionValue[idx]
-                if actionType == "insulin_long":
-                    insulin_long = actionValue[idx]
-                if actionType == "insulin_fast":
-                    insulin_fast = actionValue[idx]
-                if actionType == "exercise":
-                    exercise = actionValue[idx]
-                return Action(meal=meal, stress=stress, metformin=metformin, insulin_long=insulin_long, insulin_fast=insulin_fast, exercise=exercise)
-            return Action(meal=0,stress=0, metformin=0, insulin_long=0, insulin_fast=0, exercise=0)
+        if self._actions is None or self._compiled != self._key():
+            self._compile()
+        return self._actions.get(t, NO_ACTION)
+
+    def _compile(self):
+        # one lookup per minute in place of parsing every entry on each call,
+        # the first entry at a time wins
+        self._actions = {}
+        for time, actionValue, actionType in self.scenario or []:
+            t = parseTime(time, self.start_time)
+            if t not in self._actions:
+                self._actions[t] = NO_ACTION._replace(**{actionType: actionValue}) if actionType in Action._fields else NO_ACTION
+        self._compiled = self._key()
+
+    def _key(self):
+        # recompile when the scenario list is replaced or extended
+        return id(self.scenario), len(self.scenario or []), self.start_time
 
     def reset(self):
         pass
@@ -6,6 +6,15 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# daily meals of RandomScenario: [breakfast, snack1, lunch, snack2, dinner, snack3]
+MEAL_PROB = [0.95, 0.3, 0.95, 0.3, 0.95, 0.3]  # probability of taking each meal
+MEAL_TIME_LB = np.array([5, 9, 10, 14, 16, 20]) * 60
+MEAL_TIME_UB = np.array([9, 10, 14, 16, 20, 23]) * 60
+MEAL_TIME_MU = np.array([7, 9.5, 12, 15, 18, 21.5]) * 60
+MEAL_TIME_SIGMA = np.array([60, 30, 60, 30, 60, 30])
+MEAL_AMOUNT_MU = [45, 10, 70, 10, 80, 10]
+MEAL_AMOUNT_SIGMA = [10, 5, 10, 5, 10, 5]
+
 
 class RandomScenario(Scenario):
     def __init__(self, start_time, seed=None):
@@ -33,19 +42,9 @@ class RandomScenario(Scenario):
     def create_scenario(self):
         scenario = {'meal': {'time': [], 'amount': []}}
 
-        # Probability of taking each meal
-        # [breakfast, snack1, lunch, snack2, dinner, snack3]
-        prob = [0.95, 0.3, 0.95, 0.3, 0.95, 0.3]
-        time_lb = np.array([5, 9, 10, 14, 16, 20]) * 60
-        time_ub = np.array([9, 10, 14, 16, 20, 23]) * 60
-        time_mu = np.array([7, 9.5, 12, 15, 18, 21.5]) * 60
-        time_sigma = np.array([60, 30, 60, 30, 60, 30])
-        amount_mu = [45, 10, 70, 10, 80, 10]
-        amount_sigma = [10, 5, 10, 5, 10, 5]
-
-        for p, tlb, tub, tbar, tsd, mbar, msd in zip(prob, time_lb, time_ub,
-                                                     time_mu, time_sigma,
-                                                     amount_mu, amount_sigma):
+        for p, tlb, tub, tbar, tsd, mbar, msd in zip(MEAL_PROB, MEAL_TIME_LB, MEAL_TIME_UB,
+                                                     MEAL_TIME_MU, MEAL_TIME_SIGMA,
+                                                     MEAL_AMOUNT_MU, MEAL_AMOUNT_SIGMA):
             if self.random_gen.rand() < p:
                 tmeal = np.round(
                     truncnorm.rvs(a=(tlb - tbar) / tsd,
@@ -63,6 +62,17 @@ class RandomScenario(Scenario):
         self.random_gen = np.random.RandomState(self.seed)
         self.scenario = self.create_scenario()
 
+    def snapshot(self):
+        meals = self.scenario['meal']
+        return self.random_gen.get_state(), np.array(meals['time']), np.array(meals['amount'])
+
+    def restore(self, snapshot):
+        random_state, times, amounts = snapshot
+        # a fresh generator, so shallow copies of the scenario do not share one
+        self.random_gen = np.random.RandomState()
+        self.random_gen.set_state(random_state)
+        self.scenario = {'meal': {'time': times.tolist(), 'amount': amounts.tolist()}}
+
     @property
     def seed(self):
         return self._seed
@@ -73,6 +83,26 @@ class RandomScenario(Scenario):
         self.reset()
 
 
+def random_meal_days(n, rng):
+    '''
+    n random days of meals drawn as in RandomScenario.create_scenario, all at
+    once from the numpy Generator (or RandomState) rng.
+    Returns an (n, 1440) array of the CHO (g) announced at each minute of
+    the day.
+    '''
+    shape = (n, len(MEAL_PROB))
+    taken = rng.random(shape) < MEAL_PROB
+    times = np.round(truncnorm.rvs(a=(MEAL_TIME_LB - MEAL_TIME_MU) / MEAL_TIME_SIGMA,
+                                   b=(MEAL_TIME_UB - MEAL_TIME_MU) / MEAL_TIME_SIGMA,
+                                   loc=MEAL_TIME_MU, scale=MEAL_TIME_SIGMA, size=shape,
+                                   random_state=rng)).astype(int)
+    amounts = np.maximum(np.round(rng.normal(MEAL_AMOUNT_MU, MEAL_AMOUNT_SIGMA, size=shape)), 0)
+    meals = np.zeros((n, 24 * 60))
+    rows = np.broadcast_to(np.arange(n)[:, None], shape)
+    np.add.at(meals, (rows[taken], times[taken]), amounts[taken])
+    return meals
+
+
 if __name__ == '__main__':
     from datetime import time
     from datetime import timedelta
@@ -1,6 +1,7 @@
 import logging
 import time
 import os
+from T2DMSimulator.simulation.history import NpzSink
 
 pathos = True
 try:
@@ -18,23 +19,42 @@ class SimObj(object):
                  controller,
                  sim_time,
                  animate=True,
-                 path=None):
+                 path=None,
+                 stream=False,
+                 tiers=(15, 24 * 60)):
+        '''
+        SimObj constructor.
+        Inputs:
+            - stream: write the env history to path/<patient name> as it is
+              simulated (see T2DSimEnv.stream) instead of keeping it in
+              memory, for long simulations. results then only holds the
+              latest samples
+            - tiers: downsampled aggregates written when streaming
+        '''
         self.env = env
         self.controller = controller
         self.sim_time = sim_time
         self.animate = animate
         self._ctrller_kwargs = None
         self.path = path
+        self.stream = stream
+        self.tiers = tiers
 
     def simulate(self):
         self.controller.reset()
         obs, reward, done, info = self.env.reset()
+        if self.stream:
+            if self.path is None:
+                raise ValueError('Streaming needs the path to write the history to')
+            self.env.stream(NpzSink(os.path.join(self.path, str(self.env.patient.name))), self.tiers)
         tic = time.time()
         while self.env.time < self.env.scenario.start_time + self.sim_time:
             if self.animate:
                 self.env.render()
             action = self.controller.policy(obs, reward, done, **info)
             obs, reward, done, info = self.env.step(action)
+        if self.stream:
+            self.env.close()
         toc = time.time()
         logger.info('Simulation took {} seconds.'.format(toc - tic))
 
@@ -42,6 +62,9 @@ class SimObj(object):
         return self.env.show_history()
 
     def save_results(self):
+        if self.stream:
+            # the history was written while simulating
+            return
         df = self.results()
         if not os.path.isdir(self.path):
             os.makedirs(self.path)
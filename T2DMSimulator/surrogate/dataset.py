@@ -0,0 +1,111 @@
+import logging
+import numpy as np
+from collections import namedtuple
+from T2DMSimulator.patient.t2dpatient import Action
+from T2DMSimulator.controller.base import Action as RecommendedAction
+
+logger = logging.getLogger(__name__)
+
+# inputs the surrogate sees, in this column order
+INPUT_FIELDS = ['CHO', 'insulin_fast', 'insulin_long', 'metformin', 'vildagliptin', 'stress']
+
+Trajectory = namedtuple("trajectory", ['BG', 'inputs'])
+
+NO_RECOMMENDATION = RecommendedAction(basal=0, bolus=0, meal=0, metformin=0, physical=0, time=0, times=[0, 0, 0, 0])
+
+# (start, end) minute of day windows and CHO (g) range of the random meals
+MEAL_WINDOWS = [((6 * 60, 9 * 60), (20, 80)),
+                ((11 * 60, 14 * 60), (30, 100)),
+                ((17 * 60, 20 * 60), (30, 100))]
+SNACK_CHO = (5, 30)
+
+
+def random_schedule(n_steps, rng, snack_rate=1.0, metformin_prob=0.5, vildagliptin_prob=0.2,
+                    insulin_prob=0.2, stress_prob=0.1):
+    '''
+    Random daily life action schedule for dataset generation, an (n_steps,
+    len(INPUT_FIELDS)) array of per minute patient Action fields.
+    Inputs:
+        - rng: a numpy RandomState
+        - snack_rate: mean number of snacks per day
+        - metformin_prob, vildagliptin_prob, insulin_prob: probability that a
+          meal comes with a metformin (500-1000 mg), vildagliptin (50 mg) or
+          fast insulin (2-10 U) dose, and that a day has a long acting
+          insulin dose (10-30 U)
+        - stress_prob: probability that a day has a stress episode
+    '''
+    schedule = np.zeros((n_steps, len(INPUT_FIELDS)))
+    column = {field: i for i, field in enumerate(INPUT_FIELDS)}
+    for day in range(0, n_steps, 24 * 60):
+        for (start, end), (low, high) in MEAL_WINDOWS:
+            t = day + rng.randint(start, end)
+            if t >= n_steps:
+                continue
+            schedule[t, column['CHO']] += rng.uniform(low, high)
+            if rng.rand() < metformin_prob:
+                schedule[t, column['metformin']] += rng.choice([500, 850, 1000])
+            if rng.rand() < vildagliptin_prob:
+                schedule[t, column['vildagliptin']] += 50
+            if rng.rand() < insulin_prob:
+                schedule[t, column['insulin_fast']] += rng.uniform(2, 10)
+        for _ in range(rng.poisson(snack_rate)):
+            t = day + rng.randint(24 * 60)
+            if t < n_steps:
+                schedule[t, column['CHO']] += rng.uniform(*SNACK_CHO)
+        t = day + rng.randint(24 * 60)
+        if t < n_steps and rng.rand() < insulin_prob:
+            schedule[t, column['insulin_long']] += rng.uniform(10, 30)
+        if rng.rand() < stress_prob:
+            t = day + rng.randint(24 * 60)
+            schedule[t:t + rng.randint(30, 180), column['stress']] = rng.uniform(0.1, 0.5)
+    return schedule
+
+
+def simulate(patient, schedule):
+    '''
+    Step patient through schedule (from random_schedule) and return the
+    Trajectory of its len(schedule) + 1 BG values and the inputs it actually
+    received, meals being eaten at patient.EAT_RATE.
+    '''
+    BG = np.empty(len(schedule) + 1)
+    inputs = np.zeros_like(schedule)
+    BG[0] = patient.observation.Gsub
+    for i, row in enumerate(schedule):
+        action = Action(physical=0, **dict(zip(INPUT_FIELDS, row)))
+        taken, _ = patient.step(action, NO_RECOMMENDATION)
+        inputs[i] = [getattr(taken, field) for field in INPUT_FIELDS]
+        BG[i + 1] = patient.observation.Gsub
+    return Trajectory(BG=BG, inputs=inputs)
+
+
+def generate_dataset(patient, n_trajectories, n_steps=24 * 60, burn_in=0, seed=None, **kwargs):
+    '''
+    Simulate n_trajectories random schedules of n_steps minutes, each from a
+    fresh reset of patient. kwargs go to random_schedule.
+    Inputs:
+        - burn_in: minutes simulated without inputs before recording
+        - seed: seeds the schedules and the global numpy RNG the resting
+          heart rate is drawn from
+    Returns a list of Trajectory.
+    '''
+    rng = np.random.RandomState(seed)
+    if seed is not None:
+        np.random.seed(seed)
+    trajectories = []
+    for n in range(n_trajectories):
+        patient.reset()
+        if burn_in:
+            simulate(patient, np.zeros((burn_in, len(INPUT_FIELDS))))
+        trajectories.append(simulate(patient, random_schedule(n_steps, rng, **kwargs)))
+        logger.info('Generated trajectory {}/{}'.format(n + 1, n_trajectories))
+    return trajectories
+
+
+def save_dataset(path, trajectories):
+    np.savez_compressed(path, BG=np.stack([tr.BG for tr in trajectories]),
+                        inputs=np.stack([tr.inputs for tr in trajectories]))
+
+
+def load_dataset(path):
+    with np.load(path) as data:
+        return [Trajectory(BG=BG, inputs=inputs) for BG, inputs in zip(data['BG'], data['inputs'])]
@@ -0,0 +1,350 @@
+import logging
+import numpy as np
+from collections import namedtuple
+from scipy.signal import lfilter
+from T2DMSimulator.patient.t2dpatient import Action, Observation
+from T2DMSimulator.surrogate.dataset import INPUT_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# time constants (min) of the input filter bank, each a cascade of two
+# first order low pass filters so delayed responses (gastric emptying, drug
+# absorption) can be represented
+FILTER_TIME_CONSTANTS = np.array([5., 15., 45., 135., 405.])
+FILTER_STAGES = 2
+
+SurrogateSnapshot = namedtuple("surrogate_snapshot", ['patient', 'filters', 'BG'])
+
+
+class SurrogateModel(object):
+    '''
+    Linear-Gaussian state space emulator of the BG (observation.Gsub) of one
+    T2DPatient, NumPy only.
+
+    The state is the last three BG values and a bank of linear filters of
+    the inputs (INPUT_FIELDS of the actions the patient took). The BG
+    increment of a minute is a ridge regression on BG, its first
+    differences, the filter states, their products with BG and the current
+    inputs. The error estimate is the RMS free run error against the ODE on
+    held out trajectories, per number of steps since the last true BG
+    (calibrate).
+    '''
+    def __init__(self, weights, feature_mean, feature_std, BG_mean, BG_std, BG_range, input_max,
+                 error_profile=None, parameters_key=None):
+        '''
+        SurrogateModel constructor, see fit.
+        Inputs:
+            - error_profile: RMS error (mg/dl) after 1, 2, ... free run steps
+            - parameters_key: steady_state_key of the patient it emulates
+        '''
+        self.weights = np.asarray(weights, dtype=float)
+        self.feature_mean = np.asarray(feature_mean, dtype=float)
+        self.feature_std = np.asarray(feature_std, dtype=float)
+        self.BG_mean = float(BG_mean)
+        self.BG_std = float(BG_std)
+        self.BG_range = tuple(BG_range)
+        self.input_max = np.asarray(input_max, dtype=float)
+        self.error_profile = np.zeros(0) if error_profile is None else np.asarray(error_profile, dtype=float)
+        self.parameters_key = parameters_key
+        self._decay = np.exp(-1 / FILTER_TIME_CONSTANTS)
+
+    @property
+    def filter_shape(self):
+        return (len(INPUT_FIELDS), len(FILTER_TIME_CONSTANTS), FILTER_STAGES)
+
+    def initial_filters(self):
+        '''
+        Filter states of a patient that has not taken any input
+        '''
+        return np.zeros(self.filter_shape)
+
+    def update_filters(self, z, u):
+        '''
+        Return the filter states one minute after z, u is the (..., 6) input
+        taken in that minute
+        '''
+        z = z.copy()
+        a = self._decay
+        z[..., 0] = a * z[..., 0] + (1 - a) * np.asarray(u)[..., None]
+        for stage in range(1, FILTER_STAGES):
+            z[..., stage] = a * z[..., stage] + (1 - a) * z[..., stage - 1]
+        return z
+
+    def predict(self, BG, z, u):
+        '''
+        One step ahead BG.
+        Inputs:
+            - BG: (..., 3) last three BG values, oldest first
+            - z: (..., 6, 5, 2) filter states of the inputs before this step
+            - u: (..., 6) inputs taken in this step
+        '''
+        BG = np.asarray(BG, dtype=float)
+        return BG[..., -1] + self._features(BG, z, u) @ self.weights
+
+    def estimated_error(self, steps):
+        '''
+        Calibrated RMS error (mg/dl) of the prediction steps minutes after
+        the last true BG, inf beyond the calibrated horizon
+        '''
+        if steps <= 0:
+            return 0.0
+        if steps > len(self.error_profile):
+            return np.inf
+        return self.error_profile[steps - 1]
+
+    def in_domain(self, BG, u):
+        '''
+        True if BG and the inputs u are within the range of the training data
+        '''
+        return self.BG_range[0] <= BG <= self.BG_range[1] and np.all(np.asarray(u) <= self.input_max)
+
+    def _features(self, BG, z, u):
+        g = (BG[..., -1] - self.BG_mean) / self.BG_std
+        zz = z.reshape(z.shape[:-3] + (-1,))
+        X = np.concatenate([g[..., None], (g * g)[..., None],
+                            (BG[..., -1] - BG[..., -2])[..., None], (BG[..., -2] - BG[..., -3])[..., None],
+                            zz, g[..., None] * zz, np.asarray(u, dtype=float)], axis=-1)
+        X = (X - self.feature_mean) / self.feature_std
+        return np.concatenate([np.ones(X.shape[:-1] + (1,)), X], axis=-1)
+
+    @classmethod
+    def fit(cls, trajectories, ridge=1e-6, parameters_key=None, domain_margin=0.1):
+        '''
+        Fit the one step model to a list of dataset.Trajectory by ridge
+        regression on standardized features.
+        Inputs:
+            - ridge: penalty relative to the number of samples
+            - domain_margin: relative widening of the BG and input ranges
+              seen in training that in_domain accepts
+        '''
+        BG = np.concatenate([tr.BG for tr in trajectories])
+        inputs = np.concatenate([tr.inputs for tr in trajectories])
+        span = BG.max() - BG.min()
+        model = cls(weights=np.zeros(0), feature_mean=0, feature_std=1, BG_mean=BG.mean(), BG_std=BG.std(),
+                    BG_range=(BG.min() - domain_margin * span, BG.max() + domain_margin * span),
+                    input_max=inputs.max(axis=0) * (1 + domain_margin), parameters_key=parameters_key)
+
+        X, y = [], []
+        for tr in trajectories:
+            t = np.arange(2, len(tr.inputs))
+            BG3 = np.stack([tr.BG[t - 2], tr.BG[t - 1], tr.BG[t]], axis=-1)
+            X.append(model._features(BG3, model.filter_history(tr.inputs)[t], tr.inputs[t])[:, 1:])
+            y.append(tr.BG[t + 1] - tr.BG[t])
+        X, y = np.concatenate(X), np.concatenate(y)
+        model.feature_mean = X.mean(axis=0)
+        std = X.std(axis=0)
+        model.feature_std = np.where(std > 0, std, 1.0)
+        X = np.column_stack([np.ones(len(X)), (X - model.feature_mean) / model.feature_std])
+        penalty = ridge * len(X) * np.eye(X.shape[1])
+        penalty[0, 0] = 0
+        model.weights = np.linalg.solve(X.T @ X + penalty, X.T @ y)
+        logger.info('Surrogate one step RMS error {:.4f} mg/dl'.format(np.sqrt(np.mean((X @ model.weights - y) ** 2))))
+        return model
+
+    def filter_history(self, inputs):
+        '''
+        (len(inputs) + 1, 6, 5, 2) filter states before each step of an input
+        history starting from initial_filters
+        '''
+        z = np.zeros((len(inputs) + 1,) + self.filter_shape)
+        for k, a in enumerate(self._decay):
+            stage = inputs
+            for s in range(FILTER_STAGES):
+                stage = lfilter([1 - a], [1, -a], stage, axis=0)
+                z[1:, :, k, s] = stage
+        return z
+
+    def free_run_errors(self, trajectories, horizon, stride=15):
+        '''
+        (n_starts, horizon) errors of free runs of the model against the
+        true BG, started every stride minutes of each trajectory
+        '''
+        errors = []
+        for tr in trajectories:
+            z = self.filter_history(tr.inputs)
+            starts = np.arange(2, len(tr.inputs) - horizon + 1, stride)
+            BG3 = np.stack([tr.BG[starts - 2], tr.BG[starts - 1], tr.BG[starts]], axis=-1)
+            err = np.empty((len(starts), horizon))
+            for k in range(horizon):
+                t = starts + k
+                BG3 = np.concatenate([BG3[:, 1:], self.predict(BG3, z[t], tr.inputs[t])[:, None]], axis=-1)
+                err[:, k] = BG3[:, -1] - tr.BG[t + 1]
+            errors.append(err)
+        return np.concatenate(errors)
+
+    def calibrate(self, trajectories, horizon=240, stride=15):
+        '''
+        Set the error profile from free runs on held out trajectories: the
+        RMS error after each number of steps, made non-decreasing
+        '''
+        errors = self.free_run_errors(trajectories, horizon, stride)
+        self.error_profile = np.maximum.accumulate(np.sqrt(np.mean(errors ** 2, axis=0)))
+        return self
+
+    def save(self, path):
+        np.savez(path, weights=self.weights, feature_mean=self.feature_mean, feature_std=self.feature_std,
+                 BG_mean=self.BG_mean, BG_std=self.BG_std, BG_range=self.BG_range, input_max=self.input_max,
+                 error_profile=self.error_profile, parameters_key=str(self.parameters_key))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            values = {name: data[name] for name in data.files}
+        key = str(values.pop('parameters_key'))
+        return cls(parameters_key=None if key == 'None' else key, **values)
+
+
+class SurrogatePatient(object):
+    '''
+    T2DPatient stand-in that steps a SurrogateModel and falls back to the
+    patient's ODE integration when the surrogate cannot be trusted: when the
+    calibrated error estimate of the next step exceeds max_error, when BG or
+    the inputs leave the training domain, or when a recommended action or
+    exercise is pending (the surrogate is not trained on them).
+
+    The patient itself stays at the last point its ODE state was exact, the
+    actions taken since are buffered. A fallback replays them through the
+    patient (exact, at ODE cost) and restarts the surrogate from the true
+    BG. Reading state, snapshot or fork also catches the patient up.
+    Everything else is forwarded to the patient.
+    '''
+    def __init__(self, patient, model, max_error=5.0):
+        '''
+        SurrogatePatient constructor.
+        Inputs:
+            - patient: the T2DPatient the model was trained on
+            - model: a SurrogateModel
+            - max_error: largest accepted estimated error (mg/dl)
+        '''
+        self.patient = patient
+        self.model = model
+        self.max_error = max_error
+        self.surrogate_steps = 0
+        self.ode_steps = 0
+        self._sync()
+        self._z = model.initial_filters()
+
+    def __getattr__(self, name):
+        if name == 'patient':
+            raise AttributeError(name)
+        return getattr(self.patient, name)
+
+    @property
+    def t(self):
+        return self.patient.t + len(self._pending) * self.patient.sample_time
+
+    @property
+    def sample_time(self):
+        return self.patient.sample_time
+
+    @property
+    def observation(self):
+        return Observation(Gsub=self._BG[-1])
+
+    @property
+    def state(self):
+        self.catch_up()
+        return self.patient.state
+
+    @property
+    def estimated_error(self):
+        '''
+        Calibrated RMS error of the current BG
+        '''
+        return self.model.estimated_error(len(self._pending))
+
+    def step(self, action, reccomended_action):
+        '''
+        Same as T2DPatient.step, returns the action taken (physical being
+        the exercise heart rate) and the resting heart rate
+        '''
+        taken = self._taken(action)
+        u = self._inputs(taken)
+        if self._needs_ode(reccomended_action, u):
+            self.catch_up()
+            taken, heart_rate = self.patient.step(action, reccomended_action)
+            u = self._inputs(taken)
+            self.ode_steps += 1
+            self._sync(self._BG[1:] + [self.patient.observation.Gsub])
+        else:
+            self._pending.append((action, reccomended_action))
+            self._BG = self._BG[1:] + [float(self.model.predict(self._BG, self._z, u))]
+            heart_rate = self.patient.resting_heart_rate
+            self.surrogate_steps += 1
+        self._z = self.model.update_filters(self._z, u)
+        return taken, heart_rate
+
+    def catch_up(self):
+        '''
+        Replay the buffered actions through the patient so its ODE state is
+        exact at the current time
+        '''
+        if self._pending:
+            BG = self._synced_BG
+            for action, reccomended_action in self._pending:
+                self.patient.step(action, reccomended_action)
+                BG = BG[1:] + [self.patient.observation.Gsub]
+            self.ode_steps += len(self._pending)
+            self._sync(BG)
+
+    def snapshot(self):
+        self.catch_up()
+        return SurrogateSnapshot(patient=self.patient.snapshot(), filters=self._z.copy(), BG=list(self._BG))
+
+    def restore(self, snapshot):
+        self.patient.restore(snapshot.patient)
+        self._sync(snapshot.BG)
+        self._z = snapshot.filters.copy()
+
+    def fork(self, snapshot=None):
+        '''
+        An independent SurrogatePatient on a fork of the patient, see
+        T2DPatient.fork
+        '''
+        snapshot = self.snapshot() if snapshot is None else snapshot
+        other = SurrogatePatient(self.patient.fork(snapshot.patient), self.model, self.max_error)
+        other.restore(snapshot)
+        return other
+
+    def reset(self):
+        self.patient.reset()
+        self._sync()
+        self._z = self.model.initial_filters()
+
+    def _sync(self, BG=None):
+        # restart the surrogate from the exact BG history, constant if it is
+        # not known (after a reset)
+        self._pending = []
+        self._BG = [float(self.patient.observation.Gsub)] * 3 if BG is None else [float(value) for value in BG]
+        self._synced_BG = list(self._BG)
+        self.planned_meal = self.patient.planned_meal
+        self._last_metformin = self.patient._last_action.metformin
+
+    def _needs_ode(self, reccomended_action, u):
+        # recommended meals, metformin and exercise change what the patient
+        # takes, the ODE runs from when they are given until they are done
+        queued = list(self.patient.reccomended_actions)
+        if any(self._recommends(item) for item in [reccomended_action] + queued) or self.patient.physical_activity_queue:
+            return True
+        if not self.model.in_domain(self._BG[-1], u):
+            return True
+        return self.model.estimated_error(len(self._pending) + 1) > self.max_error
+
+    def _taken(self, action):
+        # the meal and metformin rules of T2DPatient.step, tracked here while
+        # the patient itself is behind
+        self.planned_meal += action.CHO
+        to_eat = min(self.patient.EAT_RATE, max(self.planned_meal, 0))
+        self.planned_meal = max(self.planned_meal - to_eat, 0)
+        metformin = 0 if self._last_metformin != 0 else action.metformin
+        self._last_metformin = metformin
+        return Action(CHO=to_eat, insulin_fast=action.insulin_fast, insulin_long=action.insulin_long,
+                      metformin=metformin, vildagliptin=action.vildagliptin, stress=action.stress, physical=0)
+
+    @staticmethod
+    def _recommends(reccomended_action):
+        return reccomended_action.meal != 0 or reccomended_action.metformin != 0 or reccomended_action.physical != 0
+
+    @staticmethod
+    def _inputs(taken):
+        return np.array([getattr(taken, field) for field in INPUT_FIELDS], dtype=float)
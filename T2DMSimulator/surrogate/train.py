@@ -0,0 +1,76 @@
+'''
+Training pipeline of the surrogate emulator: simulate random schedules with
+the ODE model, fit a SurrogateModel and calibrate its error estimate on held
+out trajectories. Models are saved with the content hash of the patient's
+GlucoseParameters, load_or_train retrains when they change.
+
+    python -m T2DMSimulator.surrogate.train [path]
+'''
+import logging
+import os
+import sys
+from T2DMSimulator.glucose.glucose_initializer import steady_state_key
+from T2DMSimulator.surrogate.dataset import generate_dataset
+from T2DMSimulator.surrogate.emulator import SurrogateModel
+
+logger = logging.getLogger(__name__)
+
+
+def parameters_key(patient):
+    '''
+    Content hash of the parameters a surrogate of patient depends on
+    '''
+    return steady_state_key(patient.param, patient.GBPC0, patient.IBPF0, patient.brates)
+
+
+def train_surrogate(patient, n_train=40, n_validation=10, n_steps=24 * 60, ridge=1e-6, horizon=240, seed=0,
+                    stress_prob=0, **kwargs):
+    '''
+    Train and calibrate a SurrogateModel of patient.
+    Inputs:
+        - n_train, n_validation: number of simulated days (n_steps minutes
+          each) to fit on and to calibrate the error estimate on
+        - ridge: see SurrogateModel.fit
+        - horizon: longest calibrated free run (min), the surrogate falls
+          back to the ODE beyond it
+        - stress_prob: see dataset.random_schedule. Stress drives the model
+          far from its usual range, by default it is left out of the
+          training data so the surrogate treats it as out of domain
+        - kwargs: other random_schedule settings
+    The patient is reset afterwards.
+    '''
+    trajectories = generate_dataset(patient, n_train + n_validation, n_steps, seed=seed,
+                                    stress_prob=stress_prob, **kwargs)
+    model = SurrogateModel.fit(trajectories[:n_train], ridge=ridge, parameters_key=parameters_key(patient))
+    model.calibrate(trajectories[n_train:], horizon=horizon)
+    logger.info('Surrogate RMS error after {} min: {:.2f} mg/dl'.format(horizon, model.error_profile[-1]))
+    patient.reset()
+    return model
+
+
+def load_or_train(patient, path, **kwargs):
+    '''
+    Load the surrogate of patient saved at path (an .npz file), training
+    and saving a new one if there is none or it was trained on other
+    parameters. kwargs go to train_surrogate.
+    '''
+    if os.path.exists(path):
+        model = SurrogateModel.load(path)
+        if model.parameters_key == parameters_key(patient):
+            return model
+        logger.info('Surrogate at {} was trained on other parameters, retraining'.format(path))
+    model = train_surrogate(patient, **kwargs)
+    model.save(path)
+    return model
+
+
+def main(path='surrogate.npz'):
+    from T2DMSimulator.patient.t2dpatient import T2DPatient
+    from T2DMSimulator.utils.glucose_params_subtypes import get_mard_params
+    logging.basicConfig(level=logging.INFO)
+    patient = T2DPatient({}, glucose_params=get_mard_params(), name="MARD")
+    load_or_train(patient, path)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
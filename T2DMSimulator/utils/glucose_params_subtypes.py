@@ -9,4 +9,45 @@ def get_mard_params():
     glucoseParams.glucoseMetabolicRates.c1 = glucoseParams.glucoseMetabolicRates.c1 + 10*glucoseParams.glucoseMetabolicRates.c1
     glucoseParams.glucoseMetabolicRates.c2 = glucoseParams.glucoseMetabolicRates.c2 + 20*glucoseParams.glucoseMetabolicRates.c2
     glucoseParams.glucoseMetabolicRates.c4 = glucoseParams.glucoseMetabolicRates.c4 + 20*glucoseParams.glucoseMetabolicRates.c2
-    return glucoseParams
\ No newline at end of file
+    return glucoseParams
+
+
+def get_sidd_params():
+    ## SIDD parameters
+    glucoseParams = GlucoseParameters()
+    # Lower the effect of insulin on the hepatic glucose uptake and the peripheral uptake rate
+    glucoseParams.glucoseMetabolicRates.c4 = glucoseParams.glucoseMetabolicRates.c4 - 120*glucoseParams.glucoseMetabolicRates.c4
+    glucoseParams.glucoseMetabolicRates.c1 = glucoseParams.glucoseMetabolicRates.c1 - 120*glucoseParams.glucoseMetabolicRates.c1
+    # increase fraction of glucose absorbed
+    glucoseParams.glucoseAbsorptionSubmodel.fg = glucoseParams.glucoseAbsorptionSubmodel.fg * 2
+    # decrease insulin secretion rate
+    glucoseParams.pancreasModel.Ks = glucoseParams.pancreasModel.Ks/2
+    return glucoseParams
+
+
+def get_sird_params():
+    ## SIRD parameters, used with SIRD_BRATES
+    glucoseParams = GlucoseParameters()
+    glucoseParams.InsulinSubmodel.QIH = glucoseParams.InsulinSubmodel.QIH - glucoseParams.InsulinSubmodel.QIH/5
+    glucoseParams.InsulinSubmodel.QIP = glucoseParams.InsulinSubmodel.QIP / 2
+    return glucoseParams
+
+
+SIRD_BRATES = {'rBGU': 70, 'rRBCU': 10, 'rGGU': 20, 'rPGU': 17.5, 'rHGU': 10}
+
+
+def get_mod_params():
+    ## MOD parameters
+    glucoseParams = GlucoseParameters()
+    glucoseParams.glucoseMetabolicRates.c5 = glucoseParams.glucoseMetabolicRates.c5 * 2
+    glucoseParams.glucoseMetabolicRates.c2 = glucoseParams.glucoseMetabolicRates.c2 * 2
+    return glucoseParams
+
+
+# subtype: (GlucoseParameters factory, basal rates or None for the T2DPatient defaults)
+SUBTYPES = {
+    'SIDD': (get_sidd_params, None),
+    'SIRD': (get_sird_params, SIRD_BRATES),
+    'MOD': (get_mod_params, None),
+    'MARD': (get_mard_params, None),
+}
@@ -0,0 +1,110 @@
+import heapq
+import random
+
+
+class RecommendationScheduler(object):
+    '''
+    Recommended actions waiting to be carried out, keyed on the absolute
+    simulation minute they are due. put is a heap push and get only looks
+    at the earliest entry, so checking for due actions every minute costs
+    O(1) however many are waiting.
+
+    Delays are given in units of 1/time_scale minute. With jitter an
+    action is moved earlier or later with probability JITTER_PROB, and get
+    carries out a due action with probability compliance. The draws come from
+    a random.Random seeded with seed for every decision (the same outcome
+    each time, as with random.seed(seed) before each draw), or from one
+    unseeded generator when seed is None.
+    '''
+    JITTER_PROB = 0.4
+
+    def __init__(self, time_scale=1, seed=None):
+        self.time_scale = time_scale
+        self.seed = seed
+        self.heap = []
+        self.counter = 0
+        self.last_item = None
+        self.pending = set()
+        self.cancelled = set()
+        self._random = random.Random()
+
+    def put(self, item, now, delay, jitter=None):
+        '''
+        Schedule item delay after minute now. item is dropped if it equals
+        the last item put, as controllers repeat their recommendation every
+        sample.
+        Inputs:
+            - jitter: (low, high) delay units, added to or taken from the
+              delay with probability JITTER_PROB
+        Returns a handle for cancel, None if the item was dropped.
+        '''
+        if self.last_item is not None and item == self.last_item:
+            return None
+        if jitter is not None:
+            rng = self._draws()
+            if rng.random() < self.JITTER_PROB:
+                noise = rng.randint(*jitter)
+                delay = delay + noise if rng.random() > 0.5 else delay - noise
+        handle = self.counter
+        heapq.heappush(self.heap, (now + delay / self.time_scale, handle, item))
+        self.pending.add(handle)
+        self.counter += 1
+        self.last_item = item
+        return handle
+
+    def cancel(self, handle):
+        '''
+        Drop a scheduled item by the handle put returned
+        '''
+        if handle in self.pending:
+            self.pending.discard(handle)
+            self.cancelled.add(handle)
+
+    def get(self, minute, compliance=1):
+        '''
+        Remove and return the earliest item due at or before minute, None if
+        there is none or it is not carried out (probability 1 - compliance)
+        '''
+        self._drop_cancelled()
+        if not self.heap or self.heap[0][0] > minute:
+            return None
+        _, handle, item = heapq.heappop(self.heap)
+        self.pending.discard(handle)
+        if compliance < 1 and not self._draws().random() < compliance:
+            return None
+        return item
+
+    def copy(self):
+        other = RecommendationScheduler.__new__(RecommendationScheduler)
+        other.__dict__.update(self.__dict__)
+        other.heap = list(self.heap)
+        other.pending = set(self.pending)
+        other.cancelled = set(self.cancelled)
+        other._random = random.Random()
+        other._random.setstate(self._random.getstate())
+        return other
+
+    def peek(self):
+        self._drop_cancelled()
+        if self.heap:
+            return self.heap[0][2]
+        return None
+
+    def __iter__(self):
+        '''
+        Waiting items in due order
+        '''
+        return (item for _, handle, item in sorted(self.heap) if handle not in self.cancelled)
+
+    def is_empty(self):
+        return self.size() == 0
+
+    def size(self):
+        return len(self.pending)
+
+    def _drop_cancelled(self):
+        while self.heap and self.heap[0][1] in self.cancelled:
+            self.cancelled.discard(heapq.heappop(self.heap)[1])
+
+    def _draws(self):
+        return self._random if self.seed is None else random.Random(self.seed)
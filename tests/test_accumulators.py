@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+from T2DMSimulator.analysis.accumulators import default_accumulators, merge_all, DailyRollup, RunningStats, HypoDetector
+from T2DMSimulator.analysis.metrics import risk_indices, time_in_ranges, coefficient_of_variation, hypo_events
+
+SAMPLE_TIME = 5
+N_SAMPLES = 3 * 24 * 60 // SAMPLE_TIME
+
+
+def traces(n_patients=4, seed=0):
+    # three days of 5 hour swings dipping below 70 mg/dL, one row per patient
+    rng = np.random.RandomState(seed)
+    t = np.arange(N_SAMPLES) * SAMPLE_TIME
+    phase = rng.uniform(0, 2 * np.pi, (n_patients, 1))
+    return 140 + 90 * np.sin(2 * np.pi * t / 300 + phase) + rng.normal(0, 8, (n_patients, N_SAMPLES))
+
+
+def feed(accumulators, BG, start=0):
+    for i in range(BG.shape[-1]):
+        time = (start + i) * SAMPLE_TIME
+        sample = {'time': time, 'time_of_day': time % (24 * 60), 'sample_time': SAMPLE_TIME, 'BG': BG[..., i]}
+        for accumulator in accumulators:
+            accumulator.add(sample)
+    return accumulators
+
+
+def values(accumulators):
+    return {accumulator.name: accumulator.value() for accumulator in accumulators}
+
+
+def assert_values_equal(actual, expected, skip=()):
+    if isinstance(expected, dict):
+        assert sorted(actual) == sorted(expected)
+        for key in expected:
+            if key not in skip:
+                assert_values_equal(actual[key], expected[key], skip)
+    else:
+        np.testing.assert_allclose(actual, expected, rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize('BG', [traces()[0], traces()], ids=['trace', 'patients'])
+def test_accumulators_match_the_trace_metrics(BG):
+    result = values(feed(default_accumulators(), BG))
+    stats = result['stats']
+    assert stats['count'] == N_SAMPLES
+    np.testing.assert_allclose(stats['mean'], BG.mean(axis=-1), rtol=1e-12)
+    np.testing.assert_allclose(stats['sd'], BG.std(axis=-1), rtol=1e-10)
+    np.testing.assert_allclose(stats['CV'], coefficient_of_variation(BG), rtol=1e-10)
+    np.testing.assert_array_equal(stats['min'], BG.min(axis=-1))
+    np.testing.assert_array_equal(stats['max'], BG.max(axis=-1))
+    assert_values_equal(result['time_in_range'], time_in_ranges(BG))
+    assert_values_equal(result['risk'], dict(zip(('LBGI', 'HBGI', 'RI'), risk_indices(BG))))
+    events = hypo_events(BG, SAMPLE_TIME)
+    assert np.all(events > 0)
+    np.testing.assert_array_equal(result['hypo']['events'], events)
+    np.testing.assert_array_equal(result['hypo']['minutes_below'], (BG < 70).sum(axis=-1) * SAMPLE_TIME)
+    # a day of the rollup is the metrics of that day's samples
+    day = BG[..., N_SAMPLES // 3:2 * N_SAMPLES // 3]
+    assert sorted(result['daily']) == [0, 1, 2]
+    assert_values_equal(result['daily'][1]['time_in_range'], time_in_ranges(day))
+    np.testing.assert_allclose(result['daily'][1]['stats']['mean'], day.mean(axis=-1), rtol=1e-12)
+
+
+def test_merge_all_equals_one_combined_run():
+    BG = traces(seed=1)
+    combined = values(feed(default_accumulators(), BG))
+    # split where no patient is below 70, as a run does not carry over into
+    # the next part
+    above = np.flatnonzero(np.all(BG > 70, axis=0))
+    splits = [0, above[len(above) // 3], above[2 * len(above) // 3], N_SAMPLES]
+    parts = [feed(default_accumulators(), BG[:, start:stop], start) for start, stop in zip(splits[:-1], splits[1:])]
+    merged = values([merge_all([part[i] for part in parts]) for i in range(len(combined))])
+    # whether a run is in progress is not merged, see HypoDetector.merge
+    assert_values_equal(merged, combined, skip=('in_event',))
+    # merging leaves the parts unchanged
+    assert parts[0][0].count == splits[1]
+
+
+def test_merge_all_of_patients():
+    BG = traces(seed=2)
+    per_patient = [feed([RunningStats(), HypoDetector()], BG[i]) for i in range(len(BG))]
+    stats = merge_all([accumulators[0] for accumulators in per_patient]).value()
+    assert stats['count'] == BG.size
+    assert stats['mean'] == pytest.approx(BG.mean(), rel=1e-12)
+    assert stats['sd'] == pytest.approx(BG.std(), rel=1e-10)
+    assert stats['min'] == BG.min() and stats['max'] == BG.max()
+    hypo = merge_all([accumulators[1] for accumulators in per_patient]).value()
+    assert hypo['events'] == hypo_events(BG, SAMPLE_TIME).sum()
+
+
+def test_empty_accumulators():
+    for accumulator in default_accumulators():
+        empty = accumulator.empty()
+        assert empty.field == accumulator.field
+        if isinstance(accumulator, DailyRollup):
+            assert empty.value() == {}
+    assert np.isnan(RunningStats().value()['mean'])
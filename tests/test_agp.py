@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+from T2DMSimulator.analysis.agp import AmbulatoryGlucoseProfile, PERCENTILES
+
+SAMPLE_TIME = 5
+BIN_MINUTES = 60
+
+
+def traces(n_patients=6, days=4, seed=0):
+    # (patients, time) CGM with a daily pattern, some readings missing
+    rng = np.random.RandomState(seed)
+    t = np.arange(days * 24 * 60 // SAMPLE_TIME) * SAMPLE_TIME
+    CGM = 140 + 50 * np.sin(2 * np.pi * t / (24 * 60)) + rng.normal(0, 25, (n_patients, len(t)))
+    CGM[rng.uniform(size=CGM.shape) < 0.05] = np.nan
+    return CGM
+
+
+def expected_bands(CGM, low, resolution):
+    # nearest rank percentiles of every slot, at the centre of their level
+    minutes = np.arange(CGM.shape[1]) * SAMPLE_TIME % (24 * 60)
+    bands = np.empty((len(PERCENTILES), 24 * 60 // BIN_MINUTES))
+    for slot in range(bands.shape[1]):
+        values = CGM[:, minutes // BIN_MINUTES == slot]
+        values = values[~np.isnan(values)]
+        exact = np.percentile(values, PERCENTILES, method='inverted_cdf')
+        bands[:, slot] = low + (np.floor((exact - low) / resolution) + 0.5) * resolution
+        # within half a level of the sample percentiles
+        assert np.all(np.abs(bands[:, slot] - exact) <= resolution / 2)
+    return bands
+
+
+@pytest.mark.parametrize('low, resolution', [(0, 1), (40, 5)])
+def test_bands_match_np_percentile(low, resolution):
+    CGM = traces()
+    agp = AmbulatoryGlucoseProfile(bin_minutes=BIN_MINUTES, low=low, high=400, resolution=resolution)
+    agp.add_traces(CGM, SAMPLE_TIME)
+    assert agp.count == np.sum(~np.isnan(CGM))
+    np.testing.assert_allclose(agp.percentiles(), expected_bands(CGM, low, resolution))
+    value = agp.value()
+    np.testing.assert_array_equal(value['minute'], np.arange(0, 24 * 60, BIN_MINUTES))
+    np.testing.assert_array_equal(value['p50'], agp.percentiles()[2])
+    assert list(agp.to_dataframe().columns) == ['p{}'.format(q) for q in PERCENTILES]
+
+
+def test_values_outside_the_levels_count_in_the_end_levels():
+    agp = AmbulatoryGlucoseProfile(bin_minutes=BIN_MINUTES, low=40, high=400)
+    agp.add_values(0, [10, 20, 30, 500, 600])
+    agp.add_values(60, np.nan)
+    bands = agp.percentiles((0, 50, 100))
+    np.testing.assert_array_equal(bands[:, 0], [40.5, 40.5, 400.5])
+    # slots without samples
+    assert np.isnan(bands[:, 1:]).all()
+
+
+def test_samples_added_one_at_a_time_match_bulk():
+    CGM = traces(n_patients=2, days=1, seed=1)
+    bulk = AmbulatoryGlucoseProfile(bin_minutes=BIN_MINUTES)
+    bulk.add_traces(CGM, SAMPLE_TIME, start_minute=[0, 90])
+    single = AmbulatoryGlucoseProfile(bin_minutes=BIN_MINUTES)
+    for i in range(CGM.shape[1]):
+        for patient, start in enumerate([0, 90]):
+            single.add({'time_of_day': (start + i * SAMPLE_TIME) % (24 * 60), 'CGM': CGM[patient, i]})
+    np.testing.assert_array_equal(single.counts, bulk.counts)
+
+
+def test_merge_order_does_not_matter():
+    CGM = traces(seed=2)
+    combined = AmbulatoryGlucoseProfile(bin_minutes=BIN_MINUTES)
+    combined.add_traces(CGM, SAMPLE_TIME)
+    parts = []
+    for patients in np.array_split(np.arange(len(CGM)), 3):
+        part = AmbulatoryGlucoseProfile(bin_minutes=BIN_MINUTES)
+        part.add_traces(CGM[patients], SAMPLE_TIME)
+        parts.append(part)
+    for order in ([0, 1, 2], [2, 0, 1], [1, 2, 0]):
+        merged = parts[order[0]].empty()
+        for i in order:
+            merged.merge(parts[i])
+        np.testing.assert_array_equal(merged.counts, combined.counts)
+        np.testing.assert_array_equal(merged.percentiles(), combined.percentiles())
+    # the parts are unchanged by merging into an empty profile
+    assert sum(part.count for part in parts) == combined.count
+
+
+def test_only_matching_profiles_merge():
+    agp = AmbulatoryGlucoseProfile(bin_minutes=BIN_MINUTES)
+    with pytest.raises(ValueError):
+        agp.merge(AmbulatoryGlucoseProfile(bin_minutes=30))
+    with pytest.raises(ValueError):
+        agp.merge(AmbulatoryGlucoseProfile(bin_minutes=BIN_MINUTES, resolution=2))
+    with pytest.raises(ValueError):
+        AmbulatoryGlucoseProfile(bin_minutes=7)
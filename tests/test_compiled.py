@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+from T2DMSimulator.glucose.GlucoseDynamics import GlucoseDynamics
+from T2DMSimulator.glucose.compiled import compile_parameters, compile_parameter_matrix, compiled_rhs
+from T2DMSimulator.glucose.jacobian import compiled_jacobian, JACOBIAN_SPARSITY, N_STATES
+from T2DMSimulator.patient.t2dpatient import T2DPatient
+from T2DMSimulator.utils.glucose_params_subtypes import get_mard_params
+
+
+@pytest.fixture(scope='module')
+def patient():
+    return T2DPatient({}, glucose_params=get_mard_params(), name="MARD")
+
+
+def random_states(patient, n, seed=0):
+    # states around the initial state, with the drug and meal compartments
+    # filled so every submodel is active
+    rng = np.random.RandomState(seed)
+    X0 = np.abs(np.array(patient.X0v, dtype=float))
+    x = X0 * rng.uniform(0.7, 1.3, (n, N_STATES)) + rng.uniform(0.1, 1.0, (n, N_STATES))
+    inputs = rng.uniform(0, 5e3, n), rng.uniform(0, 1, n), rng.uniform(55, 140, n)
+    return x, inputs
+
+
+def test_compiled_rhs_matches_glucose_dynamics(patient):
+    p = compile_parameters(patient.param, patient.basal)
+    x, (Dg, stress, HR) = random_states(patient, 20)
+    for i in range(len(x)):
+        expected = GlucoseDynamics(0, x[i].copy(), Dg[i], stress[i], HR[i], patient.basal, patient.param).compute()
+        np.testing.assert_allclose(compiled_rhs(0, x[i], p, Dg[i], stress[i], HR[i]), expected, rtol=1e-10, atol=1e-12)
+
+
+def test_compiled_rhs_batch_matches_single_patient(patient):
+    x, (Dg, stress, HR) = random_states(patient, 20, seed=1)
+    P = compile_parameter_matrix([patient.param] * len(x), [patient.basal] * len(x))
+    # distinct parameters per row, through the basal values
+    P[:, -25:] *= np.random.RandomState(2).uniform(0.9, 1.1, (len(x), 25))
+    batch = compiled_rhs(0, x, P, Dg, stress, HR)
+    assert batch.shape == x.shape
+    for i in range(len(x)):
+        np.testing.assert_allclose(batch[i], compiled_rhs(0, x[i], P[i], Dg[i], stress[i], HR[i]), rtol=1e-12, atol=1e-12)
+
+
+def central_differences(p, x, Dg, stress, HR):
+    J = np.empty((N_STATES, N_STATES))
+    for j in range(N_STATES):
+        h = 1e-6 * max(abs(x[j]), 1.0)
+        up, down = x.copy(), x.copy()
+        up[j] += h
+        down[j] -= h
+        J[:, j] = (compiled_rhs(0, up, p, Dg, stress, HR) - compiled_rhs(0, down, p, Dg, stress, HR)) / (2 * h)
+    return J
+
+
+def test_compiled_jacobian_matches_central_differences(patient):
+    p = compile_parameters(patient.param, patient.basal)
+    x, (Dg, stress, HR) = random_states(patient, 5, seed=3)
+    for i in range(len(x)):
+        J = compiled_jacobian(0, x[i], p, Dg[i], stress[i], HR[i])
+        expected = central_differences(p, x[i], Dg[i], stress[i], HR[i])
+        scale = np.abs(expected).max(axis=1, keepdims=True) + 1e-12
+        np.testing.assert_allclose(J / scale, expected / scale, atol=1e-5)
+
+
+def test_compiled_jacobian_stays_in_sparsity_pattern(patient):
+    p = compile_parameters(patient.param, patient.basal)
+    outside = ~JACOBIAN_SPARSITY.toarray()
+    x, (Dg, stress, HR) = random_states(patient, 5, seed=4)
+    for i in range(len(x)):
+        J = compiled_jacobian(0, x[i], p, Dg[i], stress[i], HR[i])
+        assert not np.any(J[outside])
+        # and the model has no dependence the pattern misses
+        expected = central_differences(p, x[i], Dg[i], stress[i], HR[i])
+        scale = np.abs(expected).max(axis=1, keepdims=True) + 1e-12
+        assert np.all(np.abs(expected / scale)[outside] < 1e-6)
+
+
+def test_compiled_jacobian_batch_matches_single_patient(patient):
+    x, (Dg, stress, HR) = random_states(patient, 6, seed=5)
+    P = compile_parameter_matrix([patient.param] * len(x), [patient.basal] * len(x))
+    blocks = compiled_jacobian(0, x, P, Dg, stress, HR)
+    for i in range(len(x)):
+        np.testing.assert_allclose(blocks[i], compiled_jacobian(0, x[i], P[i], Dg[i], stress[i], HR[i]), rtol=1e-12, atol=1e-12)
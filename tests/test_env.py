@@ -0,0 +1,50 @@
+import numpy as np
+from datetime import datetime
+from T2DMSimulator.actuator.pump import InsulinPump
+from T2DMSimulator.controller.base import Action as ControllerAction
+from T2DMSimulator.patient.t2dpatient import T2DPatient
+from T2DMSimulator.sensor.cgm import CGMSensor
+from T2DMSimulator.simulation.env import T2DSimEnv
+from T2DMSimulator.simulation.scenario import CustomScenario
+from T2DMSimulator.utils.glucose_params_subtypes import get_mard_params
+
+SCENARIO = [(0.5, 40, "meal"), (1.5, 500, "metformin"), (2.5, 30, "meal")]
+COLUMNS = ['BG_hist', 'CGM_hist', 'risk_hist', 'BPM_hist', 'CHO_hist', 'insulin_hist']
+
+
+def make_env():
+    # unseeded, the generators' states are all a fork has to go on
+    patient = T2DPatient({}, glucose_params=get_mard_params(), name="MARD", prob_of_actioning=0.7)
+    return T2DSimEnv(patient=patient, sensor=CGMSensor.withName('Dexcom'), pump=InsulinPump.withName('Insulet'),
+                     scenario=CustomScenario(start_time=datetime(2024, 1, 1), scenario=SCENARIO))
+
+
+def controller_action(t):
+    # recommended meals now and then, drawing the scheduler's jitter and compliance
+    meal = 20 if t % 12 == 5 else 0
+    return ControllerAction(basal=0.02, bolus=0, meal=meal, metformin=0, physical=0, time=30, times=[0, 0, 0, 0])
+
+
+def run(env, samples):
+    for t in samples:
+        env.step(controller_action(t))
+
+
+def test_fork_continues_bit_for_bit():
+    env = make_env()
+    run(env, range(20))
+    snapshot = env.snapshot()
+    fork = env.fork(snapshot)
+    run(env, range(20, 60))
+    run(fork, range(20, 60))
+
+    for name in COLUMNS:
+        np.testing.assert_array_equal(getattr(fork, name)[20:], getattr(env, name)[20:], err_msg=name)
+    np.testing.assert_array_equal(fork.patient.state, env.patient.state)
+    assert fork.patient.random_state.get_state()[1].tolist() == env.patient.random_state.get_state()[1].tolist()
+
+    # restoring the original replays the same samples again
+    env.restore(snapshot)
+    run(env, range(20, 60))
+    for name in COLUMNS:
+        np.testing.assert_array_equal(getattr(env, name), getattr(fork, name), err_msg=name)
@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+import pytest
+from datetime import datetime
+from T2DMSimulator.actuator.pump import InsulinPump
+from T2DMSimulator.controller.base import Action as ControllerAction
+from T2DMSimulator.patient.t2dpatient import T2DPatient
+from T2DMSimulator.sensor.cgm import CGMSensor
+from T2DMSimulator.simulation.env import T2DSimEnv
+from T2DMSimulator.simulation.history import History
+from T2DMSimulator.simulation.scenario import CustomScenario
+from T2DMSimulator.utils.glucose_params_subtypes import get_mard_params
+
+START_TIME = datetime(2024, 1, 1)
+N_SAMPLES = 30
+
+
+@pytest.fixture(scope='module')
+def env():
+    patient = T2DPatient({}, glucose_params=get_mard_params(), name="MARD", seed=0)
+    env = T2DSimEnv(patient=patient, sensor=CGMSensor.withName('Dexcom', seed=1), pump=InsulinPump.withName('Insulet'),
+                    scenario=CustomScenario(start_time=START_TIME, scenario=[(0.5, 40, "meal"), (1, 500, "metformin")]))
+    env.steps = [env.step(ControllerAction(basal=0.02, bolus=0, meal=0, metformin=0, physical=0, time=0, times=[0, 0, 0, 0]))
+                 for _ in range(N_SAMPLES)]
+    return env
+
+
+def baseline_history(env):
+    # show_history as it was built from the per field lists
+    df = pd.DataFrame()
+    df["Time"] = pd.Series(env.time_hist)
+    df["BG"] = pd.Series(list(env.BG_hist))
+    df["CGM"] = pd.Series(list(env.CGM_hist))
+    df["CHO"] = pd.Series(list(env.CHO_hist))
+    df["insulin"] = pd.Series(list(env.insulin_hist))
+    df["LBGI"] = pd.Series(list(env.LBGI_hist))
+    df["HBGI"] = pd.Series(list(env.HBGI_hist))
+    df["BPM"] = pd.Series(list(env.BPM_hist))
+    df["Risk"] = pd.Series(list(env.risk_hist))
+    df["actions"] = pd.Series(list(env.action_hist))
+    return df.set_index("Time")
+
+
+def test_history_views_hold_the_stepped_values(env):
+    steps = env.steps
+    assert len(env.BG_hist) == len(env.CGM_hist) == len(env.time_hist) == N_SAMPLES + 1
+    # the inputs of the last observation are not taken yet
+    assert len(env.CHO_hist) == len(env.insulin_hist) == len(env.BPM_hist) == len(env.action_hist) == N_SAMPLES
+    np.testing.assert_array_equal(env.BG_hist[1:], [step.info['bg'] for step in steps])
+    np.testing.assert_array_equal(env.CGM_hist[1:], [step.observation.CGM for step in steps])
+    np.testing.assert_array_equal(env.risk_hist[1:], [step.info['risk'] for step in steps])
+    np.testing.assert_array_equal(env.LBGI_hist[1:], [step.info['lbgi'] for step in steps])
+    np.testing.assert_array_equal(env.HBGI_hist[1:], [step.info['hbgi'] for step in steps])
+    np.testing.assert_array_equal(env.CHO_hist, [step.info['meal'] for step in steps])
+    assert env.time_hist[0] == START_TIME
+    assert env.time_hist[-1] == steps[-1].info['time']
+    assert env.action_hist.shape == (N_SAMPLES, 7) and env.action_hist.dtype == np.float32
+    assert env.CHO_hist.sum() > 0 and not np.isnan(env.BPM_hist).any()
+    with pytest.raises(ValueError):
+        env.BG_hist[0] = 0
+    with pytest.raises(AttributeError):
+        env.unknown_hist
+
+
+def test_show_history_matches_the_baseline_layout(env):
+    df, expected = env.show_history(), baseline_history(env)
+    pd.testing.assert_frame_equal(df.drop(columns='actions'), expected.drop(columns='actions'), check_freq=False)
+    assert list(df.columns) == list(expected.columns)
+    for row, expected_row in zip(df['actions'].iloc[:-1], expected['actions'].iloc[:-1]):
+        assert row.dtype == np.float32
+        np.testing.assert_array_equal(row, expected_row)
+    assert np.isnan(df['actions'].iloc[-1]) and np.isnan(expected['actions'].iloc[-1])
+
+
+def test_history_grows_past_its_preallocation():
+    history = History(chunk=4)
+    expected = []
+    for i in range(11):
+        history.append(time=i, BG=100 + i)
+        history.set_last(actions=np.full(7, i))
+        expected.append(100 + i)
+        # reading in between joins the chunks written so far
+        if i % 3 == 0:
+            np.testing.assert_array_equal(history['BG'], expected)
+    assert len(history) == 11 and history.capacity == 12
+    np.testing.assert_array_equal(history['time'], np.arange(11))
+    np.testing.assert_array_equal(history['BG'], expected)
+    np.testing.assert_array_equal(history['actions'], np.repeat(np.arange(11), 7).reshape(11, 7))
+    # fields never given stay NaN
+    assert np.isnan(history['CGM']).all() and len(history['CGM']) == 11
+
+    history.truncate(6)
+    history.append(time=6, BG=0)
+    np.testing.assert_array_equal(history['BG'], expected[:6] + [0])
+    assert np.isnan(history['actions'][-1]).all()
+    df = history.to_dataframe()
+    assert list(df.index) == list(range(7))
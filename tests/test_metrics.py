@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from T2DMSimulator.analysis.metrics import time_in_ranges, gmi, mage, hypo_events, glycemic_metrics, TIR_BANDS
+
+NAN = np.nan
+
+
+def test_time_in_ranges_band_edges():
+    BG = [53.9, 54, 69.9, 70, 180, 180.1, 250, 250.1, NAN]
+    fractions = time_in_ranges(BG)
+    # NaN samples are left out of the count
+    expected = {'very_low': 1 / 8, 'low': 2 / 8, 'in_range': 2 / 8, 'high': 2 / 8, 'very_high': 1 / 8}
+    assert set(fractions) == set(TIR_BANDS)
+    for name, value in expected.items():
+        assert fractions[name] == pytest.approx(value), name
+    assert sum(fractions.values()) == pytest.approx(1)
+
+
+def test_time_in_ranges_per_trace():
+    fractions = time_in_ranges([[60, 100, 100, 300], [100, 100, NAN, NAN]], bands={'target': (70, 180, 'both')})
+    np.testing.assert_allclose(fractions['target'], [0.5, 1.0])
+
+
+def test_gmi():
+    assert gmi([100, NAN, 200]) == pytest.approx(3.31 + 0.02392 * 150)
+    np.testing.assert_allclose(gmi([[154, 154], [100, 300]]), [3.31 + 0.02392 * 154, 3.31 + 0.02392 * 200])
+
+
+def test_mage_counts_excursions_larger_than_the_sd():
+    # turning points 200, 190, 200, 100: only the 100 mg/dL fall exceeds the
+    # sd of the trace (46.1)
+    assert mage([100, 200, 190, 200, 100, 200]) == pytest.approx(100)
+    # peaks and nadirs of different heights
+    BG = [100, 250, 100, 180, 100, 250]
+    assert np.std(BG) < 70
+    assert mage(BG) == pytest.approx((150 + 80 + 80) / 3)
+
+
+def test_mage_flat_stretches_and_nan():
+    # the plateaus turn at their last sample
+    assert mage([100, 200, 200, 100, 100, 200, 150]) == pytest.approx(100)
+    # NaN is left out of the sd and does not make a turning point
+    BG = [100, NAN, 150, 200, 100, 200, 100]
+    assert np.nanstd(BG) < 100
+    assert mage(BG) == pytest.approx(100)
+    assert np.isnan(mage([100, 100, 100, 100]))
+    assert np.isnan(mage([100, 120, 140, 160]))
+    # traces of a matrix do not share turning points
+    np.testing.assert_allclose(mage([[100, 200, 100, 200, 100], [100, 110, 120, 130, 140]]), [100, NAN])
+
+
+def test_hypo_events_duration():
+    # 5 minute samples: runs of 3 samples (15 min) and 4 count, 2 do not
+    BG = [100, 60, 60, 60, 100, 60, 60, 100, 60, 60, 60, 60, 100]
+    assert hypo_events(BG, 5) == 2
+    assert hypo_events(BG, 5, min_duration=10) == 3
+    # 4 samples of 4 minutes last 16
+    assert hypo_events(BG, 4) == 1
+    assert hypo_events(BG, 3) == 0
+    # threshold itself is not below it
+    assert hypo_events([70, 70, 70, 70], 5) == 0
+    assert hypo_events([69, 69, 69, 69], 5) == 1
+
+
+def test_hypo_events_merging():
+    # a run at the start and one at the end of the trace, consecutive
+    # samples below the threshold make one event
+    assert hypo_events([60, 60, 60, 100, 50, 65, 69, 60], 5) == 2
+    # one sample above the threshold or a NaN splits an event
+    assert hypo_events([60, 60, 71, 60, 60], 5) == 0
+    assert hypo_events([60, 60, 60, NAN, 60, 60, 60], 5) == 2
+    # runs do not continue into the next trace of a matrix
+    np.testing.assert_array_equal(hypo_events([[100, 100, 60, 60], [60, 60, 100, 100]], 5), [0, 0])
+    np.testing.assert_array_equal(hypo_events([[100, 60, 60, 60], [60, 60, 60, 100]], 5), [1, 1])
+
+
+def test_glycemic_metrics_chunks_match_single_traces():
+    rng = np.random.RandomState(0)
+    BG = 140 + 60 * np.sin(np.arange(200) / 10 + rng.uniform(0, 6, (7, 1))) + rng.normal(0, 10, (7, 200))
+    BG[2, 50:60] = NAN
+    metrics = glycemic_metrics(BG, 5, chunk=3)
+    for i in range(len(BG)):
+        for name, value in glycemic_metrics(BG[i], 5).items():
+            assert metrics[name][i] == pytest.approx(value, nan_ok=True), name
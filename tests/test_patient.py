@@ -0,0 +1,42 @@
+import numpy as np
+from T2DMSimulator.controller.base import Action as ControllerAction
+from T2DMSimulator.patient.t2dpatient import T2DPatient, Action
+from T2DMSimulator.utils.glucose_params_subtypes import get_mard_params
+
+NO_RECOMMENDATION = ControllerAction(basal=0, bolus=0, meal=0, metformin=0, physical=0, time=0, times=[0, 0, 0, 0])
+
+
+def meal_response(meal, n_steps=240, meal_time=30, **kwargs):
+    patient = T2DPatient({}, glucose_params=get_mard_params(), name="MARD", **kwargs)
+    BG = [patient.observation.Gsub]
+    for t in range(n_steps):
+        action = Action(CHO=meal if t == meal_time else 0, insulin_fast=0, insulin_long=0, metformin=0,
+                        vildagliptin=0, stress=0, physical=0)
+        patient.step(action, NO_RECOMMENDATION)
+        BG.append(patient.observation.Gsub)
+    return np.array(BG)
+
+
+def test_postprandial_peak():
+    # a 60 g meal eaten from minute 30 raises BG by about 117 mg/dL an hour
+    # later, the absorbed glucose (Ra, mg/min) entering the whole-body gut
+    # compartment
+    BG = meal_response(60)
+    rise = BG.max() - BG[30]
+    assert 105 < rise < 130
+    assert 40 <= BG.argmax() - 30 <= 75
+    assert BG[240] < BG.max() - 50
+
+
+def test_postprandial_peak_grows_with_the_meal():
+    small, large = meal_response(30), meal_response(60)
+    ratio = (small.max() - small[30]) / (large.max() - large[30])
+    assert 0.4 < ratio < 0.6
+
+
+def test_horizon_integration_follows_minute_integration():
+    # horizon mode holds the resting heart rate at block means, which moves
+    # the glucose by less than the solvers' tolerances do
+    minute = meal_response(60, n_steps=360, seed=1)
+    horizon = meal_response(60, n_steps=360, seed=1, integration='horizon')
+    np.testing.assert_allclose(horizon, minute, rtol=3e-3)
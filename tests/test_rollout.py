@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from T2DMSimulator.controller.base import Action as ControllerAction
+from T2DMSimulator.patient.t2dpatient import T2DPatient, Action
+from T2DMSimulator.simulation.rollout import rollout
+from T2DMSimulator.utils.glucose_params_subtypes import get_mard_params
+
+NO_RECOMMENDATION = ControllerAction(basal=0, bolus=0, meal=0, metformin=0, physical=0, time=0, times=[0, 0, 0, 0])
+N_STEPS = 90
+# doses on the first and last minute of the rollout, a meal with a dose and
+# a dose on the minute after, minute: inputs
+DOSES = {0: dict(insulin_fast=2.0), 30: dict(CHO=30, metformin=500), 31: dict(insulin_long=5.0),
+         N_STEPS - 1: dict(insulin_fast=1.0, vildagliptin=50)}
+
+
+def inputs(**doses):
+    return Action(**dict(dict.fromkeys(Action._fields, 0), **doses))
+
+
+@pytest.fixture(scope='module')
+def stepped():
+    # rollouts assume the noise free resting heart rate
+    patient = T2DPatient({}, glucose_params=get_mard_params(), name="MARD", seed=3)
+    patient.HEART_RATE_STD = 0
+    # the snapshot is taken while a meal is being eaten
+    for t in range(20):
+        patient.step(inputs(CHO=40 if t == 15 else 0), NO_RECOMMENDATION)
+    snapshot = patient.snapshot()
+    other = patient.fork(snapshot)
+    BG = [other.observation.Gsub]
+    for t in range(N_STEPS):
+        other.step(inputs(**DOSES.get(t, {})), NO_RECOMMENDATION)
+        BG.append(other.observation.Gsub)
+    return patient, snapshot, np.array(BG)
+
+
+@pytest.mark.parametrize('method', ['rows', 'RK45', 'BDF'])
+def test_single_candidate_rollout_matches_stepping_the_patient(stepped, method):
+    patient, snapshot, expected = stepped
+    schedule = {field: np.zeros(N_STEPS) for field in Action._fields}
+    for t, doses in DOSES.items():
+        for field, value in doses.items():
+            schedule[field][t] = value
+    result = rollout(patient, Action(**schedule), N_STEPS, snapshot=snapshot, method=method, rtol=1e-8, atol=1e-10)
+    assert result.BG.shape == (1, N_STEPS + 1)
+    np.testing.assert_array_equal(result.time, snapshot.t + np.arange(N_STEPS + 1))
+    # the patient's dopri5 runs at rtol 1e-6
+    np.testing.assert_allclose(result.BG[0], expected, atol=5e-3)
+    # the rollout leaves the patient where it was
+    np.testing.assert_array_equal(patient.state, snapshot.state)
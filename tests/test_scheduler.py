@@ -0,0 +1,119 @@
+import random
+from T2DMSimulator.utils.scheduler import RecommendationScheduler
+
+
+def test_items_are_due_delay_after_now():
+    scheduler = RecommendationScheduler(time_scale=5)
+    scheduler.put('meal', 10, 25)
+    assert scheduler.get(14) is None
+    assert scheduler.size() == 1
+    assert scheduler.get(15) == 'meal'
+    assert scheduler.is_empty()
+    assert scheduler.get(100) is None
+
+
+def test_overdue_items_come_one_per_get():
+    scheduler = RecommendationScheduler()
+    scheduler.put('a', 0, 1)
+    scheduler.put('b', 0, 2)
+    assert scheduler.get(10) == 'a'
+    assert scheduler.get(10) == 'b'
+    assert scheduler.get(10) is None
+
+
+def test_repeated_items_are_dropped():
+    scheduler = RecommendationScheduler()
+    assert scheduler.put('a', 0, 5) is not None
+    assert scheduler.put('a', 1, 5) is None
+    assert scheduler.put('b', 2, 5) is not None
+    assert scheduler.put('a', 3, 5) is not None
+    assert scheduler.size() == 3
+
+
+def test_heap_returns_items_in_due_order():
+    rng = random.Random(0)
+    scheduler = RecommendationScheduler()
+    dues = [rng.randint(0, 50) for _ in range(200)]
+    for i, due in enumerate(dues):
+        scheduler.put((due, i), 0, due)
+    # ties are carried out in the order they were put
+    expected = sorted((due, i) for i, due in enumerate(dues))
+    assert list(scheduler) == expected
+    assert scheduler.peek() == expected[0]
+    assert [scheduler.get(50) for _ in dues] == expected
+    assert scheduler.is_empty()
+
+
+def test_cancelled_items_are_skipped():
+    scheduler = RecommendationScheduler()
+    handles = [scheduler.put(i, 0, i) for i in range(5)]
+    scheduler.cancel(handles[0])
+    scheduler.cancel(handles[3])
+    # cancelling twice or after the item is gone does nothing
+    scheduler.cancel(handles[3])
+    assert scheduler.size() == 3
+    assert list(scheduler) == [1, 2, 4]
+    assert scheduler.peek() == 1
+    assert [scheduler.get(10) for _ in range(4)] == [1, 2, 4, None]
+    scheduler.cancel(handles[1])
+    assert scheduler.is_empty()
+    assert not scheduler.heap and not scheduler.cancelled
+
+
+def test_jitter_moves_the_due_time_within_its_range():
+    moved = 0
+    for seed in range(500):
+        scheduler = RecommendationScheduler(seed=seed)
+        scheduler.put('meal', 100, 50, jitter=(10, 20))
+        due = scheduler.heap[0][0]
+        assert due == 150 or 10 <= abs(due - 150) <= 20
+        moved += due != 150
+        # a seeded scheduler makes the same draw every time
+        scheduler.put('other', 100, 50, jitter=(10, 20))
+        assert [entry[0] for entry in scheduler.heap] == [due, due]
+    assert abs(moved / 500 - RecommendationScheduler.JITTER_PROB) < 0.07
+
+
+def test_unseeded_jitter_is_random():
+    scheduler = RecommendationScheduler()
+    for i in range(200):
+        scheduler.put(i, 0, 50, jitter=(10, 20))
+    dues = {due for due, _, _ in scheduler.heap}
+    assert len(dues) > 10 and 50 in dues
+
+
+def test_compliance_is_the_share_of_due_items_carried_out():
+    scheduler = RecommendationScheduler()
+    scheduler._random.seed(0)
+    for i in range(1000):
+        scheduler.put(i, 0, 0)
+    carried_out = [scheduler.get(0, compliance=0.3) for _ in range(1000)]
+    assert scheduler.is_empty()
+    assert abs(sum(item is not None for item in carried_out) / 1000 - 0.3) < 0.05
+
+    # seeded, every decision has the same outcome
+    for seed in range(20):
+        scheduler = RecommendationScheduler(seed=seed)
+        for i in range(10):
+            scheduler.put(i, 0, 0)
+        outcomes = {scheduler.get(0, compliance=0.5) is None for _ in range(10)}
+        assert len(outcomes) == 1
+    scheduler = RecommendationScheduler()
+    scheduler.put('a', 0, 0)
+    # not carried out, but no longer waiting either
+    assert scheduler.get(0, compliance=0) is None
+    assert scheduler.is_empty()
+
+
+def test_copies_are_independent():
+    scheduler = RecommendationScheduler()
+    handle = scheduler.put('a', 0, 5, jitter=(10, 20))
+    scheduler.put('b', 0, 10, jitter=(10, 20))
+    other = scheduler.copy()
+    other.cancel(handle)
+    other.put('c', 0, 1)
+    assert set(scheduler) == {'a', 'b'} and scheduler.size() == 2
+    assert set(other) == {'b', 'c'} and other.size() == 2
+    # and continue the same draws
+    draws = [scheduler._random.random() for _ in range(3)]
+    assert [other._random.random() for _ in range(3)] == draws
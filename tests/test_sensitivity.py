@@ -0,0 +1,34 @@
+import numpy as np
+from T2DMSimulator.analysis.sensitivity import forward_sensitivity
+from T2DMSimulator.patient.t2dpatient import T2DPatient, Action
+from T2DMSimulator.simulation.rollout import rollout
+from T2DMSimulator.utils.glucose_params_subtypes import get_mard_params
+
+# parameters GlucoseInitializer uses (Ks, QGL) and one it does not (c1)
+PARAMETERS = [('pancreasModel', 'Ks'), ('glucoseSubmodel', 'QGL'), ('glucoseMetabolicRates', 'c1')]
+
+
+def scaled_patient(submodel=None, name=None, factor=1.0):
+    glucose_params = get_mard_params()
+    if submodel is not None:
+        entries = getattr(glucose_params, submodel)
+        setattr(entries, name, getattr(entries, name) * factor)
+    return T2DPatient({}, glucose_params=glucose_params, name="MARD")
+
+
+def test_forward_sensitivity_matches_reinitialized_patients():
+    n_steps = 120
+    CHO, metformin = np.zeros(n_steps), np.zeros(n_steps)
+    CHO[10], metformin[60] = 60, 500
+    actions = Action(CHO=CHO, insulin_fast=0, insulin_long=0, metformin=metformin, vildagliptin=0, stress=0, physical=0)
+    patient = scaled_patient()
+    result = forward_sensitivity(patient, ['{}.{}'.format(*parameter) for parameter in PARAMETERS], actions, n_steps)
+
+    for j, (submodel, name) in enumerate(PARAMETERS):
+        # central differences of full simulations of patients built with
+        # the perturbed parameter, basal values and initial state included
+        h = 1e-4
+        up = rollout(scaled_patient(submodel, name, 1 + h), actions, n_steps, method='BDF', rtol=1e-10, atol=1e-10).BG[0]
+        down = rollout(scaled_patient(submodel, name, 1 - h), actions, n_steps, method='BDF', rtol=1e-10, atol=1e-10).BG[0]
+        expected = (up - down) / (2 * h * getattr(getattr(patient.param, submodel), name))
+        np.testing.assert_allclose(result.dBG[:, j], expected, atol=1e-3 * np.abs(expected).max())
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+import pytest
+from datetime import datetime
+from T2DMSimulator.actuator.pump import InsulinPump
+from T2DMSimulator.controller.base import Action as ControllerAction
+from T2DMSimulator.patient.t2dpatient import T2DPatient
+from T2DMSimulator.sensor.cgm import CGMSensor
+from T2DMSimulator.simulation import history
+from T2DMSimulator.simulation.env import T2DSimEnv
+from T2DMSimulator.simulation.history import History, Downsampler, NpzSink, ParquetSink, HISTORY_TABLE, columns_dataframe
+from T2DMSimulator.simulation.scenario import CustomScenario
+from T2DMSimulator.utils.glucose_params_subtypes import get_mard_params
+
+SINKS = [NpzSink, pytest.param(ParquetSink, marks=pytest.mark.skipif(not history.pyarrow, reason='needs pyarrow'))]
+CHUNK = 8
+N_ROWS = 101
+
+
+def rows(n=N_ROWS, seed=0):
+    # a 3 minute sampled record with missing values and a multi value field
+    rng = np.random.RandomState(seed)
+    columns = {name: rng.uniform(50, 300, n) for name in ['BG', 'CGM', 'risk', 'LBGI', 'HBGI', 'BPM', 'CHO', 'insulin']}
+    columns['time'] = 3.0 * np.arange(n)
+    columns['CHO'][rng.uniform(size=n) < 0.2] = np.nan
+    columns['actions'] = rng.uniform(0, 1, (n, 7)).astype(np.float32)
+    return columns
+
+
+def record(columns, **kwargs):
+    store = History(chunk=CHUNK, **kwargs)
+    sizes = []
+    for i in range(len(columns['time'])):
+        store.append(**{name: values[i] for name, values in columns.items()})
+        sizes.append(sum(block.nbytes for blocks in store.blocks.values() for block in blocks))
+    return store, sizes
+
+
+@pytest.mark.parametrize('sink_type', SINKS)
+def test_streamed_rows_read_back(tmp_path, sink_type):
+    columns = rows()
+    sink = sink_type(str(tmp_path))
+    store, _ = record(columns, sink=sink)
+    store.finish()
+    sink.close()
+    written = sink.read(HISTORY_TABLE)
+    if sink_type is ParquetSink:
+        # one parquet column per action
+        columns.update(('actions_{}'.format(i), column) for i, column in enumerate(columns.pop('actions').T))
+    assert sorted(written) == sorted(columns)
+    for name, values in columns.items():
+        np.testing.assert_array_equal(written[name], values)
+    # the rows still in memory are the latest ones
+    assert len(store.column('BG')) < N_ROWS
+    np.testing.assert_array_equal(store.column('BG'), columns['BG'][store.start:])
+
+
+@pytest.mark.parametrize('sink_type', SINKS)
+def test_downsampled_tiers_match_binned_rows(tmp_path, sink_type):
+    columns = rows()
+    sink = sink_type(str(tmp_path))
+    store, _ = record(columns, sink=sink, tiers=[Downsampler(15), Downsampler(60)])
+    store.finish()
+    sink.close()
+    frame = pd.DataFrame({name: values for name, values in columns.items() if values.ndim == 1})
+    for minutes in (15, 60):
+        tier = sink.read('{}min'.format(minutes))
+        groups = frame.groupby(np.floor(frame['time'] / minutes) * minutes)
+        np.testing.assert_array_equal(tier['time'], groups.size().index)
+        np.testing.assert_array_equal(tier['count'], groups.size())
+        for name in ['BG', 'CHO']:
+            # the statistics skip missing values
+            np.testing.assert_allclose(tier[name + '_mean'], groups[name].mean(), rtol=1e-12)
+            np.testing.assert_array_equal(tier[name + '_min'], groups[name].min())
+            np.testing.assert_array_equal(tier[name + '_max'], groups[name].max())
+
+
+def test_streaming_memory_is_bounded(tmp_path):
+    _, sizes = record(rows(), sink=NpzSink(str(tmp_path)))
+    # two chunks are allocated once and reused
+    assert len(set(sizes)) == 1
+    _, in_memory = record(rows())
+    assert in_memory[-1] > 6 * sizes[-1]
+
+
+def test_streamed_env_history_matches_the_in_memory_one(tmp_path):
+    def make_env():
+        patient = T2DPatient({}, glucose_params=get_mard_params(), name="MARD", seed=0)
+        return T2DSimEnv(patient=patient, sensor=CGMSensor.withName('Dexcom', seed=1), pump=InsulinPump.withName('Insulet'),
+                         scenario=CustomScenario(start_time=datetime(2024, 1, 1), scenario=[(0.5, 40, "meal")]))
+
+    action = ControllerAction(basal=0.02, bolus=0, meal=0, metformin=0, physical=0, time=0, times=[0, 0, 0, 0])
+    streamed, in_memory = make_env(), make_env()
+    sink = NpzSink(str(tmp_path))
+    streamed.stream(sink, tiers=(15,), chunk=24)
+    for _ in range(100):
+        # the rewards look back over the streamed history too
+        assert streamed.step(action).reward == in_memory.step(action).reward
+    assert len(streamed.history.column('BG')) <= 48
+    streamed.close()
+    df = columns_dataframe(sink.read(), in_memory.scenario.start_time)
+    expected = in_memory.show_history()
+    pd.testing.assert_frame_equal(df.drop(columns='actions'), expected.drop(columns='actions'), check_freq=False)
+    np.testing.assert_array_equal(np.stack(df['actions'].iloc[:-1]), np.stack(expected['actions'].iloc[:-1]))
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from T2DMSimulator.glucose.GlucoseParameters import GlucoseParameters
+from T2DMSimulator.glucose.compiled import PARAMETER_LAYOUT, compile_parameters
+from T2DMSimulator.patient.t2dpatient import T2DPatient
+from T2DMSimulator.patient.virtual_cohort import generate_virtual_cohort, SubtypeDistribution, BRATE_KEYS
+from T2DMSimulator.utils.glucose_params_subtypes import SUBTYPES
+
+
+def patient_of(row):
+    # the T2DPatient a cohort row was sampled for
+    glucose_params = GlucoseParameters()
+    for i, (submodel_name, name) in enumerate(PARAMETER_LAYOUT):
+        setattr(getattr(glucose_params, submodel_name), name, float(row['params'][i]))
+    return T2DPatient({}, glucose_params=glucose_params, GBPC0=float(row['GBPC0']), IBPF0=float(row['IBPF0']),
+                      brates=dict(zip(BRATE_KEYS, row['brates'].tolist())), steady_state_cache=None)
+
+
+def test_cohort_matches_per_patient_initialization():
+    cohort = generate_virtual_cohort(24, seed=0)
+    assert set(cohort['subtype']) == set(SUBTYPES)
+    np.testing.assert_array_equal(cohort['id'], np.arange(24))
+    for row in cohort:
+        patient = patient_of(row)
+        np.testing.assert_array_equal(row['params'], compile_parameters(patient.param, patient.basal))
+        np.testing.assert_array_equal(row['X0'], patient.X0v)
+
+
+@pytest.mark.parametrize('subtype', sorted(SUBTYPES))
+def test_unvaried_distribution_is_the_subtype_preset(subtype):
+    glucose_params, brates = SUBTYPES[subtype]
+    distribution = SubtypeDistribution.subtype(subtype, variation={}, GBPC0_cv=0)
+    cohort = generate_virtual_cohort(3, seed=1, distributions={subtype: distribution})
+    patient = T2DPatient({}, glucose_params=glucose_params(), brates=brates, steady_state_cache=None)
+    for row in cohort:
+        np.testing.assert_array_equal(row['params'], compile_parameters(patient.param, patient.basal))
+        np.testing.assert_array_equal(row['X0'], patient.X0v)
+
+
+def test_seed_reproducibility():
+    first, second = generate_virtual_cohort(50, seed=7), generate_virtual_cohort(50, seed=7)
+    for field in first.dtype.names:
+        np.testing.assert_array_equal(first[field], second[field])
+    other = generate_virtual_cohort(50, seed=8)
+    assert not np.array_equal(first['params'], other['params'])
+    assert not np.array_equal(first['GBPC0'], other['GBPC0'])
+
+
+def test_proportions():
+    cohort = generate_virtual_cohort(400, proportions={'MARD': 3, 'SIDD': 1}, seed=0)
+    assert set(cohort['subtype']) == {'MARD', 'SIDD'}
+    assert abs(np.mean(cohort['subtype'] == 'MARD') - 0.75) < 0.07
+    # the varied parameters scatter around the subtype's values
+    c1 = cohort['params'][cohort['subtype'] == 'MARD', PARAMETER_LAYOUT.index(('glucoseMetabolicRates', 'c1'))]
+    expected = SUBTYPES['MARD'][0]().glucoseMetabolicRates.c1
+    assert abs(c1.mean() / expected - 1) < 0.05
+    assert 0.15 < c1.std() / c1.mean() < 0.25